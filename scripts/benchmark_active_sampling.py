@@ -0,0 +1,150 @@
+# %%
+import time
+from typing import Dict, List, Optional, Tuple
+
+import fire
+import numpy as np
+import scipy.sparse
+import torch
+from sklearn.metrics.cluster import adjusted_rand_score
+
+from swap_graphs.community_detection import detect_communities
+from swap_graphs.core import active_edge_sampling, default_weight_func, sample_edges
+from swap_graphs.utils import load_object
+
+
+def planted_comp_metrics(
+    nb_nodes: int, nb_communities: int, rng: np.random.Generator
+) -> np.ndarray:
+    """A synthetic [source, target] matrix of comparison metrics: small inside the planted communities, large between them."""
+    labels = rng.integers(0, nb_communities, nb_nodes)
+    same = labels[:, None] == labels[None, :]
+    comp_metrics = np.where(
+        same,
+        np.abs(rng.normal(0.5, 0.3, (nb_nodes, nb_nodes))),
+        np.abs(rng.normal(2.0, 0.6, (nb_nodes, nb_nodes))),
+    )
+    np.fill_diagonal(comp_metrics, np.nan)
+    return comp_metrics
+
+
+def load_full_comp_metrics(xp_path: str, nb_components: int) -> Dict[str, np.ndarray]:
+    """The [source, target] matrices of comparison metrics of the full swap graphs saved by compute_sgraphs.py."""
+    all_data = load_object(xp_path, "all_data.pkl")
+    matrices = {}
+    for name, component_data in list(all_data.items())[:nb_components]:
+        edges = np.array(component_data["sgraph_edges"], dtype=np.float64)
+        sources, targets = edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64)
+        nb_nodes = max(sources.max(), targets.max()) + 1
+        comp_metrics = np.full((nb_nodes, nb_nodes), np.nan)
+        comp_metrics[sources, targets] = edges[:, 2]
+        matrices[name] = comp_metrics
+    return matrices
+
+
+def communities_from_edges(
+    nb_nodes: int,
+    sources: np.ndarray,
+    targets: np.ndarray,
+    comp_metrics: np.ndarray,
+    resolution: float,
+    seed: int,
+) -> np.ndarray:
+    weights = default_weight_func(comp_metrics)(comp_metrics)
+    nonzero = weights != 0
+    return detect_communities(
+        scipy.sparse.csr_matrix(
+            (weights[nonzero], (sources[nonzero], targets[nonzero])),
+            shape=(nb_nodes, nb_nodes),
+        ),
+        resolution=resolution,
+        seed=seed,
+    )
+
+
+def benchmark_active_sampling(
+    xp_path: Optional[str] = None,
+    nb_components: int = 5,
+    nb_nodes: int = 300,
+    nb_communities: int = 6,
+    budget_fractions: Tuple[float, ...] = (0.1, 0.2),
+    initial_sources_per_target: int = 5,
+    resolution: float = 1.0,
+    seed: int = 0,
+):
+    """Compare the communities of swap graphs built with a fraction of the patched forward passes (active sampling vs uniform sampling) to the communities of the full graphs, with the adjusted Rand index.
+    The forward passes are replayed from the comparison metrics of full graphs: the graphs saved in xp_path/all_data.pkl by compute_sgraphs.py, or synthetic graphs with planted communities if xp_path is None."""
+    rng = np.random.default_rng(seed)
+    if xp_path is not None:
+        full_comp_metrics = load_full_comp_metrics(xp_path, nb_components)
+    else:
+        full_comp_metrics = {
+            f"planted_{i}": planted_comp_metrics(nb_nodes, nb_communities, rng)
+            for i in range(nb_components)
+        }
+
+    results: Dict[Tuple[str, float], List[float]] = {}
+    for name, comp_metrics in full_comp_metrics.items():
+        n = comp_metrics.shape[0]
+        full_targets, full_sources = np.nonzero(~np.isnan(comp_metrics.T))
+        full_labels = communities_from_edges(
+            n,
+            full_sources,
+            full_targets,
+            comp_metrics[full_sources, full_targets],
+            resolution,
+            seed,
+        )
+
+        def evaluate_edges(sources: List[int], targets: List[int]) -> np.ndarray:
+            return comp_metrics[sources, targets]
+
+        for fraction in budget_fractions:
+            edge_budget = int(fraction * len(full_sources))
+            start = time.perf_counter()
+            sources, targets, metrics = active_edge_sampling(
+                n,
+                evaluate_edges,
+                edge_budget,
+                initial_sources_per_target=initial_sources_per_target,
+                resolution=resolution,
+                seed=seed,
+            )
+            active_time = time.perf_counter() - start
+            active_labels = communities_from_edges(
+                n, sources, targets, metrics, resolution, seed
+            )
+
+            uniform_sources, uniform_targets = sample_edges(
+                n,
+                nb_edges=edge_budget,
+                generator=torch.Generator().manual_seed(seed),
+            )
+            uniform_sources, uniform_targets = np.array(uniform_sources), np.array(
+                uniform_targets
+            )
+            uniform_labels = communities_from_edges(
+                n,
+                uniform_sources,
+                uniform_targets,
+                comp_metrics[uniform_sources, uniform_targets],
+                resolution,
+                seed,
+            )
+
+            active_ari = adjusted_rand_score(full_labels, active_labels)
+            uniform_ari = adjusted_rand_score(full_labels, uniform_labels)
+            results.setdefault(("active", fraction), []).append(active_ari)
+            results.setdefault(("uniform", fraction), []).append(uniform_ari)
+            print(
+                f"{name}: {len(sources)}/{len(full_sources)} forward passes (x{len(full_sources) / len(sources):.1f} fewer), ARI active {active_ari:.3f}, ARI uniform {uniform_ari:.3f}, sampling overhead {active_time:.1f}s"
+            )
+
+    for fraction in budget_fractions:
+        print(
+            f"Budget {fraction:.0%} of the edges: mean ARI with the full graph, active {np.mean(results[('active', fraction)]):.3f}, uniform {np.mean(results[('uniform', fraction)]):.3f}"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_active_sampling)
@@ -0,0 +1,95 @@
+# %%
+import random as rd
+import time
+from typing import List
+
+import torch
+import fire
+
+from swap_graphs.core import (
+    ModelComponent,
+    WildPosition,
+    component_patching_hook,
+)
+
+torch.set_grad_enabled(False)
+
+
+def loop_patching_hook(
+    z: torch.Tensor,
+    cache: torch.Tensor,
+    component: ModelComponent,
+    source_idx: List[int],
+    target_idx: List[int],
+):
+    """The previous implementation of component_patching_hook, kept as a reference: one Python iteration per row, positions recomputed at each iteration."""
+    for i in range(len(source_idx)):
+        z[i, component.position.positions_from_idx(target_idx)[i], component.head, :] = cache[
+            i, component.position.positions_from_idx(source_idx)[i], component.head, :
+        ]
+    return z
+
+
+def time_fn(fn, nb_runs: int, device: str) -> float:
+    fn()  # warmup
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(nb_runs):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / nb_runs
+
+
+def benchmark_patching_hook(
+    batch_size: int = 256,
+    seq_len: int = 300,
+    n_heads: int = 12,
+    d_head: int = 64,
+    dataset_size: int = 1000,
+    nb_runs: int = 20,
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+):
+    """Compare the time of a single call of the patching hook between the Python loop and the vectorized implementation. The index tensors of the vectorized hook are built once per batch, as in ActivationStore.getPatchingHooksByIdx."""
+    position = WildPosition(
+        [rd.randint(0, seq_len - 1) for _ in range(dataset_size)], label="END"
+    )
+    component = ModelComponent(position=position, layer=0, name="z", head=3)
+    source_idx = [rd.randint(0, dataset_size - 1) for _ in range(batch_size)]
+    target_idx = [rd.randint(0, dataset_size - 1) for _ in range(batch_size)]
+
+    z = torch.randn(batch_size, seq_len, n_heads, d_head, device=device)
+    cache = torch.randn(batch_size, seq_len, n_heads, d_head, device=device)
+
+    target_positions = position.positions_tensor_from_idx(target_idx, device=device)
+    source_positions = position.positions_tensor_from_idx(source_idx, device=device)
+
+    loop_time = time_fn(
+        lambda: loop_patching_hook(z, cache, component, source_idx, target_idx),
+        nb_runs,
+        device,
+    )
+    vectorized_time = time_fn(
+        lambda: component_patching_hook(
+            z,
+            hook=None,  # type: ignore
+            cache=cache,
+            component=component,
+            source_idx=source_idx,
+            target_idx=target_idx,
+            target_positions=target_positions,
+            source_positions=source_positions,
+        ),
+        nb_runs,
+        device,
+    )
+
+    print(f"batch size {batch_size}, seq len {seq_len}, device {device}")
+    print(f"Python loop hook: {loop_time * 1e3:.2f} ms")
+    print(f"Vectorized hook:  {vectorized_time * 1e6:.2f} µs")
+    print(f"Speedup: x{loop_time / vectorized_time:.0f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_patching_hook)
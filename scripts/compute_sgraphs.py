@@ -1,7 +1,11 @@
 # %%
+import concurrent.futures
+import contextlib
 import copy
 import dataclasses
+import hashlib
 import itertools
+import multiprocessing
 import os
 import pickle
 import random
@@ -11,7 +15,7 @@ from copy import deepcopy
 from functools import partial
 from pathlib import Path
 from pprint import pprint
-from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 
 import datasets
@@ -55,6 +59,8 @@ from swap_graphs.core import (
     find_important_components,
     SgraphDataset,
     compute_clustering_metrics,
+    IncrementalPatchingEngine,
+    plan_batch_size,
 )
 from torch.utils.data import DataLoader
 from transformer_lens import (
@@ -86,6 +92,8 @@ from swap_graphs.utils import (
     show_mtx,
 )
 from swap_graphs.core import SgraphDataset, SwapGraph, break_long_str
+from swap_graphs.community_detection import CommunityBackend
+from swap_graphs.work_queue import FileWorkQueue
 
 from tqdm import tqdm
 
@@ -104,18 +112,230 @@ from swap_graphs.datasets.nano_qa.nano_qa_dataset import (
 from swap_graphs.datasets.nano_qa.nano_qa_utils import print_performance_table
 
 
+def edge_log_path(edge_log_dir: str, component_name: str) -> str:
+    return os.path.join(edge_log_dir, f"{component_name}.edges")
+
+
+def remove_edge_logs(edge_log_dir: str, component_names: Iterable[str]):
+    """Remove the edge logs of the components whose result is saved."""
+    for name in component_names:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(edge_log_path(edge_log_dir, name))
+
+
+def build_component_sgraph(
+    c: ModelComponent,
+    model: HookedTransformer,
+    dataset,
+    sgraph_dataset: SgraphDataset,
+    comp_metric: CompMetric,
+    batch_size_sgraph: Optional[int],
+    eval_position: WildPosition,
+    incremental_engine: Optional[IncrementalPatchingEngine],
+    sorted_components: List[ModelComponent],
+    fig_path: str,
+    convergence_patience: Optional[int] = None,
+    convergence_threshold: float = 0.95,
+    skip_equal_activations: Optional[float] = None,
+    community_backend: CommunityBackend = "louvain",
+    edge_log_dir: Optional[str] = None,
+    initial_positions: Optional[Dict[int, np.ndarray]] = None,
+    layout_iterations: int = 100,
+    warm_layout_iterations: int = 20,
+) -> Dict:
+    """Build the swap graph of the component c, compute its communities and metrics and save its html plot. Return the data stored in all_data for this component. If convergence_patience is set, the graph is built by rounds until its communities converge (see SwapGraph.build_until_convergence).
+    If edge_log_dir is given, the evaluated edges are saved in an edge log per component in this folder while the graph is built, such that an interrupted component resumes where it stopped.
+    If initial_positions is given (the node positions of the previous component), the layout of the plot is warm-started from it with warm_layout_iterations iterations instead of layout_iterations, such that the plots of consecutive components are aligned."""
+    sgraph = SwapGraph(
+        model=model,
+        tok_dataset=dataset.prompts_tok,
+        comp_metric=comp_metric,
+        batch_size=batch_size_sgraph,
+        proba_edge=1.0,
+        patchedComponents=[c],
+        eval_position=eval_position,
+        incremental_engine=incremental_engine,
+        seed=component_seed(c),
+        skip_equal_activations=skip_equal_activations,
+        community_backend=community_backend,
+    )
+    if convergence_patience is None:
+        log_path = None
+        if edge_log_dir is not None:
+            log_path = edge_log_path(edge_log_dir, str(c))
+        sgraph.build(verbose=False, progress_bar=False, edge_log_path=log_path)
+    else:
+        sgraph.build_until_convergence(
+            ari_threshold=convergence_threshold, patience=convergence_patience
+        )
+    sgraph.compute_weights()
+    sgraph.compute_communities()
+
+    component_data = {}
+    component_data["nb_skipped_edges"] = sgraph.nb_skipped_edges
+    if convergence_patience is not None:
+        component_data["convergence"] = {
+            "converged": sgraph.converged,
+            "nb_rounds": len(sgraph.convergence_trace),
+            "trace": sgraph.convergence_trace,
+        }
+    component_data["clustering_metrics"] = compute_clustering_metrics(sgraph)
+    component_data["feature_metrics"] = sgraph_dataset.compute_feature_rand(sgraph)
+    component_data["sgraph_edges"] = sgraph.raw_edges
+    component_data["commu"] = sgraph.commu_labels
+    component_data["node_positions"] = sgraph.compute_layout(
+        iterations=layout_iterations
+        if initial_positions is None
+        else warm_layout_iterations,
+        initial_positions=initial_positions,
+        seed=component_seed(c),
+    )
+
+    # create html plot for the graph
+    largest_rand_feature, max_rand_idx = max(
+        component_data["feature_metrics"]["rand"].items(), key=lambda x: x[1]
+    )
+    title = wrap_str(
+        f"<b>{sgraph.patchedComponents[0]}</b> Average CompMetric: {np.mean(sgraph.edge_comp_metrics):.2f} (#{sorted_components.index(c)}), Rand idx commu-{largest_rand_feature}: {max_rand_idx:.2f}, modularity: {component_data['clustering_metrics']['modularity']:.2f}",
+        max_line_len=70,
+    )
+
+    sgraph.show_html(
+        sgraph_dataset,
+        feature_to_show="all",
+        title=title,
+        display=False,
+        save_path=fig_path,
+        color_discrete=True,
+    )
+    return deepcopy(component_data)
+
+
+WORKER_STATE: Dict[str, Any] = {}  # the arguments of build_component_sgraph shared by all the components of a worker process
+
+
+def load_pretrained_model(model_name: str, device: str) -> HookedTransformer:
+    return HookedTransformer.from_pretrained(model_name, device=device)
+
+
+def init_sgraph_worker(
+    model_name: str,
+    device: str,
+    threads_per_worker: int,
+    incremental_patching: bool,
+    batch_size: Optional[int],
+    sgraph_kwargs: Dict[str, Any],
+    model_loader: Callable[[str, str], HookedTransformer] = load_pretrained_model,
+):
+    """Initialize a worker process: load the model once and store the arguments of build_component_sgraph shared by the components of its shard."""
+    torch.set_grad_enabled(False)
+    torch.set_num_threads(threads_per_worker)
+    model = model_loader(model_name, device)
+    incremental_engine = None
+    if incremental_patching:
+        incremental_engine = IncrementalPatchingEngine(
+            model=model,
+            dataset=sgraph_kwargs["dataset"].prompts_tok,
+            position=sgraph_kwargs["eval_position"],
+            batch_size=batch_size
+            or plan_batch_size(
+                model, sgraph_kwargs["dataset"].prompts_tok.shape[1], full_logits=False
+            ),
+        )
+    WORKER_STATE.update(sgraph_kwargs)
+    if sgraph_kwargs.get("queue") is not None:
+        # the queue is pickled with the worker id of the parent process: each worker claims its leases under its own id
+        WORKER_STATE["queue"] = FileWorkQueue(
+            queue_dir=sgraph_kwargs["queue"].queue_dir,
+            lease_seconds=sgraph_kwargs["queue"].lease_seconds,
+        )
+    WORKER_STATE["model"] = model
+    WORKER_STATE["incremental_engine"] = incremental_engine
+
+
+def component_seed(c: ModelComponent) -> int:
+    """A seed derived from the name of the component, such that a swap graph recomputed by any worker is identical."""
+    return int(hashlib.sha1(str(c).encode()).hexdigest()[:8], 16)
+
+
+def run_component(
+    c: ModelComponent, queue: Optional[FileWorkQueue] = None, **kwargs
+) -> Optional[Dict]:
+    """Build the swap graph of the component. If a work queue is given, the component is only computed if its lease can be claimed, and its result is written to the queue. Return None if the component is done or leased by another worker."""
+    if queue is None:
+        return build_component_sgraph(c, **kwargs)
+    if not queue.try_claim(str(c)):
+        return None
+    with queue.heartbeat(str(c)):
+        component_data = build_component_sgraph(c, **kwargs)
+    queue.complete(str(c), component_data)
+    if kwargs.get("edge_log_dir") is not None:
+        remove_edge_logs(kwargs["edge_log_dir"], [str(c)])
+    return component_data
+
+
+def sgraph_worker(c: ModelComponent) -> Tuple[str, Optional[Dict]]:
+    component_data = run_component(c, **WORKER_STATE)
+    if component_data is not None:  # warm-start the layout of the next component
+        WORKER_STATE["initial_positions"] = component_data["node_positions"]
+    return str(c), component_data
+
+
+def run_components_in_pool(
+    components: List[ModelComponent],
+    nb_workers: int,
+    model_name: str,
+    device: str,
+    threads_per_worker: Optional[int],
+    incremental_patching: bool,
+    batch_size: Optional[int],
+    sgraph_kwargs: Dict[str, Any],
+    model_loader: Callable[[str, str], HookedTransformer] = load_pretrained_model,
+) -> Iterator[Tuple[str, Optional[Dict]]]:
+    """Build the swap graphs of the components in nb_workers spawned processes, each loading its own model with model_loader (a picklable function). Yield the name and the data of each component as it completes."""
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // nb_workers)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=nb_workers,
+        mp_context=multiprocessing.get_context("spawn"),  # CUDA can't be used in forked processes
+        initializer=init_sgraph_worker,
+        initargs=(
+            model_name,
+            device,
+            threads_per_worker,
+            incremental_patching,
+            batch_size,
+            sgraph_kwargs,
+            model_loader,
+        ),
+    ) as executor:
+        futures = [executor.submit(sgraph_worker, c) for c in components]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            yield future.result()
+
+
 def auto_sgraph(
     model_name: str,
     head_subpart: str = "z",
     include_mlp: bool = True,
     proportion_to_sgraph: float = 1.0,
-    batch_size: int = 200,
-    batch_size_sgraph: int = 200,
+    batch_size: Optional[int] = 200,
+    batch_size_sgraph: Optional[int] = 200,
     nb_sample_eval: int = 200,
     nb_datapoints_sgraph: int = 100,
     xp_path: str = "../xp",
     dataset_name: Literal["IOI", "nanoQA"] = "IOI",
     restart_xp_name: Optional[str] = None,
+    incremental_patching: bool = False,
+    device: str = "cuda",
+    nb_workers: int = 1,
+    threads_per_worker: Optional[int] = None,
+    work_queue: bool = False,
+    lease_seconds: float = 600.0,
+    convergence_patience: Optional[int] = None,
+    convergence_threshold: float = 0.95,
+    skip_equal_activations: Optional[float] = None,
+    community_backend: CommunityBackend = "louvain",
 ):
     """
     Run swap graph on components of a model.
@@ -125,7 +345,18 @@ def auto_sgraph(
     proportion_to_graph: proportion of the components the most important to compute sgraph on.
     nb_sample: number of patching experiments for the structural step to find the important components
     xp_path: path to the folder where the results will be saved
-    batch_size: batch size for building the swap graph
+    batch_size: batch size for finding the important components. Pass None to plan it from the free memory of the device
+    batch_size_sgraph: batch size for building the swap graphs. Pass None to plan it from the free memory of the device
+    incremental_patching: if True, the patched forward passes only recompute the END position, reusing the keys and values of the clean run
+    device: device on which the model is loaded
+    nb_workers: number of worker processes building the swap graphs. Each worker loads the model once and builds the swap graphs of its share of the important components
+    threads_per_worker: number of torch threads of each worker. If None, the cores are split evenly between the workers
+    work_queue: if True, the components are claimed through lease files in the queue folder of the experiment, such that several compute_sgraphs processes (e.g. on different nodes) started with the same restart_xp_name split the components. The results of each component are written in the queue folder and merged into all_data.pkl
+    lease_seconds: a component whose lease has not been renewed for this duration (e.g. its worker crashed) is claimed again
+    convergence_patience: if set, each swap graph is built by rounds and stops once its communities are stable: the ARI between the communities of consecutive rounds stays above convergence_threshold for convergence_patience rounds. The rounds are recorded in the "convergence" entry of each component
+    skip_equal_activations: if set, the patching experiments whose source and target activations are equal within this tolerance are resolved without a forward pass (0 for bit-identical activations). The number of skipped edges is recorded in the "nb_skipped_edges" entry of each component
+    community_backend: "louvain" or "leiden" on the CSR weight matrix, or "networkx" to validate them against the networkx implementation of Louvain
+    While a swap graph is built, its evaluated edges are saved in the edge_logs folder of the experiment, such that restarting the experiment (restart_xp_name) resumes an interrupted component where it stopped. The edge log of a component is removed once its result is saved
     """
     assert dataset_name in [
         "IOI",
@@ -187,6 +418,10 @@ def auto_sgraph(
     config["COMP_METRIC"] = COMP_METRIC
     config["PATCHED_POSITION"] = PATCHED_POSITION
     config["date"] = date
+    config["convergence_patience"] = convergence_patience
+    config["convergence_threshold"] = convergence_threshold
+    config["skip_equal_activations"] = skip_equal_activations
+    config["community_backend"] = community_backend
 
     loaded_comp_metric = False
     loaded_all_data = False
@@ -224,7 +459,7 @@ def auto_sgraph(
     ### Find important components by ressampling ablation
 
     print("loading model ...")
-    model = HookedTransformer.from_pretrained(model_name, device="cuda")
+    model = HookedTransformer.from_pretrained(model_name, device=device)
 
     if dataset_name == "IOI":
         assert check_tokenizer(
@@ -280,16 +515,27 @@ def auto_sgraph(
     else:
         raise ValueError("Unknown dataset_name")
 
+    eval_position = WildPosition(dataset.word_idx["END"], label="END")  # type: ignore
     if COMP_METRIC == "KL":
         comp_metric: CompMetric = partial(
             KL_div_sim,
-            position_to_evaluate=WildPosition(dataset.word_idx["END"], label="END"),  # type: ignore
+            position_to_evaluate=eval_position,  # type: ignore
         )
     elif COMP_METRIC == "LDiff":
         comp_metric: CompMetric = partial(logit_diff_comp, ioi_dataset=dataset, keep_sign=True)  # type: ignore
     else:
         raise ValueError("Unknown comp_metric")
 
+    incremental_engine = None
+    if incremental_patching:
+        incremental_engine = IncrementalPatchingEngine(
+            model=model,
+            dataset=dataset.prompts_tok,
+            position=eval_position,
+            batch_size=batch_size
+            or plan_batch_size(model, dataset.prompts_tok.shape[1], full_logits=False),
+        )
+
     components_to_search = get_components_at_position(
         position=WildPosition(
             dataset.word_idx[PATCHED_POSITION], label=PATCHED_POSITION
@@ -299,7 +545,13 @@ def auto_sgraph(
         include_mlp=include_mlp,
         head_subpart=head_subpart,
     )
-    if not loaded_comp_metric:
+    queue = None
+    if work_queue:
+        queue = FileWorkQueue(
+            queue_dir=os.path.join(xp_path, "queue"), lease_seconds=lease_seconds
+        )
+
+    def search_important_components():
         results = find_important_components(
             model=model,
             dataset=dataset.prompts_tok,
@@ -310,20 +562,28 @@ def auto_sgraph(
             verbose=False,
             output_shape=(model.cfg.n_layers, model.cfg.n_heads + 1),
             force_cache_all=False,  # if true, will cache all the results in memory, faster but more memory intensive
+            eval_position=eval_position,  # only keep the reference log-probs at the END position
+            incremental_engine=incremental_engine,
+            skip_equal_activations=skip_equal_activations,
         )
         if include_mlp:
             sec_dim = model.cfg.n_heads + 1
         else:
             sec_dim = model.cfg.n_heads
 
-        save_object(
-            torch.cat(results).reshape(model.cfg.n_layers, sec_dim, nb_sample_eval),
-            xp_path,
-            "comp_metric.pkl",
-        )
         comp_metric_res = torch.cat(results).reshape(
             model.cfg.n_layers, sec_dim, nb_sample_eval
         )
+        save_object(comp_metric_res, xp_path, "comp_metric.pkl")
+        return comp_metric_res
+
+    if not loaded_comp_metric:
+        if queue is None:
+            comp_metric_res = search_important_components()
+        else:  # the search is not seeded: a single worker runs it, such that all the workers select the same components
+            comp_metric_res = queue.run_once(
+                "find_important_components", search_important_components
+            )
 
         # %%
     assert (
@@ -376,51 +636,80 @@ def auto_sgraph(
     else:
         assert type(all_data) == dict, "all_data is not a dict"
 
-    for i in tqdm(range(len(important_components))):
-        print(len(all_data))  # TODO: remove
-        c = important_components[i]
-        sgraph = SwapGraph(
-            model=model,
-            tok_dataset=dataset.prompts_tok,
-            comp_metric=comp_metric,
-            batch_size=batch_size_sgraph,
-            proba_edge=1.0,
-            patchedComponents=[c],
-        )
-        sgraph.build(verbose=False, progress_bar=False)
-        sgraph.compute_weights()
-        sgraph.compute_communities()
-
-        component_data = {}
-        component_data["clustering_metrics"] = compute_clustering_metrics(sgraph)
-        component_data["feature_metrics"] = sgraph_dataset.compute_feature_rand(sgraph)
-        component_data["sgraph_edges"] = sgraph.raw_edges
-        component_data["commu"] = sgraph.commu_labels
-
-        # deepcopy the component data
-        all_data[str(c)] = deepcopy(component_data)
-
-        # create html plot for the graph
-        largest_rand_feature, max_rand_idx = max(
-            component_data["feature_metrics"]["rand"].items(), key=lambda x: x[1]
-        )
-        title = wrap_str(
-            f"<b>{sgraph.patchedComponents[0]}</b> Average CompMetric: {np.mean(sgraph.all_comp_metrics):.2f} (#{sorted_components.index(c)}), Rand idx commu-{largest_rand_feature}: {max_rand_idx:.2f}, modularity: {component_data['clustering_metrics']['modularity']:.2f}",
-            max_line_len=70,
-        )
-
-        sgraph.show_html(
-            sgraph_dataset,
-            feature_to_show="all",
-            title=title,
-            display=False,
-            save_path=fig_path,
-            color_discrete=True,
-        )
-        if i % 2 == 0:  # save every 2 iterations
-            save_object(all_data, xp_path, "all_data.pkl")
-    save_object(all_data, xp_path, "all_data.pkl")
-
+    edge_log_dir = os.path.join(
+        xp_path, "edge_logs"
+    )  # the edges of the swap graphs being built, to resume an interrupted component
+    os.makedirs(edge_log_dir, exist_ok=True)
+
+    def save_all_data():
+        save_object(all_data, xp_path, "all_data.pkl")
+        remove_edge_logs(edge_log_dir, all_data.keys())
+
+    sgraph_kwargs = dict(
+        queue=queue,
+        dataset=dataset,
+        sgraph_dataset=sgraph_dataset,
+        comp_metric=comp_metric,
+        batch_size_sgraph=batch_size_sgraph,
+        eval_position=eval_position,
+        sorted_components=sorted_components,
+        fig_path=fig_path,
+        convergence_patience=convergence_patience,
+        convergence_threshold=convergence_threshold,
+        skip_equal_activations=skip_equal_activations,
+        community_backend=community_backend,
+        edge_log_dir=edge_log_dir,
+    )
+    if nb_workers == 1:
+        initial_positions = None
+        for i in tqdm(range(len(important_components))):
+            c = important_components[i]
+            component_data = run_component(
+                c,
+                model=model,
+                incremental_engine=incremental_engine,
+                initial_positions=initial_positions,
+                **sgraph_kwargs,
+            )
+            if component_data is None:  # computed by another worker
+                continue
+            all_data[str(c)] = component_data
+            initial_positions = component_data["node_positions"]
+            if i % 2 == 0 and queue is None:  # save every 2 iterations
+                save_all_data()
+    else:
+        del model, incremental_engine  # each worker loads its own model
+        torch.cuda.empty_cache()
+        for i, (c_name, component_data) in enumerate(
+            run_components_in_pool(
+                important_components,
+                nb_workers,
+                model_name,
+                device,
+                threads_per_worker,
+                incremental_patching,
+                batch_size,
+                sgraph_kwargs,
+            )
+        ):
+            if component_data is None:  # computed by another worker
+                continue
+            all_data[c_name] = component_data
+            if i % 2 == 0 and queue is None:  # save every 2 components
+                save_all_data()
+
+    if queue is not None:  # merge the results of all the workers
+        all_data.update(queue.results([str(c) for c in important_components]))
+        nb_remaining = len([c for c in important_components if str(c) not in all_data])
+        print(f"{nb_remaining} components are still computed by other workers")
+        save_object(all_data, xp_path, f"all_data.pkl.tmp-{queue.worker_id}")
+        os.replace(
+            os.path.join(xp_path, f"all_data.pkl.tmp-{queue.worker_id}"),
+            os.path.join(xp_path, "all_data.pkl"),
+        )  # several workers can write all_data.pkl
+        remove_edge_logs(edge_log_dir, all_data.keys())
+    else:
+        save_all_data()
 
 if __name__ == "__main__":
     fire.Fire(auto_sgraph)
@@ -81,6 +81,7 @@ from swap_graphs.utils import (
     load_config,
 )
 from swap_graphs.core import SgraphDataset, SwapGraph, break_long_str
+from swap_graphs.layout import force_directed_layout
 
 from tqdm import tqdm
 
@@ -499,9 +500,12 @@ def plot_data(
 
     recompute_position = True
     if recompute_position:
-        node_positions = nx.spring_layout(  # type: ignore
-            G, k=0.5, iterations=200
+        positions = force_directed_layout(
+            nx.to_scipy_sparse_array(G, weight="weight", format="csr"),
+            k=0.5,
+            iterations=200,
         )  # computed on the complete graph G
+        node_positions = dict(zip(G.nodes, positions))
 
     nx.set_node_attributes(G_plot, node_positions, "pos")  # type: ignore
 
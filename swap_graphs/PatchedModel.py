@@ -59,6 +59,8 @@ from swap_graphs.core import (
     ActivationStore,
     find_important_components,
     compute_clustering_metrics,
+    plan_batch_size,
+    run_batches_with_backoff,
     NOT_A_HEAD,
 )
 
@@ -174,6 +176,15 @@ class PatchedModel:
     communities: Dict[ModelComponent, Dict[int, int]] = field(kw_only=True)
     activation_store: ActivationStore = field(init=False)
     force_cache_all = field(default=False, kw_only=True)
+    slice_positions = field(
+        default=False, kw_only=True
+    )  # only cache the activations at the position of each component
+    cache_batch_size: Optional[int] = field(
+        default=None, kw_only=True
+    )  # batch size used to compute the cache of the dataset. None: single forward pass
+    cache_dir: Optional[str] = field(
+        default=None, kw_only=True
+    )  # if set, the activation cache is stored in memory-mapped files in this directory
 
     def __attrs_post_init__(self):
         self.activation_store = ActivationStore(
@@ -181,41 +192,37 @@ class PatchedModel:
             model=self.model,
             dataset=self.sgraph_dataset.tok_dataset,
             force_cache_all=self.force_cache_all,
+            slice_positions=self.slice_positions,
+            batch_size=self.cache_batch_size,
+            cache_dir=self.cache_dir,
         )  # the activation store is initialized with an empty list of components, we'll define the components each time we ask for patching hooks
 
     def batched_patch(
         self,
         x: torch.Tensor,
         hook_gen: Callable[[List[int]], List[Tuple[str, Callable]]],
-        batch_size: int = 20,
+        batch_size: Optional[int] = 20,
         reset_hooks: bool = True,
     ) -> torch.Tensor:
-        """Patch the model with the hooks returned by hook_gen and run the model on x in batches of size batch_size. Returns the logits of the patched model."""
+        """Patch the model with the hooks returned by hook_gen and run the model on x in batches of size batch_size. Returns the logits of the patched model. If batch_size is None, it is planned from the free memory of the device. A batch running out of memory is retried with half the batch size."""
         assert len(x.shape) == 2, "x should be a 2D tensor"
 
         if reset_hooks:
             self.model.reset_hooks()
 
-        all_logits = []
-        for i in range(0, len(x), batch_size):
-            target_idx = list(
-                range(i, min(i + batch_size, len(x)))
-            )  # The index of the batch inputs
-            target_x = x[i : min(i + batch_size, len(x))]
+        if batch_size is None:
+            batch_size = plan_batch_size(self.model, x.shape[1])
 
+        def run_batch(start: int, end: int) -> torch.Tensor:
+            target_idx = list(range(start, end))  # The index of the batch inputs
             hooks = hook_gen(target_idx)
-
-            gc.collect()
-            torch.cuda.empty_cache()
-
-            patched_logits = self.model.run_with_hooks(
-                target_x,
+            return self.model.run_with_hooks(
+                x[start:end],
                 return_type="logits",
                 fwd_hooks=hooks,
             )
-            all_logits.append(patched_logits)
 
-        return torch.cat(all_logits)
+        return torch.cat(run_batches_with_backoff(len(x), batch_size, run_batch))
 
     def hook_gen_scrub_by_communities(
         self,
@@ -227,18 +234,17 @@ class PatchedModel:
 
         self.activation_store.change_component_list(list_of_components)
         def hook_gen(target_idx: List[int]):
-            all_hooks = []
+            all_source_idx = []
             for component in list_of_components:
                 source_idx = randomize_inside_class(
                     target_idx, self.communities[component]
                 )  # the source index is the list of all the index of the dataset, but randomized within the community of the component
-                hook_list = self.activation_store.getPatchingHooksByIdx(
-                    source_idx=source_idx,
-                    target_idx=target_idx,
-                    list_of_components=[component],
-                )  # we add the hook to the activation store
-                all_hooks.append((hook_list[0][0], hook_list[0][1]))
-            return all_hooks
+                all_source_idx.append(source_idx)
+            return self.activation_store.getFusedPatchingHooksByIdx(
+                source_idx=all_source_idx,
+                target_idx=target_idx,
+                list_of_components=list_of_components,
+            )  # a single hook per hook point, patching all the components at this hook point
 
         return hook_gen
 
@@ -282,7 +288,7 @@ class PatchedModel:
         print("components:", list(self.activation_store.transformerLensCache.keys()))
 
         def hook_gen(target_idx: List[int]):
-            all_hooks = []
+            all_source_idx = []
             for component in list_of_components:
                 if feature_to_match is None:
                     source_idx = randomize_accross_classes(
@@ -296,15 +302,12 @@ class PatchedModel:
                         self.sgraph_dataset.feature_values[feature],
                         self.sgraph_dataset.feature_values[feature_to_match],
                     )
-                hook_list = self.activation_store.getPatchingHooksByIdx(
-                    source_idx=source_idx,
-                    target_idx=target_idx,
-                    list_of_components=[component],
-                )  # we add the hook to the activation store
-                all_hooks.append(
-                    (hook_list[0][0], hook_list[0][1])
-                )  # we add the hook to the list of hooks
-            return all_hooks
+                all_source_idx.append(source_idx)
+            return self.activation_store.getFusedPatchingHooksByIdx(
+                source_idx=all_source_idx,
+                target_idx=target_idx,
+                list_of_components=list_of_components,
+            )  # a single hook per hook point, patching all the components at this hook point
 
         return hook_gen
 
@@ -5,3 +5,4 @@ from swap_graphs.datasets.ioi import *  # type: ignore
 from swap_graphs.core import *  # type: ignore
 from swap_graphs.PatchedModel import *  # type: ignore
 from swap_graphs.datasets.nano_qa import *  # type: ignore
+from swap_graphs.work_queue import *  # type: ignore
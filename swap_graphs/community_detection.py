@@ -0,0 +1,247 @@
+from typing import Literal, Optional, Tuple
+
+import numpy as np
+import scipy.sparse
+from jaxtyping import Int
+
+CommunityBackend = Literal["louvain", "leiden", "networkx"]
+
+
+def directed_modularity(
+    weights: scipy.sparse.csr_matrix,
+    labels: Int[np.ndarray, "node"],
+    resolution: float = 1.0,
+) -> float:
+    """The modularity of the partition labels of the directed graph of adjacency matrix weights (weights[u, v] is the weight of u -> v), as in networkx."""
+    # sum over the communities c of w_c / m - resolution * out_c * in_c / m^2 (w_c: weight inside c, out_c and in_c: degrees of c, m: total weight)
+    weights = weights.tocoo()
+    m = weights.data.sum()
+    if m == 0:
+        return 0.0
+    nb_communities = labels.max() + 1
+    same_community = labels[weights.row] == labels[weights.col]
+    inside = weights.data[same_community].sum()
+    out_degrees = np.bincount(
+        labels[weights.row], weights=weights.data, minlength=nb_communities
+    )
+    in_degrees = np.bincount(
+        labels[weights.col], weights=weights.data, minlength=nb_communities
+    )
+    return float(inside / m - resolution * (out_degrees * in_degrees).sum() / m**2)
+
+
+def relabel(labels: Int[np.ndarray, "node"]) -> Int[np.ndarray, "node"]:
+    """Map the labels to 0, ..., nb_communities - 1, in the order of their first occurrence."""
+    _, first_idx, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first_idx))
+    return order[inverse]
+
+
+def aggregate(
+    weights: scipy.sparse.csr_matrix, labels: Int[np.ndarray, "node"]
+) -> scipy.sparse.csr_matrix:
+    """The graph whose nodes are the communities of labels: the weight of the edge c -> d is the sum of the weights of the edges from c to d (self-loops for c = d)."""
+    nb_nodes = weights.shape[0]
+    membership = scipy.sparse.csr_matrix(
+        (np.ones(nb_nodes), (np.arange(nb_nodes), labels)),
+        shape=(nb_nodes, labels.max() + 1),
+    )
+    return (membership.T @ weights @ membership).tocsr()
+
+
+def neighbor_weights(weights: scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+    """The symmetric matrix of the weights between distinct nodes (in both directions)."""
+    symmetric = (weights + weights.T).tocsr()
+    symmetric.setdiag(0)
+    symmetric.eliminate_zeros()
+    return symmetric
+
+
+def local_moving(
+    weights: scipy.sparse.csr_matrix,
+    labels: Int[np.ndarray, "node"],
+    resolution: float,
+    rng: np.random.Generator,
+) -> Tuple[Int[np.ndarray, "node"], bool]:
+    """Move the nodes, in random order, to the neighboring community that increases the most the modularity until no move increases it. Return the labels and whether a node moved."""
+    labels = labels.copy()
+    m = weights.data.sum()
+    out_degrees = np.asarray(weights.sum(axis=1)).flatten()
+    in_degrees = np.asarray(weights.sum(axis=0)).flatten()
+    nbrs = neighbor_weights(weights)
+
+    nb_labels = len(labels)
+    total_out = np.bincount(labels, weights=out_degrees, minlength=nb_labels)
+    total_in = np.bincount(labels, weights=in_degrees, minlength=nb_labels)
+
+    moved = False
+    improved = True
+    while improved:
+        improved = False
+        for node in rng.permutation(len(labels)):
+            community = labels[node]
+            start, end = nbrs.indptr[node], nbrs.indptr[node + 1]
+            neighbors = nbrs.indices[start:end]
+            candidates, inverse = np.unique(labels[neighbors], return_inverse=True)
+            w_to_candidates = np.bincount(inverse, weights=nbrs.data[start:end])
+
+            # the gains of all the neighboring communities at once
+            total_out[community] -= out_degrees[node]
+            total_in[community] -= in_degrees[node]
+            w_to_own = w_to_candidates[candidates == community].sum()
+            remove_cost = -w_to_own / m + resolution * (
+                out_degrees[node] * total_in[community]
+                + in_degrees[node] * total_out[community]
+            ) / m**2
+            gains = (
+                remove_cost
+                + w_to_candidates / m
+                - resolution
+                * (
+                    out_degrees[node] * total_in[candidates]
+                    + in_degrees[node] * total_out[candidates]
+                )
+                / m**2
+            )
+            best_community = community
+            if len(gains) > 0 and gains.max() > 0:
+                best_community = candidates[gains.argmax()]
+            total_out[best_community] += out_degrees[node]
+            total_in[best_community] += in_degrees[node]
+            if best_community != community:
+                labels[node] = best_community
+                improved = True
+                moved = True
+    return labels, moved
+
+
+def refine_partition(
+    weights: scipy.sparse.csr_matrix,
+    labels: Int[np.ndarray, "node"],
+    resolution: float,
+    rng: np.random.Generator,
+    theta: float = 0.01,
+) -> Int[np.ndarray, "node"]:
+    """The refinement step of Leiden (Traag et al., 2019): split each community of labels into well-connected sub-communities. Return the labels of the sub-communities."""
+    m = weights.data.sum()
+    out_degrees = np.asarray(weights.sum(axis=1)).flatten()
+    in_degrees = np.asarray(weights.sum(axis=0)).flatten()
+    nbrs = neighbor_weights(weights).tocoo()
+    nb_nodes = len(labels)
+    community_out = np.bincount(labels, weights=out_degrees, minlength=nb_nodes)
+    community_in = np.bincount(labels, weights=in_degrees, minlength=nb_nodes)
+
+    def well_connected(w_to_rest, out_c, in_c, community):
+        # the weight between c and the rest of its community is at least the one expected in the null model of the modularity
+        expected = (
+            resolution
+            * (
+                out_c * (community_in[community] - in_c)
+                + in_c * (community_out[community] - out_c)
+            )
+            / m
+        )
+        return w_to_rest >= expected
+
+    inside = labels[nbrs.row] == labels[nbrs.col]
+    w_to_community = np.bincount(
+        nbrs.row[inside], weights=nbrs.data[inside], minlength=nb_nodes
+    )  # the weight between each node and the rest of its community, in both directions
+    nbrs = nbrs.tocsr()
+
+    refined = np.arange(nb_nodes)  # start from singletons
+    sizes = np.ones(nb_nodes, dtype=np.int64)
+    sub_out, sub_in = out_degrees.copy(), in_degrees.copy()
+    sub_w_to_community = w_to_community.copy()
+    for node in rng.permutation(nb_nodes):
+        community = labels[node]
+        if sizes[refined[node]] > 1 or not well_connected(
+            w_to_community[node], out_degrees[node], in_degrees[node], community
+        ):
+            continue
+        start, end = nbrs.indptr[node], nbrs.indptr[node + 1]
+        same = labels[nbrs.indices[start:end]] == community
+        candidates, inverse = np.unique(
+            refined[nbrs.indices[start:end][same]], return_inverse=True
+        )
+        w_to_candidates = np.bincount(inverse, weights=nbrs.data[start:end][same])
+        gains = (
+            w_to_candidates
+            - resolution
+            * (out_degrees[node] * sub_in[candidates] + in_degrees[node] * sub_out[candidates])
+            / m
+        )  # in units of edge weight. The node is a singleton: leaving its community costs nothing
+        allowed = (gains >= 0) & well_connected(
+            sub_w_to_community[candidates],
+            sub_out[candidates],
+            sub_in[candidates],
+            community,
+        )
+        if not allowed.any():
+            continue
+        options = np.append(candidates[allowed], refined[node])  # or stay alone
+        option_gains = np.append(gains[allowed], 0.0)
+        probas = np.exp((option_gains - option_gains.max()) / theta)
+        chosen = rng.choice(options, p=probas / probas.sum())
+        if chosen == refined[node]:
+            continue
+        sizes[refined[node]] -= 1
+        refined[node] = chosen
+        sizes[chosen] += 1
+        sub_out[chosen] += out_degrees[node]
+        sub_in[chosen] += in_degrees[node]
+        sub_w_to_community[chosen] += (
+            w_to_community[node] - 2 * w_to_candidates[candidates == chosen].sum()
+        )  # the edges between the node and chosen are now inside
+    return refined
+
+
+def detect_communities(
+    weights: scipy.sparse.csr_matrix,
+    resolution: float = 1.0,
+    method: Literal["louvain", "leiden"] = "louvain",
+    seed: Optional[int] = None,
+    threshold: float = 1e-7,  # the levels stop when the modularity increases by less than threshold
+    theta: float = 0.01,  # the randomness of the merges of the refinement of Leiden
+) -> Int[np.ndarray, "node"]:
+    """Find the communities of the directed graph of adjacency matrix weights by maximizing its modularity with the Louvain or the Leiden algorithm. Return the community label of each node."""
+    # each level moves the nodes (local_moving) and aggregates each community into a node. Leiden aggregates the refined sub-communities instead (refine_partition), such that the communities stay well connected
+    rng = np.random.default_rng(seed)
+    weights = scipy.sparse.csr_matrix(weights, dtype=np.float64)
+    nb_nodes = weights.shape[0]
+    if weights.nnz == 0:
+        return np.arange(nb_nodes)
+
+    node_labels = np.arange(
+        nb_nodes
+    )  # the node of the aggregated graph containing each node of the original graph
+    graph = weights
+    graph_labels = np.arange(
+        nb_nodes
+    )  # the community of each node of the aggregated graph
+    modularity = directed_modularity(weights, node_labels, resolution)
+    while True:
+        graph_labels, moved = local_moving(graph, graph_labels, resolution, rng)
+        graph_labels = relabel(graph_labels)
+        if not moved:
+            break
+        new_node_labels = graph_labels[node_labels]
+        new_modularity = directed_modularity(weights, new_node_labels, resolution)
+        if new_modularity - modularity <= threshold:
+            break
+        modularity = new_modularity
+
+        if method == "leiden":
+            refined_labels = relabel(
+                refine_partition(graph, graph_labels, resolution, rng, theta)
+            )
+            node_labels = refined_labels[node_labels]
+            graph = aggregate(graph, refined_labels)
+            parent_labels = np.zeros(graph.shape[0], dtype=np.int64)
+            parent_labels[refined_labels] = graph_labels  # each sub-community starts in the community it was refined from
+            graph_labels = parent_labels
+        else:
+            node_labels = new_node_labels
+            graph = aggregate(graph, graph_labels)
+            graph_labels = np.arange(graph.shape[0])
+    return relabel(graph_labels[node_labels])
@@ -1,15 +1,18 @@
 # %%
+import collections
+import concurrent.futures
 import copy
 import dataclasses
 
 # %%
 import gc
+import hashlib
 import itertools
 import random
 import random as rd
 from functools import partial
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union, Set
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union, Set
 
 
 import datasets
@@ -19,6 +22,7 @@ import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 import plotly.express as px
+import scipy.sparse
 import plotly.graph_objects as go
 import torch
 import torch.nn as nn
@@ -28,7 +32,7 @@ import tqdm.auto as tqdm
 import transformer_lens
 import transformer_lens.utils as utils
 from attrs import define, field
-from jaxtyping import Float, Int
+from jaxtyping import Bool, Float, Int
 from sklearn.metrics.cluster import (
     adjusted_rand_score,
     completeness_score,
@@ -47,11 +51,27 @@ from transformer_lens.hook_points import (  # Hooking utilities
     HookedRootModule,
     HookPoint,
 )
+from transformer_lens.past_key_value_caching import HookedTransformerKeyValueCacheEntry
+from swap_graphs.community_detection import (
+    CommunityBackend,
+    detect_communities,
+    directed_modularity,
+)
+from swap_graphs.layout import force_directed_layout
 
 from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
 
 from typing import Protocol, Literal
 import os
+import warnings
+
+NO_PSUTIL = False
+try:
+    import psutil  # to read the available RAM on every platform, os.sysconf is Linux-only
+except ImportError:
+    NO_PSUTIL = True
+
+FALLBACK_MEMORY_BYTES = 2 * 1024**3  # the available RAM assumed when it can't be read
 
 
 def dict_val_to_str(
@@ -166,12 +186,42 @@ class WildPosition:
             ), f"Index out of range! {max(idx)} > {len(self.position)}"
             return [int(self.position[idx[i]]) for i in range(len(idx))]
 
+    def positions_tensor_from_idx(
+        self, idx: List[int], device: Optional[Union[str, torch.device]] = None
+    ) -> Int[torch.Tensor, "batch"]:
+        """Same as positions_from_idx, but returns a long tensor on `device` that can be used directly for advanced indexing."""
+        if isinstance(self.position, int):
+            return torch.full((len(idx),), self.position, dtype=torch.long, device=device)
+        return torch.tensor(
+            self.positions_from_idx(idx), dtype=torch.long, device=device
+        )
+
+    def fingerprint(self) -> str:
+        """A short hash of the position values, to tell apart positions sharing the same label."""
+        return hashlib.sha1(str(self.position).encode()).hexdigest()[:8]
+
     def __attrs_post_init__(self):
         if isinstance(self.position, torch.Tensor):
             assert self.position.dim() == 1
             self.position = [int(x) for x in self.position.tolist()]
 
 
+def logits_at_positions(
+    logits: Union[Float[torch.Tensor, "batch seq vocab"], Float[torch.Tensor, "batch vocab"]],
+    position: WildPosition,
+    target_idx: Optional[List[int]] = None,
+) -> Float[torch.Tensor, "batch vocab"]:
+    """Return the logits at the evaluation position of each row. Logits already restricted to the evaluation positions (e.g. the reference log-probs of an ActivationStore with an eval_position) are returned as is."""
+    if logits.dim() == 2:
+        return logits
+    if target_idx is None:
+        target_idx = list(range(logits.shape[0]))
+    return logits[
+        torch.arange(logits.shape[0], device=logits.device),
+        position.positions_tensor_from_idx(target_idx, device=logits.device),
+    ]
+
+
 @define
 class ModelComponent:
     """Stores a model component (head, layer, etc.) and its position in the model.
@@ -238,7 +288,7 @@ class ModelComponent:
 # %%
 
 
-def component_patching_hook( # TODO add test for this function
+def component_patching_hook(
     z: Float[torch.Tensor, ""],
     hook: HookPoint,
     cache: Float[torch.Tensor, ""],
@@ -247,31 +297,100 @@ def component_patching_hook( # TODO add test for this function
     target_idx: List[int],
     source_position: Optional[WildPosition] = None,
     verbose: bool = False,
+    target_positions: Optional[Int[torch.Tensor, "batch"]] = None,
+    source_positions: Optional[Int[torch.Tensor, "batch"]] = None,
 ) -> Float[torch.Tensor, ""]:
-    """Patches the activations of a component with the cache."""
+    """Patches the activations of a component with the cache. All the rows of the batch are patched with a single indexed assignment.
+    target_positions and source_positions can be precomputed once per batch (see getPatchingHooksByIdx), otherwise they are computed from the component position."""
     if verbose:
         print_gpu_mem(f"patching {component.name} {component.layer} {component.head}")
         print(z.shape)
         print(cache.shape)
-        
+
     if source_position is None:
         source_position = component.position
 
+    if target_positions is None:
+        target_positions = component.position.positions_tensor_from_idx(
+            target_idx, device=z.device
+        )
+    if source_positions is None:
+        source_positions = source_position.positions_tensor_from_idx(
+            source_idx, device=cache.device
+        )
+
+    rows = torch.arange(len(source_idx), device=z.device)
+    cache_rows = rows.to(cache.device)
+
     if component.is_head():
         head = component.head
-        for i in range(len(source_idx)):  # TODO : vectorize
-            z[i, component.position.positions_from_idx(target_idx)[i], head, :] = cache[
-                i, source_position.positions_from_idx(source_idx)[i], head, :
-            ]
+        z[rows, target_positions.to(z.device), head, :] = cache[
+            cache_rows, source_positions.to(cache.device), head, :
+        ].to(z.device)
     else:
-        
-        for i in range(len(source_idx)):
-            z[i, component.position.positions_from_idx(target_idx)[i], :] = cache[
-                i, source_position.positions_from_idx(source_idx)[i], :
-            ]
+        z[rows, target_positions.to(z.device), :] = cache[
+            cache_rows, source_positions.to(cache.device), :
+        ].to(z.device)
+    return z
+
+
+def fused_patching_hook(
+    z: Float[torch.Tensor, ""],
+    hook: HookPoint,
+    patch_values: Float[torch.Tensor, "component batch ..."],
+    rows: Int[torch.Tensor, "component batch"],
+    target_positions: Int[torch.Tensor, "component batch"],
+    heads: Optional[Int[torch.Tensor, "component batch"]] = None,
+) -> Float[torch.Tensor, ""]:
+    """Patches all the components sharing a hook point in a single indexed write. patch_values are gathered from the cache beforehand (see getFusedPatchingHooksByIdx), each component having its own source indices."""
+    if heads is None:
+        z[rows, target_positions] = patch_values.to(z.device)
+    else:
+        z[rows, target_positions, heads] = patch_values.to(z.device)
     return z
 
 
+def create_memmap_tensor(
+    path: str, shape: Tuple[int, ...], dtype: torch.dtype
+) -> torch.Tensor:
+    """Create a memory-mapped .npy file at path and return a CPU tensor sharing its memory. bfloat16 has no numpy equivalent and is stored as float32."""
+    if dtype == torch.bfloat16:
+        dtype = torch.float32
+    np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+    return torch.from_numpy(
+        np.lib.format.open_memmap(path, mode="w+", dtype=np_dtype, shape=shape)
+    )
+
+
+def load_memmap_tensor(path: str) -> torch.Tensor:
+    """Open a .npy file in read-only memory-mapped mode. The rows are only read from disk when they are indexed."""
+    with warnings.catch_warnings():  # torch warns that the read-only array is not writable
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.from_numpy(np.load(path, mmap_mode="r"))
+
+
+def write_to_buffer(
+    buffers: Dict[str, torch.Tensor],
+    key: str,
+    tensor: torch.Tensor,
+    start: int,
+    total_size: int,
+    disk_path: Optional[str] = None,
+):
+    """Write tensor in buffers[key] at the rows [start, start + len(tensor)]. The buffer of size total_size is allocated at the first write, as a memory-mapped file if disk_path is given. When the tensor already covers all the rows and is kept in memory, it is stored without copy."""
+    if key not in buffers:
+        shape = (total_size,) + tuple(tensor.shape[1:])
+        if disk_path is not None:
+            buffers[key] = create_memmap_tensor(disk_path, shape, tensor.dtype)
+        elif start == 0 and tensor.shape[0] == total_size:
+            buffers[key] = tensor
+            return
+        else:
+            buffers[key] = torch.empty(shape, dtype=tensor.dtype, device=tensor.device)
+    buffer = buffers[key]
+    buffer[start : start + tensor.shape[0]] = tensor.to(buffer.device, buffer.dtype)
+
+
 @define
 class ActivationStore:
     """Stores the activations of a model for a given dataset (the patched dataset), and create hooks to patch the activations of a given component (head, layer, etc)."""
@@ -280,34 +399,307 @@ class ActivationStore:
     dataset: Float[torch.Tensor, "batch pos"] = field(kw_only=True)
     listOfComponents: Optional[List[ModelComponent]] = field(kw_only=True, default=None)
     force_cache_all: bool = field(kw_only=True, default=False)
-    dataset_logits: Float[torch.Tensor, "batch pos vocab"] = field(init=False)
-    transformerLensCache: Union[Dict[str, torch.Tensor], ActivationCache] = field(
+    slice_positions: bool = field(
+        kw_only=True, default=False
+    )  # if True, only store the activations at the position of each component: [batch, head, d_head] instead of [batch, seq, head, d_head]
+    batch_size: Optional[int] = field(
+        kw_only=True, default=None
+    )  # if set, the cache is computed by chunks of batch_size. If None, the whole dataset is run in a single forward pass.
+    cache_dir: Optional[str] = field(
+        kw_only=True, default=None
+    )  # if set, the activations are stored in memory-mapped files in this directory (one per hook name) and reused across processes
+    cache_version: Optional[str] = field(
+        kw_only=True, default=None
+    )  # identifies the weights of the model in the disk cache key (e.g. a checkpoint name). If None, the parameters of the model are hashed
+    cache_budget_bytes: Optional[int] = field(
+        kw_only=True, default=None
+    )  # if set, hooks cached for previous component lists are kept up to this number of bytes (LRU eviction). If None, only the hooks of the current list are kept.
+    cache_resid_pre: bool = field(
+        kw_only=True, default=False
+    )  # if True, the clean resid_pre of every layer is also cached, such that patched runs can start at the first patched layer
+    eval_position: Optional[WildPosition] = field(
+        kw_only=True, default=None
+    )  # if set, dataset_logits only stores the reference log-probs at the evaluation positions: [batch, vocab] instead of [batch, pos, vocab]
+    dataset_logits: Union[
+        Float[torch.Tensor, "batch pos vocab"], Float[torch.Tensor, "batch vocab"]
+    ] = field(init=False)
+    transformerLensCache: "collections.OrderedDict[str, torch.Tensor]" = field(
         init=False
-    )
+    )  # ordered from the least to the most recently used hook
+    activation_groups_cache: Dict[Tuple[str, float], torch.Tensor] = field(
+        init=False, factory=dict
+    )  # the activation group of each row, by component and tolerance (see activation_groups)
+    nb_skipped_forwards: int = field(
+        init=False, default=0
+    )  # the number of patched forward passes skipped because the source and target activations were equal
+    _disk_cache_path: Optional[str] = field(
+        init=False, default=None
+    )  # computed once by disk_cache_path, the parameters of the model can be long to hash
 
-    def compute_cache(self):
-        if self.listOfComponents is None or self.force_cache_all:
-            dataset_logits, cache = self.model.run_with_cache(
-                self.dataset
+    def cache_key(self, component: ModelComponent) -> str:
+        """The key of the cache storing the activations of the component. When the positions are sliced, components sharing a hook point but at different positions (labels or values) are stored separately."""
+        if self.slice_positions:
+            return f"{component.hook_name}@{component.position.label}-{component.position.fingerprint()}"
+        return component.hook_name
+
+    def compute_chunk_cache(
+        self,
+        chunk: Float[torch.Tensor, "batch pos"],
+        start: int,
+        components: Optional[List[ModelComponent]],
+        with_logits: bool = True,
+    ) -> Dict[str, torch.Tensor]:
+        """Run the model on a chunk of the dataset starting at index start. Return the activations of the components (of all hooks if components is None) and the logits under the key logits_key() if with_logits."""
+        cache = {}
+        chunk_idx = list(range(start, start + chunk.shape[0]))
+
+        resid_pre: Dict[int, torch.Tensor] = {}
+        resid_hooks = []
+        if with_logits and self.cache_resid_pre:
+
+            def save_resid_hook(tensor, hook, layer: int):
+                resid_pre[layer] = tensor.detach()
+
+            resid_hooks = [
+                (self.resid_pre_key(l), partial(save_resid_hook, layer=l))
+                for l in range(self.model.cfg.n_layers)
+            ]
+        if components is None:
+            logits, activation_cache = self.model.run_with_cache(
+                chunk
             )  # default, but memory inneficient
+            cache = dict(activation_cache.items())
+        elif self.slice_positions:
+
+            def save_sliced_hook(tensor, hook, component: ModelComponent):
+                positions = component.position.positions_tensor_from_idx(
+                    chunk_idx, device=tensor.device
+                )
+                cache[self.cache_key(component)] = tensor[
+                    torch.arange(tensor.shape[0], device=tensor.device), positions
+                ].detach()
+
+            logits = self.model.run_with_hooks(
+                chunk,
+                return_type="logits" if with_logits else None,
+                fwd_hooks=[
+                    (c.hook_name, partial(save_sliced_hook, component=c))
+                    for c in components
+                ]
+                + resid_hooks,
+            )
         else:
-            cache = {}
 
             def save_hook(tensor, hook):
-                cache[hook.name] = tensor.detach().to("cuda")
+                cache[hook.name] = tensor.detach()
+
+            logits = self.model.run_with_hooks(  # only cache the components we need
+                chunk,
+                return_type="logits" if with_logits else None,
+                fwd_hooks=[(c.hook_name, save_hook) for c in components]
+                + resid_hooks,
+            )
+        if with_logits and self.cache_resid_pre and components is not None:
+            for l in range(self.model.cfg.n_layers):
+                cache[self.resid_pre_key(l)] = resid_pre[l]
+        if with_logits:
+            if self.eval_position is not None:
+                logits = torch.nn.functional.log_softmax(
+                    logits_at_positions(logits, self.eval_position, chunk_idx), dim=-1
+                )
+            cache[self.logits_key()] = logits
+        return cache
+
+    def resid_pre_key(self, layer: int) -> str:
+        """The key of the clean resid_pre of a layer (only cached if cache_resid_pre)."""
+        return utils.get_act_name("resid_pre", layer)
+
+    def resid_pre_keys(self) -> List[str]:
+        if not self.cache_resid_pre:
+            return []
+        return [self.resid_pre_key(l) for l in range(self.model.cfg.n_layers)]
+
+    def logits_key(self) -> str:
+        """The key of the reference logits in the buffers (and the name of their file in the disk cache)."""
+        if self.eval_position is not None:
+            return f"log_probs@{self.eval_position.label}-{self.eval_position.fingerprint()}"
+        return "logits"
+
+    def disk_cache_path(self) -> str:
+        """The directory of the memory-mapped cache files of this model and dataset."""
+        assert self.cache_dir is not None
+        if self._disk_cache_path is None:
+            # the config (dtype and device included), the weights and the dataset. The position values are in the file names (cache_key)
+            fingerprint = hashlib.sha1()
+            fingerprint.update(repr(self.model.cfg).encode())
+            if self.cache_version is not None:  # a tag of the weights, instead of hashing them
+                fingerprint.update(self.cache_version.encode())
+            else:
+                for name, param in self.model.state_dict().items():
+                    fingerprint.update(name.encode())
+                    fingerprint.update(
+                        param.detach()
+                        .cpu()
+                        .contiguous()
+                        .flatten()
+                        .view(torch.uint8)
+                        .numpy()
+                        .tobytes()
+                    )
+            fingerprint.update(str(tuple(self.dataset.shape)).encode())
+            fingerprint.update(self.dataset.cpu().numpy().tobytes())
+            self._disk_cache_path = os.path.join(
+                self.cache_dir, fingerprint.hexdigest()[:16]
+            )
+        return self._disk_cache_path
 
-            dataset_logits = (
-                self.model.run_with_hooks(  # only cache the components we need
-                    self.dataset,
-                    fwd_hooks=[(c.hook_name, save_hook) for c in self.listOfComponents],
+    def disk_cache_file(self, key: str) -> str:
+        return os.path.join(self.disk_cache_path(), key.replace("/", "_") + ".npy")
+
+    def load_disk_cache(self, keys: List[str]) -> Dict[str, torch.Tensor]:
+        """Load the keys that have already been written to disk. Missing keys are ignored."""
+        if self.cache_dir is None:
+            return {}
+        return {
+            k: load_memmap_tensor(self.disk_cache_file(k))
+            for k in keys
+            if os.path.exists(self.disk_cache_file(k))
+        }
+
+    def compute_buffers(
+        self, components: Optional[List[ModelComponent]], with_logits: bool
+    ) -> Dict[str, torch.Tensor]:
+        """Compute the activations of the components on the whole dataset. If batch_size is set, the dataset is streamed through the model in chunks of batch_size and each chunk is written into preallocated buffers, such that the peak memory of the forward pass is bounded by one batch.
+        If cache_dir is set, the buffers are memory-mapped files. They are written under temporary names and renamed once complete, such that concurrent processes sharing the directory never read a partial file."""
+        if self.cache_dir is not None:
+            os.makedirs(self.disk_cache_path(), exist_ok=True)
+
+        nb_samples = self.dataset.shape[0]
+        batch_size = nb_samples if self.batch_size is None else self.batch_size
+
+        buffers: Dict[str, torch.Tensor] = {}
+        tmp_files: Dict[str, str] = {}
+        for start in range(0, nb_samples, batch_size):
+            cache = self.compute_chunk_cache(
+                self.dataset[start : start + batch_size],
+                start,
+                components,
+                with_logits=with_logits,
+            )
+            for key, activations in cache.items():
+                if self.cache_dir is not None and key not in tmp_files:
+                    tmp_files[key] = f"{self.disk_cache_file(key)}.tmp{os.getpid()}"
+                write_to_buffer(
+                    buffers,
+                    key,
+                    activations,
+                    start,
+                    nb_samples,
+                    disk_path=tmp_files.get(key),
                 )
+            del cache
+
+        if self.cache_dir is not None:
+            del buffers
+            buffers = {}
+            for key, tmp_file in tmp_files.items():
+                os.replace(tmp_file, self.disk_cache_file(key))
+                buffers[key] = load_memmap_tensor(self.disk_cache_file(key))
+        return buffers
+
+    def missing_components(
+        self, components: List[ModelComponent]
+    ) -> List[ModelComponent]:
+        """The components whose activations are not in the cache (one component per cache key)."""
+        missing = {}
+        for c in components:
+            if self.cache_key(c) not in self.transformerLensCache:
+                missing.setdefault(self.cache_key(c), c)
+        return list(missing.values())
+
+    def add_to_cache(self, components: List[ModelComponent]):
+        """Add the activations of the components to the cache. Only the missing keys are loaded from disk or computed, in a single pass over the dataset."""
+        missing = self.missing_components(components)
+        buffers = self.load_disk_cache([self.cache_key(c) for c in missing])
+        missing = [c for c in missing if self.cache_key(c) not in buffers]
+        if len(missing) > 0:
+            buffers.update(self.compute_buffers(missing, with_logits=False))
+        self.transformerLensCache.update(buffers)
+
+    def compute_cache(self):
+        """Compute the cache of the dataset: the logits and the activations of listOfComponents (of all hooks if listOfComponents is None or force_cache_all)."""
+        self.transformerLensCache = collections.OrderedDict()
+        if self.listOfComponents is None or self.force_cache_all:
+            assert (
+                not self.slice_positions
+            ), "The positions can only be sliced when caching a list of components"
+            buffers = self.compute_buffers(None, with_logits=True)
+        else:
+            buffers = self.load_disk_cache(
+                [self.logits_key()]
+                + self.resid_pre_keys()
+                + [self.cache_key(c) for c in self.listOfComponents]
             )
-        self.transformerLensCache = cache
-        self.dataset_logits = dataset_logits  # type: ignore
+            if any(
+                k not in buffers for k in [self.logits_key()] + self.resid_pre_keys()
+            ):
+                to_compute = [
+                    c
+                    for c in self.missing_components(self.listOfComponents)
+                    if self.cache_key(c) not in buffers
+                ]
+                buffers.update(self.compute_buffers(to_compute, with_logits=True))
+        self.dataset_logits = buffers.pop(self.logits_key())  # type: ignore
+        self.transformerLensCache.update(buffers)
+        if self.listOfComponents is not None and not self.force_cache_all:
+            self.add_to_cache(self.listOfComponents)
 
     def __attrs_post_init__(self):
         self.compute_cache()
 
+    def extend(self, new_rows: Float[torch.Tensor, "batch pos"]):
+        """Add new_rows at the end of the dataset and compute their reference logits and activations, without recomputing the previous rows. The activations of listOfComponents (and the clean resid_pre) are extended, the other cached hooks are removed. The positions of the components and eval_position must cover the new rows. The extended cache is kept in memory, also with cache_dir."""
+        assert (
+            self.listOfComponents is not None and not self.force_cache_all
+        ), "Only the cache of a list of components can be extended"
+        nb_old = self.dataset.shape[0]
+        self.dataset = torch.cat([self.dataset, new_rows.to(self.dataset.device)])
+        self._disk_cache_path = None  # the disk cache of the grown dataset is a new one
+        nb_samples = self.dataset.shape[0]
+        batch_size = nb_samples - nb_old if self.batch_size is None else self.batch_size
+        components = list(
+            {self.cache_key(c): c for c in self.listOfComponents}.values()
+        )
+
+        new_buffers: Dict[str, torch.Tensor] = {}
+        for start in range(nb_old, nb_samples, batch_size):
+            cache = self.compute_chunk_cache(
+                self.dataset[start : start + batch_size], start, components
+            )
+            for key, activations in cache.items():
+                write_to_buffer(
+                    new_buffers, key, activations, start - nb_old, nb_samples - nb_old
+                )
+            del cache
+
+        new_logits = new_buffers.pop(self.logits_key())
+        self.dataset_logits = torch.cat(
+            [self.dataset_logits, new_logits.to(self.dataset_logits.device)]
+        )
+        self.transformerLensCache = collections.OrderedDict(
+            (
+                key,
+                torch.cat(
+                    [
+                        self.transformerLensCache[key],
+                        activations.to(self.transformerLensCache[key].device),
+                    ]
+                ),
+            )
+            for key, activations in new_buffers.items()
+        )
+        self.activation_groups_cache = {}
+
     def getPatchingHooksByIdx(
         self,
         source_idx: List[int],
@@ -327,42 +719,699 @@ class ActivationStore:
 
         assert list_of_components is not None
 
+        if self.slice_positions:  # the sliced cache is read by the fused hooks
+            return self.getFusedPatchingHooksByIdx(
+                source_idx=[source_idx] * len(list_of_components),
+                target_idx=target_idx,
+                list_of_components=list_of_components,
+            )
+
         for component in list_of_components:
+            cache = self.transformerLensCache[component.hook_name][source_idx]
             patchingHooks.append(
                 (
                     component.hook_name,
                     partial(
                         component_patching_hook,
                         component=component,
-                        cache=self.transformerLensCache[component.hook_name][
-                            source_idx
-                        ],
+                        cache=cache,
                         source_idx=source_idx,
                         target_idx=target_idx,
                         verbose=verbose,
+                        target_positions=component.position.positions_tensor_from_idx(
+                            target_idx, device=cache.device
+                        ),  # index tensors are built once per batch, not at each call of the hook
+                        source_positions=component.position.positions_tensor_from_idx(
+                            source_idx, device=cache.device
+                        ),
                     ),
                 )
             )
 
         return patchingHooks
 
-    def change_component_list(self, new_list):
-        """Change the list of components to patch. Update the cache accordingly (only when needed)."""
+    def gather_patch_values(
+        self, component: ModelComponent, source_idx: List[int]
+    ) -> Float[torch.Tensor, "batch ..."]:
+        """Return the activations of the component on the rows source_idx, at the position of the component: [batch, d_head] for heads, [batch, d_model] for layers."""
+        cache = self.transformerLensCache[self.cache_key(component)]
+        rows = torch.tensor(source_idx, dtype=torch.long, device=cache.device)
+        if self.slice_positions:
+            values = cache[rows]
+        else:
+            positions = component.position.positions_tensor_from_idx(
+                source_idx, device=cache.device
+            )
+            values = cache[rows, positions]
+        if component.is_head():
+            return values[:, component.head]
+        return values
+
+    def activation_groups(
+        self, component: ModelComponent, tolerance: float = 0.0
+    ) -> Int[torch.Tensor, "batch"]:
+        """Group the rows of the dataset by their activation of the component at its position, equal within tolerance (bit-identical if 0). Return the group id of each row."""
+        key = (str(component), tolerance)
+        if key not in self.activation_groups_cache:
+            values = self.gather_patch_values(
+                component, list(range(self.dataset.shape[0]))
+            ).flatten(start_dim=1)
+            if tolerance > 0:  # quantized to multiples of tolerance
+                values = torch.round(values.float() / tolerance)
+            self.activation_groups_cache[key] = torch.unique(
+                values, dim=0, return_inverse=True
+            )[1].cpu()
+        return self.activation_groups_cache[key]
+
+    def equal_activations(
+        self,
+        source_idx: List[int],
+        target_idx: List[int],
+        components: List[ModelComponent],
+        tolerance: float = 0.0,
+        row_components: Optional[List[ModelComponent]] = None,
+    ) -> Bool[torch.Tensor, "batch"]:
+        """Whether patching each (source, target) pair leaves the target unchanged: the source and target activations are in the same activation_groups for all the components (for row_components[i] only if given)."""
+        sources = torch.tensor(source_idx, dtype=torch.long)
+        targets = torch.tensor(target_idx, dtype=torch.long)
+        if row_components is None:
+            equal = torch.ones(len(target_idx), dtype=torch.bool)
+            for component in components:
+                groups = self.activation_groups(component, tolerance)
+                equal &= groups[sources] == groups[targets]
+            return equal
+        equal = torch.zeros(len(target_idx), dtype=torch.bool)
+        for component in components:
+            rows = torch.tensor([c is component for c in row_components])
+            groups = self.activation_groups(component, tolerance)
+            equal |= rows & (groups[sources] == groups[targets])
+        return equal
+
+    def getFusedPatchingHooksByIdx(
+        self,
+        source_idx: List[List[int]],
+        target_idx: List[int],
+        list_of_components: List[ModelComponent],
+    ):
+        """Create one hook per hook point, patching all the components of list_of_components that share this hook point. source_idx[k] is the list of source indices of the k-th component."""
+        assert len(source_idx) == len(
+            list_of_components
+        ), "You should provide one list of source indices per component"
+
+        components_by_hook: Dict[str, List[Tuple[ModelComponent, List[int]]]] = {}
+        for component, component_source_idx in zip(list_of_components, source_idx):
+            assert max(component_source_idx) < self.dataset.shape[0]
+            components_by_hook.setdefault(component.hook_name, []).append(
+                (component, component_source_idx)
+            )
+
+        patchingHooks = []
+        for hook_name, components in components_by_hook.items():
+            assert len(set(c.is_head() for c, _ in components)) == 1
+            patch_values = torch.stack(
+                [self.gather_patch_values(c, s) for c, s in components]
+            )
+            device = patch_values.device
+
+            target_positions = torch.stack(
+                [
+                    c.position.positions_tensor_from_idx(target_idx, device)
+                    for c, _ in components
+                ]
+            )
+            rows = torch.arange(len(target_idx), device=device).expand_as(
+                target_positions
+            )
+
+            if components[0][0].is_head():
+                heads = torch.tensor(
+                    [[c.head] for c, _ in components], dtype=torch.long, device=device
+                ).expand_as(target_positions)
+            else:
+                heads = None
+
+            patchingHooks.append(
+                (
+                    hook_name,
+                    partial(
+                        fused_patching_hook,
+                        patch_values=patch_values,
+                        rows=rows,
+                        target_positions=target_positions,
+                        heads=heads,
+                    ),
+                )
+            )
+
+        return patchingHooks
+
+    def getMultiplexedPatchingHooksByIdx(
+        self,
+        source_idx: List[int],
+        target_idx: List[int],
+        row_components: List[ModelComponent],
+    ):
+        """Create one hook per hook point, where each row of the batch is patched on its own component: row i is patched on row_components[i] with the activations of source_idx[i]. This allows to pack the (source, target) pairs of many components in the same forward pass."""
+        assert len(source_idx) == len(target_idx) == len(row_components)
+        assert max(source_idx) < self.dataset.shape[0]
+
+        rows_by_hook: Dict[str, Dict[ModelComponent, List[int]]] = {}
+        for i, component in enumerate(row_components):
+            rows_by_hook.setdefault(component.hook_name, {}).setdefault(
+                component, []
+            ).append(i)
+
+        patchingHooks = []
+        for hook_name, rows_by_component in rows_by_hook.items():
+            assert len(set(c.is_head() for c in rows_by_component)) == 1
+            patch_values = torch.cat(
+                [
+                    self.gather_patch_values(c, [source_idx[i] for i in rows])
+                    for c, rows in rows_by_component.items()
+                ]
+            )
+            device = patch_values.device
+
+            target_positions = torch.cat(
+                [
+                    c.position.positions_tensor_from_idx(
+                        [target_idx[i] for i in rows], device
+                    )
+                    for c, rows in rows_by_component.items()
+                ]
+            )
+            rows = torch.tensor(
+                [i for c_rows in rows_by_component.values() for i in c_rows],
+                dtype=torch.long,
+                device=device,
+            )
+            if next(iter(rows_by_component)).is_head():
+                heads = torch.tensor(
+                    [c.head for c, c_rows in rows_by_component.items() for _ in c_rows],
+                    dtype=torch.long,
+                    device=device,
+                )
+            else:
+                heads = None
+
+            patchingHooks.append(
+                (
+                    hook_name,
+                    partial(
+                        fused_patching_hook,
+                        patch_values=patch_values,
+                        rows=rows,
+                        target_positions=target_positions,
+                        heads=heads,
+                    ),
+                )
+            )
+
+        return patchingHooks
+
+    def cache_nbytes(self, keys: Optional[List[str]] = None) -> int:
+        """Number of bytes of the cached activations (of the given keys, of all keys if None)."""
+        if keys is None:
+            keys = list(self.transformerLensCache.keys())
+        return sum(
+            self.transformerLensCache[k].element_size()
+            * self.transformerLensCache[k].nelement()
+            for k in keys
+        )
+
+    def estimate_nbytes(self, component: ModelComponent) -> int:
+        """Estimate the number of bytes needed to cache the activations of the component, from the model config."""
+        return estimate_activation_nbytes(
+            self.model,
+            component,
+            self.dataset.shape[0],
+            1 if self.slice_positions else self.dataset.shape[1],
+        )
+
+    def evict(self, keep: List[str]):
+        """Remove the least recently used keys, except keep, until the cache fits in cache_budget_bytes (all of them if there is no budget)."""
+        for key in list(self.transformerLensCache.keys()):
+            if key in keep or key in self.resid_pre_keys():
+                continue
+            if (
+                self.cache_budget_bytes is not None
+                and self.cache_nbytes() <= self.cache_budget_bytes
+            ):
+                break
+            del self.transformerLensCache[key]
+
+    def change_component_list(
+        self,
+        new_list: List[ModelComponent],
+        prefetch: Optional[List[ModelComponent]] = None,
+    ):
+        """Change the list of components to patch. Only the hooks that are not already cached are computed."""
         if self.listOfComponents is not None and not self.force_cache_all:
-            if [c.hook_name for c in new_list] != [
-                c.hook_name for c in self.listOfComponents
-            ]:
-                self.listOfComponents = new_list
-                self.compute_cache()  # only recompute when the list changed and when the cache is partial
+            to_compute = self.missing_components(new_list)
+            # with a budget, the missing hooks of prefetch are computed in the same pass while they fit, and the least recently used hooks are evicted
+            if (
+                len(to_compute) > 0
+                and prefetch is not None
+                and self.cache_budget_bytes is not None
+            ):
+                nbytes = self.cache_nbytes() + sum(
+                    self.estimate_nbytes(c) for c in to_compute
+                )
+                for c in self.missing_components(prefetch):
+                    if self.cache_key(c) in [self.cache_key(x) for x in to_compute]:
+                        continue
+                    nbytes += self.estimate_nbytes(c)
+                    if nbytes > self.cache_budget_bytes:
+                        break
+                    to_compute.append(c)
+            self.add_to_cache(to_compute)
+
+            keep = [self.cache_key(c) for c in new_list]
+            for key in keep:  # the current components are the most recently used
+                self.transformerLensCache.move_to_end(key)  # type: ignore
+            self.evict(keep)
         self.listOfComponents = new_list
 
 
+def unembed_resid(
+    model: HookedTransformer,
+    resid: Float[torch.Tensor, "batch pos d_model"],
+    position: Optional[WildPosition] = None,
+    target_idx: Optional[List[int]] = None,
+) -> torch.Tensor:
+    """Apply the final layer norm and the unembedding to the final residual stream. If position is given, only the evaluation position of each row is unembedded and the logits are [batch, vocab]."""
+    if position is not None:
+        resid = logits_at_positions(resid, position, target_idx)[
+            :, None, :
+        ]  # [batch, 1, d_model]
+    if model.cfg.normalization_type is not None:
+        resid = model.ln_final(resid)
+    logits = model.unembed(resid)
+    if position is not None:
+        return logits[:, 0, :]
+    return logits
+
+
+def run_with_hooks_at_positions(
+    model: HookedTransformer,
+    x: Float[torch.Tensor, "batch pos"],
+    fwd_hooks: List[Tuple[str, Callable]],
+    position: WildPosition,
+    target_idx: List[int],
+) -> Float[torch.Tensor, "batch vocab"]:
+    """Run the model with hooks, but only unembed the final residual stream at the evaluation positions of each row. Return the logits at these positions."""
+    final_resid = {}
+
+    def save_final_resid(tensor, hook):
+        final_resid["resid"] = tensor
+
+    model.run_with_hooks(
+        x,
+        return_type=None,  # skip the unembedding of the whole sequence
+        fwd_hooks=fwd_hooks
+        + [
+            (
+                utils.get_act_name("resid_post", model.cfg.n_layers - 1),
+                save_final_resid,
+            )
+        ],
+    )
+    return unembed_resid(model, final_resid["resid"], position, target_idx)
+
+
+def run_blocks_with_hooks(
+    model: HookedTransformer,
+    resid: Float[torch.Tensor, "batch pos d_model"],
+    start_layer: int,
+    fwd_hooks: List[Tuple[str, Callable]],
+    kv_cache_entries: Optional[List[HookedTransformerKeyValueCacheEntry]] = None,
+) -> Float[torch.Tensor, "batch pos d_model"]:
+    """Run the blocks start_layer, ..., n_layers - 1 on the residual stream resid with the hooks attached. kv_cache_entries (one per block run) hold the keys and values of the positions preceding resid. Return the final residual stream."""
+    assert (
+        model.cfg.positional_embedding_type != "shortformer"
+    ), "Shortformer positional embeddings are not supported"
+    try:
+        for hook_name, hook_fn in fwd_hooks:
+            model.add_hook(hook_name, hook_fn)
+        for l in range(start_layer, model.cfg.n_layers):
+            if kv_cache_entries is None:
+                resid = model.blocks[l](resid)
+            else:
+                resid = model.blocks[l](
+                    resid, past_kv_cache_entry=kv_cache_entries[l - start_layer]
+                )
+    finally:
+        model.reset_hooks(including_permanent=False)  # as in run_with_hooks
+    return resid
+
+
+@define
+class IncrementalPatchingEngine:
+    """Run patched forward passes that only recompute a single position per row, reusing the keys and values of the clean run.
+    When components are patched at a position p, causal attention guarantees that the earlier positions are unchanged. If the output is only read at p, the patched run only needs to compute the residual stream at p, from the first patched layer onward, attending to the clean keys and values of the positions before p.
+    The patched position and the evaluated position are both given by `position`."""
+
+    model: HookedTransformer = field(kw_only=True)
+    dataset: Float[torch.Tensor, "batch pos"] = field(kw_only=True)
+    position: WildPosition = field(kw_only=True)
+    batch_size: Optional[int] = field(kw_only=True, default=None)
+    past_keys: List[Float[torch.Tensor, "batch pos head d_head"]] = field(init=False)
+    past_values: List[Float[torch.Tensor, "batch pos head d_head"]] = field(init=False)
+    resid_pre: List[Float[torch.Tensor, "batch d_model"]] = field(
+        init=False
+    )  # the clean residual stream at `position`, before each layer
+
+    def __attrs_post_init__(self):
+        self.compute_cache()
+
+    def compute_cache(self):
+        """Cache the keys and values of every layer and the residual stream at `position` on the clean dataset."""
+        buffers = self.compute_buffers(0)
+        n_layers = self.model.cfg.n_layers
+        self.past_keys = [buffers[utils.get_act_name("k", l)] for l in range(n_layers)]
+        self.past_values = [
+            buffers[utils.get_act_name("v", l)] for l in range(n_layers)
+        ]
+        self.resid_pre = [
+            buffers[utils.get_act_name("resid_pre", l)] for l in range(n_layers)
+        ]
+
+    def compute_buffers(self, start_row: int) -> Dict[str, torch.Tensor]:
+        """Compute the keys, values and residual stream at `position` of the rows of the dataset from start_row, by chunks of batch_size."""
+        nb_samples = self.dataset.shape[0]
+        batch_size = (
+            nb_samples - start_row if self.batch_size is None else self.batch_size
+        )
+        n_layers = self.model.cfg.n_layers
+
+        buffers: Dict[str, torch.Tensor] = {}
+        for start in range(start_row, nb_samples, batch_size):
+            chunk = self.dataset[start : start + batch_size]
+            chunk_idx = list(range(start, start + chunk.shape[0]))
+            cache = {}
+
+            def save_hook(tensor, hook):
+                cache[hook.name] = tensor.detach()
+
+            def save_resid_hook(tensor, hook):
+                cache[hook.name] = logits_at_positions(
+                    tensor.detach(), self.position, chunk_idx
+                )
+
+            fwd_hooks = []
+            for l in range(n_layers):
+                fwd_hooks.append((utils.get_act_name("k", l), save_hook))
+                fwd_hooks.append((utils.get_act_name("v", l), save_hook))
+                fwd_hooks.append((utils.get_act_name("resid_pre", l), save_resid_hook))
+            self.model.run_with_hooks(chunk, return_type=None, fwd_hooks=fwd_hooks)
+            for key, activations in cache.items():
+                write_to_buffer(
+                    buffers, key, activations, start - start_row, nb_samples - start_row
+                )
+            del cache
+        return buffers
+
+    def extend(self, new_rows: Float[torch.Tensor, "batch pos"]):
+        """Add new_rows at the end of the dataset and cache their keys, values and residual stream, without recomputing the previous rows. `position` must cover the new rows."""
+        nb_old = self.dataset.shape[0]
+        self.dataset = torch.cat([self.dataset, new_rows.to(self.dataset.device)])
+        buffers = self.compute_buffers(nb_old)
+        n_layers = self.model.cfg.n_layers
+        for l in range(n_layers):
+            self.past_keys[l] = torch.cat(
+                [self.past_keys[l], buffers[utils.get_act_name("k", l)]]
+            )
+            self.past_values[l] = torch.cat(
+                [self.past_values[l], buffers[utils.get_act_name("v", l)]]
+            )
+            self.resid_pre[l] = torch.cat(
+                [self.resid_pre[l], buffers[utils.get_act_name("resid_pre", l)]]
+            )
+
+    def run_patched(
+        self,
+        target_idx: List[int],
+        components: List[ModelComponent],
+        patch_values: List[Float[torch.Tensor, "batch ..."]],
+    ) -> Float[torch.Tensor, "batch vocab"]:
+        """Run the model on the rows target_idx where each component is patched with patch_values (one [batch, ...] tensor per component, see ActivationStore.gather_patch_values). Return the logits at `position`."""
+        for c in components:
+            assert c.position.positions_from_idx(
+                target_idx
+            ) == self.position.positions_from_idx(
+                target_idx
+            ), f"{c} should be patched at the evaluated position"
+        start_layer = min(c.layer for c in components)
+        device = self.resid_pre[0].device
+        positions = self.position.positions_tensor_from_idx(target_idx, device=device)
+        targets = torch.tensor(target_idx, dtype=torch.long, device=device)
+        logits = None
+
+        for p in positions.unique().tolist():  # rows sharing the same prefix length are run together
+            rows = (positions == p).nonzero()[:, 0]
+            group_targets = targets[rows]
+
+            fwd_hooks = []
+            components_by_hook: Dict[str, List[int]] = {}
+            for k, c in enumerate(components):
+                components_by_hook.setdefault(c.hook_name, []).append(k)
+            for hook_name, compo_ids in components_by_hook.items():
+                values = torch.stack(
+                    [patch_values[k][rows.to(patch_values[k].device)] for k in compo_ids]
+                )
+                zeros = torch.zeros(
+                    values.shape[:2], dtype=torch.long, device=values.device
+                )  # the recomputed sequence only contains the position p
+                heads = None
+                if components[compo_ids[0]].is_head():
+                    heads = torch.tensor(
+                        [[components[k].head] for k in compo_ids],
+                        dtype=torch.long,
+                        device=values.device,
+                    ).expand_as(zeros)
+                fwd_hooks.append(
+                    (
+                        hook_name,
+                        partial(
+                            fused_patching_hook,
+                            patch_values=values,
+                            rows=torch.arange(len(rows), device=values.device).expand_as(
+                                zeros
+                            ),
+                            target_positions=zeros,
+                            heads=heads,
+                        ),
+                    )
+                )
+
+            resid = run_blocks_with_hooks(
+                self.model,
+                self.resid_pre[start_layer][group_targets][:, None, :],
+                start_layer,
+                fwd_hooks,
+                kv_cache_entries=[
+                    HookedTransformerKeyValueCacheEntry(
+                        past_keys=self.past_keys[l][group_targets, :p],
+                        past_values=self.past_values[l][group_targets, :p],
+                    )
+                    for l in range(start_layer, self.model.cfg.n_layers)
+                ],
+            )
+            group_logits = unembed_resid(self.model, resid)[:, 0, :]
+            if logits is None:
+                logits = torch.empty(
+                    (len(target_idx), group_logits.shape[-1]),
+                    dtype=group_logits.dtype,
+                    device=group_logits.device,
+                )
+            logits[rows.to(logits.device)] = group_logits
+        return logits  # type: ignore
+
+
+def is_out_of_memory_error(e: BaseException) -> bool:
+    """Whether e is raised by the CUDA or the CPU allocator running out of memory."""
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and (
+        "out of memory" in str(e) or "can't allocate memory" in str(e)
+    )
+
+
+def available_memory_bytes(device: Union[str, torch.device]) -> int:
+    """The free memory of the device: the free GPU memory for CUDA devices, the available RAM otherwise."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        return free_bytes
+    if not NO_PSUTIL:
+        return psutil.virtual_memory().available
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):  # SC_AVPHYS_PAGES doesn't exist on macOS, sysconf on Windows
+        return FALLBACK_MEMORY_BYTES
+
+
+def estimate_activation_nbytes(
+    model: HookedTransformer, component: ModelComponent, nb_rows: int, seq_len: int
+) -> int:
+    """Estimate the number of bytes of the activations of the component on nb_rows rows of seq_len positions, from the model config."""
+    cfg = model.cfg
+    if component.name in ["q", "k", "v", "z"]:
+        row_size = cfg.n_heads * cfg.d_head
+    else:
+        row_size = cfg.d_model
+    return nb_rows * row_size * seq_len * torch.empty(0, dtype=cfg.dtype).element_size()
+
+
+def estimate_row_nbytes(
+    model: HookedTransformer, seq_len: int, full_logits: bool = True
+) -> int:
+    """Estimate the peak memory used by one row of a forward pass without gradients: the attention scores and pattern, the hidden activations of the MLP, a few copies of the residual stream and the logits (of all positions if full_logits, of a single position otherwise)."""
+    cfg = model.cfg
+    d_mlp = getattr(cfg, "d_mlp", None) or 4 * cfg.d_model  # None for attn-only models
+    nb_elements = (
+        2 * cfg.n_heads * seq_len**2
+        + 2 * d_mlp * seq_len
+        + 8 * cfg.d_model * seq_len  # residual stream, q, k, v, z and hook outputs
+        + (seq_len if full_logits else 1) * cfg.d_vocab
+    )
+    dtype = getattr(cfg, "dtype", torch.float32)
+    return nb_elements * torch.empty(0, dtype=dtype).element_size()
+
+
+def plan_batch_size(
+    model: HookedTransformer,
+    seq_len: int,
+    full_logits: bool = True,
+    memory_fraction: float = 0.5,
+    max_batch_size: Optional[int] = None,
+    components: Optional[List[ModelComponent]] = None,
+    nb_cached_rows: int = 0,
+) -> int:
+    """The largest batch size whose estimated forward pass fits in memory_fraction of the free memory of the model device. The patch values of components are counted in each row, and their clean cache on nb_cached_rows rows (if it is not computed yet) is taken from the free memory."""
+    row_nbytes = estimate_row_nbytes(model, seq_len, full_logits=full_logits)
+    free_nbytes = available_memory_bytes(model.cfg.device)
+    if components is not None:
+        row_nbytes += sum(
+            estimate_activation_nbytes(model, c, 1, seq_len) for c in components
+        )  # the patch values gathered for the batch
+        hooks = {c.hook_name: c for c in components}.values()
+        cached_row_nbytes = sum(
+            estimate_activation_nbytes(model, c, 1, seq_len) for c in hooks
+        ) + (seq_len if full_logits else 1) * model.cfg.d_vocab * torch.empty(
+            0, dtype=model.cfg.dtype
+        ).element_size()  # the activations and the reference logits
+        free_nbytes = max(0, free_nbytes - nb_cached_rows * cached_row_nbytes)
+    batch_size = int(memory_fraction * free_nbytes // row_nbytes)
+    if max_batch_size is not None:
+        batch_size = min(batch_size, max_batch_size)
+    return max(1, batch_size)
+
+
+def run_batches_with_backoff(
+    nb_rows: int,
+    batch_size: int,
+    run_batch: Callable[[int, int], Any],
+    progress_bar: bool = False,
+) -> List[Any]:
+    """Call run_batch(start, end) on consecutive batches covering the rows 0, ..., nb_rows - 1 and return the results in order. If a batch runs out of memory, the batch size is halved and the batch is retried, such that no result is lost."""
+    results = []
+    start = 0
+    with tqdm.tqdm(total=nb_rows, disable=not progress_bar) as pbar:
+        while start < nb_rows:
+            end = min(start + batch_size, nb_rows)
+            out_of_memory = False
+            try:
+                results.append(run_batch(start, end))
+            except RuntimeError as e:
+                if not is_out_of_memory_error(e) or batch_size == 1:
+                    raise
+                out_of_memory = True
+            if out_of_memory:  # outside of the except block, the tensors of the failed batch can be freed
+                batch_size = max(1, batch_size // 2)
+                gc.collect()
+                torch.cuda.empty_cache()
+                warnings.warn(f"Out of memory, retrying with batch size {batch_size}")
+                continue
+            pbar.update(end - start)
+            start = end
+    return results
+
+
+def run_pipelined_batches(
+    nb_rows: int,
+    batch_size: int,
+    prepare_batch: Callable[[int, int], Any],
+    forward_batch: Callable[[Any], Any],
+    finish_batch: Callable[[Any, Any], Any],
+    progress_bar: bool = False,
+    max_pending: int = 2,  # the batches waiting for finish_batch, to bound the memory held by their outputs
+) -> List[Any]:
+    """Like run_batches_with_backoff, with prepare_batch (one batch ahead) and finish_batch running in background threads while forward_batch runs in the calling thread."""
+    grad_enabled = torch.is_grad_enabled()  # the grad mode is local to each thread
+
+    def in_grad_mode(fn: Callable) -> Callable:
+        def wrapped(*args):
+            with torch.set_grad_enabled(grad_enabled):
+                return fn(*args)
+
+        return wrapped
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=1
+    ) as producer, concurrent.futures.ThreadPoolExecutor(
+        max_workers=1
+    ) as consumer, tqdm.tqdm(
+        total=nb_rows, disable=not progress_bar
+    ) as pbar:
+        start = 0
+        next_inputs = producer.submit(
+            in_grad_mode(prepare_batch), start, min(batch_size, nb_rows)
+        )
+        while start < nb_rows:
+            end = min(start + batch_size, nb_rows)
+            inputs = next_inputs.result()
+            if end < nb_rows:
+                next_inputs = producer.submit(
+                    in_grad_mode(prepare_batch), end, min(end + batch_size, nb_rows)
+                )
+            out_of_memory = False
+            try:
+                outputs = forward_batch(inputs)
+            except RuntimeError as e:
+                if not is_out_of_memory_error(e) or batch_size == 1:
+                    raise
+                out_of_memory = True
+            if out_of_memory:
+                del inputs
+                if end < nb_rows:
+                    next_inputs.result()  # the prefetched batch has the wrong boundaries
+                for result in results:  # free the outputs of the pending batches
+                    result.result()
+                batch_size = max(1, batch_size // 2)
+                gc.collect()
+                torch.cuda.empty_cache()
+                warnings.warn(f"Out of memory, retrying with batch size {batch_size}")
+                next_inputs = producer.submit(
+                    in_grad_mode(prepare_batch), start, min(start + batch_size, nb_rows)
+                )
+                continue
+            results.append(consumer.submit(in_grad_mode(finish_batch), inputs, outputs))
+            del inputs, outputs
+            if len(results) > max_pending:
+                results[-max_pending - 1].result()
+            pbar.update(end - start)
+            start = end
+        return [result.result() for result in results]
+
+
 def compute_batched_weights(
     model: HookedTransformer,
     dataset: Float[torch.Tensor, "batch pos"],
     source_IDs: List[int],
     target_IDs: List[int],
-    batch_size: int,
+    batch_size: Optional[int],
     components_to_patch: List[ModelComponent],
     comp_metric: CompMetric,
     additional_info_gathering: Optional[
@@ -371,63 +1420,594 @@ def compute_batched_weights(
     verbose: bool = False,
     activation_store: Optional[ActivationStore] = None,
     progress_bar: bool = True,
+    eval_position: Optional[
+        WildPosition
+    ] = None,  # only unembed these positions: comp_metric then receives [batch, vocab] logits
+    incremental_engine: Optional[
+        IncrementalPatchingEngine
+    ] = None,  # only recompute the patched position (the components are patched at eval_position)
+    cache_resid_pre: bool = False,  # start the patched forward passes from the clean residual stream at the first patched layer
+    row_components: Optional[
+        List[ModelComponent]
+    ] = None,  # the i-th pair is only patched on row_components[i]
+    pipeline: bool = False,  # gather the inputs and compute the metric in background threads, same results as the serial path
+    skip_equal_activations: Optional[
+        float
+    ] = None,  # don't run the pairs whose source and target activations are equal within this tolerance
 ):
-    all_weights = []
+    """Compute the comparison metric between the original and the patched logits for each (source, target) pair. If batch_size is None, it is planned from the free memory (see plan_batch_size)."""
+    if incremental_engine is not None:
+        assert (
+            eval_position is not None
+        ), "The incremental engine only computes the logits at the evaluated position"
+    if row_components is not None:
+        assert len(row_components) == len(target_IDs)
+        assert (
+            incremental_engine is None
+        ), "The incremental engine patches the same components on all rows"
+    if len(target_IDs) == 0:
+        return torch.zeros(0, device=model.cfg.device)
+    if batch_size is None:
+        batch_size = plan_batch_size(
+            model,
+            dataset.shape[1],
+            full_logits=eval_position is None,
+            components=components_to_patch,
+            nb_cached_rows=len(dataset) if activation_store is None else 0,
+        )
     if activation_store is None:
         activation_store = ActivationStore(
-            model=model, dataset=dataset, listOfComponents=components_to_patch
+            model=model,
+            dataset=dataset,
+            listOfComponents=components_to_patch,
+            batch_size=batch_size,
+            eval_position=eval_position,
+            cache_resid_pre=cache_resid_pre,
+        )
+    start_layer = min(c.layer for c in components_to_patch)
+
+    nb_pairs = len(target_IDs)
+    equal_rows = torch.zeros(nb_pairs, dtype=torch.bool)
+    if skip_equal_activations is not None:
+        # the patch leaves these targets unchanged: their metric is computed between the reference logits and themselves
+        equal_rows = activation_store.equal_activations(
+            source_IDs,
+            target_IDs,
+            components_to_patch,
+            skip_equal_activations,
+            row_components,
         )
-    for i in tqdm.tqdm(range(0, len(target_IDs), batch_size), disable=not progress_bar):
-        source_idx = source_IDs[
-            i : min(i + batch_size, len(source_IDs))
+        activation_store.nb_skipped_forwards += int(equal_rows.sum())
+        if verbose:
+            print(f"Skipped {int(equal_rows.sum())}/{nb_pairs} forward passes")
+        skipped_target_IDs = [t for t, e in zip(target_IDs, equal_rows.tolist()) if e]
+        kept = (~equal_rows).tolist()
+        source_IDs = [s for s, k in zip(source_IDs, kept) if k]
+        target_IDs = [t for t, k in zip(target_IDs, kept) if k]
+        if row_components is not None:
+            row_components = [c for c, k in zip(row_components, kept) if k]
+
+    def prepare_batch(start: int, end: int) -> Dict[str, Any]:
+        """Gather the inputs of the batch: the target sequences, the patching hooks (with the activations of the sources) and the reference logits."""
+        batch: Dict[str, Any] = {}
+        batch["source_idx"] = source_IDs[
+            start:end
         ]  # the index that will send the cache, the once by witch we pqtch
-        target_idx = target_IDs[
-            i : min(i + batch_size, len(target_IDs))
+        batch["target_idx"] = target_IDs[
+            start:end
         ]  # The index of the datapoints that the majority of the model will run on
+        batch["target_x"] = dataset[batch["target_idx"]]
+        batch["logits_target"] = activation_store.dataset_logits[batch["target_idx"]]
+
+        if row_components is not None:
+            batch["patching_hooks"] = activation_store.getMultiplexedPatchingHooksByIdx(
+                source_idx=batch["source_idx"],
+                target_idx=batch["target_idx"],
+                row_components=row_components[start:end],
+            )
+        elif incremental_engine is None:
+            batch["patching_hooks"] = activation_store.getPatchingHooksByIdx(
+                source_idx=batch["source_idx"],
+                target_idx=batch["target_idx"],
+                verbose=verbose,
+            )
+        else:
+            batch["patch_values"] = [
+                activation_store.gather_patch_values(c, batch["source_idx"])
+                for c in components_to_patch
+            ]
 
-        target_x = dataset[target_idx]
+        if activation_store.cache_resid_pre and incremental_engine is None:
+            batch["resid"] = activation_store.transformerLensCache[
+                activation_store.resid_pre_key(start_layer)
+            ][batch["target_idx"]]
+        return batch
 
-        gc.collect()
-        torch.cuda.empty_cache()
+    def forward_batch(batch: Dict[str, Any]) -> torch.Tensor:
+        """Run the patched forward pass of the batch and return the patched logits."""
+        target_idx = batch["target_idx"]
         if verbose:
             print_gpu_mem("before run_with_hooks")
 
-        patched_logits = model.run_with_hooks(
-            target_x,
-            return_type="logits",
-            fwd_hooks=activation_store.getPatchingHooksByIdx(
-                source_idx=source_idx, target_idx=target_idx, verbose=verbose
-            ),
-        )
+        if incremental_engine is not None:
+            assert eval_position is not None
+            assert incremental_engine.position.positions_from_idx(
+                target_idx
+            ) == eval_position.positions_from_idx(target_idx)
+            return incremental_engine.run_patched(
+                target_idx, components_to_patch, batch["patch_values"]
+            )
+        elif activation_store.cache_resid_pre:
+            final_resid = run_blocks_with_hooks(
+                model,
+                batch["resid"].to(model.cfg.device),
+                start_layer,
+                batch["patching_hooks"],
+            )
+            return unembed_resid(model, final_resid, eval_position, target_idx)
+        elif eval_position is None:
+            return model.run_with_hooks(
+                batch["target_x"],
+                return_type="logits",
+                fwd_hooks=batch["patching_hooks"],
+            )
+        else:
+            return run_with_hooks_at_positions(
+                model,
+                batch["target_x"],
+                batch["patching_hooks"],
+                eval_position,
+                target_idx,
+            )
 
+    def finish_batch(
+        batch: Dict[str, Any], patched_logits: torch.Tensor
+    ) -> torch.Tensor:
+        """Compare the patched logits to the reference logits."""
+        logits_target = batch["logits_target"].to(patched_logits.device)
         comp_results = comp_metric(
-            logits_target=activation_store.dataset_logits[target_idx],
+            logits_target=logits_target,
             logits_source=patched_logits,
-            target_seqs=target_x,
-            target_idx=target_idx,
+            target_seqs=batch["target_x"],
+            target_idx=batch["target_idx"],
         )
 
         if additional_info_gathering is not None:  # gather facts for debugging
             additional_info_gathering(
-                activation_store.dataset_logits[target_idx], patched_logits, target_x  # type: ignore
+                logits_target, patched_logits, batch["target_x"]  # type: ignore
             )
 
-        all_weights.append(comp_results)
+        return comp_results
+
+    if len(target_IDs) == 0:  # all the pairs were skipped
+        all_weights = []
+    elif pipeline:
+        all_weights = run_pipelined_batches(
+            len(target_IDs),
+            batch_size,
+            prepare_batch,
+            forward_batch,
+            finish_batch,
+            progress_bar=progress_bar,
+        )
+    else:
 
-        # print_gpu_mem("before del")
-        # del patched_logits
-        # model.reset_hooks()
-        # gc.collect()
-        # torch.cuda.empty_cache()
-        # print_gpu_mem("after del")
+        def run_batch(start: int, end: int) -> torch.Tensor:
+            batch = prepare_batch(start, end)
+            return finish_batch(batch, forward_batch(batch))
 
-    return torch.cat(all_weights)
+        all_weights = run_batches_with_backoff(
+            len(target_IDs), batch_size, run_batch, progress_bar=progress_bar
+        )
+    if not equal_rows.any():
+        return torch.cat(all_weights)
+
+    skipped_weights = []
+    for start in range(0, len(skipped_target_IDs), batch_size):
+        batch = {"target_idx": skipped_target_IDs[start : start + batch_size]}
+        batch["target_x"] = dataset[batch["target_idx"]]
+        batch["logits_target"] = activation_store.dataset_logits[batch["target_idx"]]
+        skipped_weights.append(finish_batch(batch, batch["logits_target"]))
+    skipped_weights = torch.cat(skipped_weights)
+    weights = torch.empty(
+        nb_pairs, dtype=skipped_weights.dtype, device=skipped_weights.device
+    )
+    weights[equal_rows.to(weights.device)] = skipped_weights
+    if len(all_weights) > 0:
+        weights[~equal_rows.to(weights.device)] = torch.cat(all_weights).to(
+            weights.device
+        )
+    return weights
+
+
+def sample_edges(
+    nb_nodes: int,
+    proba_edge: float = 1.0,
+    nb_edges: Optional[int] = None,
+    sources_per_target: Optional[int] = None,
+    generator: Optional[torch.Generator] = None,
+    max_chunk_numel: int = 2**24,
+) -> Tuple[List[int], List[int]]:
+    """Sample the (source, target) pairs of a swap graph among the pairs of distinct nodes. Return the list of sources and the list of targets, sorted by target then source.
+    * By default, each pair is kept with probability proba_edge.
+    * If nb_edges is set, exactly nb_edges distinct pairs are sampled uniformly.
+    * If sources_per_target is set, each target gets exactly sources_per_target distinct sources.
+    The random matrices are drawn by chunks of targets of at most max_chunk_numel elements."""
+    assert nb_edges is None or sources_per_target is None
+    if nb_edges is not None:
+        nb_pairs = nb_nodes * (nb_nodes - 1)
+        assert nb_edges <= nb_pairs, "There are not enough pairs of distinct nodes"
+        pair_idx = torch.randperm(nb_pairs, generator=generator)[:nb_edges].sort().values
+        targets = pair_idx // (nb_nodes - 1)
+        sources = pair_idx % (nb_nodes - 1)
+        sources += (sources >= targets).long()  # skip the diagonal
+        return sources.tolist(), targets.tolist()
+
+    if sources_per_target is not None:
+        assert sources_per_target <= nb_nodes - 1, "There are not enough sources"
+
+    all_sources, all_targets = [], []
+    chunk_size = max(1, max_chunk_numel // nb_nodes)
+    for start in range(0, nb_nodes, chunk_size):
+        end = min(start + chunk_size, nb_nodes)
+        rand = torch.rand((end - start, nb_nodes), generator=generator)
+        diagonal = (torch.arange(end - start), torch.arange(start, end))
+        if sources_per_target is not None:
+            rand[diagonal] = 2.0  # never among the smallest values
+            sources = rand.topk(sources_per_target, dim=1, largest=False).indices
+            sources = sources.sort(dim=1).values
+            targets = torch.arange(start, end)[:, None].expand_as(sources)
+            all_sources.append(sources.flatten())
+            all_targets.append(targets.flatten())
+        else:
+            mask = rand <= proba_edge
+            mask[diagonal] = False
+            targets, sources = mask.nonzero(as_tuple=True)
+            all_sources.append(sources)
+            all_targets.append(targets + start)
+    return torch.cat(all_sources).tolist(), torch.cat(all_targets).tolist()
+
+
+def sample_edges_to_new_nodes(
+    nb_old_nodes: int,
+    nb_nodes: int,
+    proba_edge: float = 1.0,
+    sources_per_target: Optional[int] = None,
+    generator: Optional[torch.Generator] = None,
+) -> Tuple[List[int], List[int]]:
+    """Sample the (source, target) pairs of a swap graph that involve at least one of the nodes nb_old_nodes, ..., nb_nodes - 1 (new -> old, old -> new and new -> new), such that they complete a graph sampled on the first nb_old_nodes nodes. Return the list of sources and the list of targets, sorted by target then source.
+    * By default, each pair is kept with probability proba_edge.
+    * If sources_per_target is set, each new target gets exactly sources_per_target distinct sources (the old targets keep their sources)."""
+    new_nodes = torch.arange(nb_old_nodes, nb_nodes)
+    if sources_per_target is not None:
+        assert sources_per_target <= nb_nodes - 1, "There are not enough sources"
+        rand = torch.rand((len(new_nodes), nb_nodes), generator=generator)
+        rand[torch.arange(len(new_nodes)), new_nodes] = 2.0  # never among the smallest values
+        sources = rand.topk(sources_per_target, dim=1, largest=False).indices
+        sources = sources.sort(dim=1).values
+        targets = new_nodes[:, None].expand_as(sources)
+        return sources.flatten().tolist(), targets.flatten().tolist()
+
+    old_targets = torch.arange(nb_old_nodes).repeat_interleave(len(new_nodes))
+    new_sources = new_nodes.repeat(nb_old_nodes)
+    new_targets = new_nodes.repeat_interleave(nb_nodes)
+    all_sources = torch.arange(nb_nodes).repeat(len(new_nodes))
+    not_self = all_sources != new_targets
+    sources = torch.cat([new_sources, all_sources[not_self]])
+    targets = torch.cat([old_targets, new_targets[not_self]])
+    if proba_edge < 1.0:
+        keep = torch.rand(len(sources), generator=generator) <= proba_edge
+        sources, targets = sources[keep], targets[keep]
+    return sources.tolist(), targets.tolist()
+
+
+EDGE_LOG_DTYPE = np.dtype(
+    [("source", "<i4"), ("target", "<i4"), ("comp_metric", "<f4")]
+)  # one record per evaluated edge in the edge logs
+
+
+def append_edge_log(
+    path: str,
+    sources: Int[np.ndarray, "edge"],
+    targets: Int[np.ndarray, "edge"],
+    comp_metrics: Float[np.ndarray, "edge"],
+):
+    """Append the edges to the binary edge log at path, and flush them to the disk."""
+    records = np.empty(len(sources), dtype=EDGE_LOG_DTYPE)
+    records["source"] = sources
+    records["target"] = targets
+    records["comp_metric"] = comp_metrics
+    with open(path, "ab") as f:
+        f.write(records.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_edge_log(
+    path: str,
+) -> Tuple[Int[np.ndarray, "edge"], Int[np.ndarray, "edge"], Float[np.ndarray, "edge"]]:
+    """Load the sources, targets and comparison metrics of the edges in the edge log at path (empty arrays if it doesn't exist). A record truncated by an interrupted write is ignored."""
+    if not os.path.exists(path):
+        records = np.zeros(0, dtype=EDGE_LOG_DTYPE)
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+        nb_records = len(data) // EDGE_LOG_DTYPE.itemsize
+        records = np.frombuffer(
+            data[: nb_records * EDGE_LOG_DTYPE.itemsize], dtype=EDGE_LOG_DTYPE
+        )
+    return (
+        records["source"].astype(np.int64),
+        records["target"].astype(np.int64),
+        records["comp_metric"].copy(),
+    )
 
 
 def gaussian_kernel(d, sigma):
     return np.exp(-0.5 * (d / sigma) ** 2) / (sigma * np.sqrt(2 * np.pi))
 
 
+def default_weight_func(comp_metrics: np.ndarray) -> Callable:
+    """The default function from comparison metrics to graph weights: a gaussian kernel whose width is the 25th percentile of the comparison metrics."""
+    return partial(
+        gaussian_kernel,
+        sigma=np.percentile(
+            comp_metrics, 25
+        ),  # hard coded default to have a reasonable kernel to got from KL to graph weights
+    )
+
+
+def partial_graph_communities(
+    nb_nodes: int,
+    sources: Int[np.ndarray, "edge"],
+    targets: Int[np.ndarray, "edge"],
+    comp_metrics: Float[np.ndarray, "edge"],
+    weight_func: Optional[Callable] = None,
+    resolution: float = 1.0,
+    method: Literal["louvain", "leiden"] = "louvain",
+    seed: Optional[int] = None,
+) -> Tuple[Int[np.ndarray, "node"], Float[np.ndarray, "edge"]]:
+    """The communities of the graph of the edges evaluated so far, with weights from weight_func (the default kernel of compute_weights if None). Return the community labels and the edge weights."""
+    func = weight_func if weight_func is not None else default_weight_func(comp_metrics)
+    weights = np.asarray(func(comp_metrics), dtype=np.float64)
+    nonzero = weights != 0
+    labels = detect_communities(
+        scipy.sparse.csr_matrix(
+            (weights[nonzero], (sources[nonzero], targets[nonzero])),
+            shape=(nb_nodes, nb_nodes),
+        ),
+        resolution=resolution,
+        method=method,
+        seed=seed,
+    )
+    return labels, weights
+
+
+def community_uncertainty(
+    nb_nodes: int,
+    sources: Int[np.ndarray, "edge"],
+    targets: Int[np.ndarray, "edge"],
+    weights: Float[np.ndarray, "edge"],
+    labels: Int[np.ndarray, "node"],
+) -> Tuple[Float[np.ndarray, "node"], Float[np.ndarray, "node community"]]:
+    """How uncertain the community of each node is, given the evaluated edges. Return the uncertainties and the [node, community] affinities."""
+    # the affinity is the mean weight of the edges (both directions) between the node and the community
+    nb_communities = int(labels.max()) + 1
+    nodes = np.concatenate([targets, sources])
+    linked_communities = np.concatenate([labels[sources], labels[targets]])
+    pair_idx = nodes * nb_communities + linked_communities
+    sums = np.bincount(
+        pair_idx,
+        weights=np.concatenate([weights, weights]),
+        minlength=nb_nodes * nb_communities,
+    ).reshape(nb_nodes, nb_communities)
+    counts = np.bincount(pair_idx, minlength=nb_nodes * nb_communities).reshape(
+        nb_nodes, nb_communities
+    )
+    prior = weights.mean() if len(weights) > 0 else 0.0  # one pseudo-edge, such that the communities never compared to the node keep an average affinity
+    affinities = (sums + prior) / (counts + 1)
+    if nb_communities == 1:
+        return np.ones(nb_nodes), affinities
+    totals = affinities.sum(axis=1, keepdims=True)
+    probas = np.divide(
+        affinities,
+        totals,
+        out=np.full_like(affinities, 1 / nb_communities),
+        where=totals > 0,
+    )
+    top_two = np.partition(probas, nb_communities - 2, axis=1)[:, -2:]
+    # 1 - the margin between the two largest normalized affinities
+    return 1 - (top_two[:, 1] - top_two[:, 0]), affinities
+
+
+def active_edge_sampling(
+    nb_nodes: int,
+    evaluate_edges: Callable[[List[int], List[int]], np.ndarray],
+    edge_budget: int,
+    initial_sources_per_target: int = 5,
+    round_size: Optional[int] = None,
+    sources_per_node: int = 4,
+    weight_func: Optional[Callable] = None,
+    resolution: float = 1.0,
+    method: Literal["louvain", "leiden"] = "louvain",
+    seed: Optional[int] = None,
+    verbose: bool = False,
+) -> Tuple[Int[np.ndarray, "edge"], Int[np.ndarray, "edge"], Float[np.ndarray, "edge"]]:
+    """Evaluate edge_budget edges of a swap graph, sampled where they decide the communities of the most uncertain nodes. Return the sources, the targets and the comparison metrics of the evaluated edges."""
+    # each target first gets initial_sources_per_target random sources. Then by rounds of round_size edges, the nodes of largest community_uncertainty
+    # in the provisional communities get sources_per_node new sources from their two most linked communities
+    rng = np.random.default_rng(seed)
+    generator = None
+    if seed is not None:
+        generator = torch.Generator().manual_seed(seed)
+    if round_size is None:
+        round_size = nb_nodes
+    edge_budget = min(edge_budget, nb_nodes * (nb_nodes - 1))
+
+    initial_sources, initial_targets = sample_edges(
+        nb_nodes,
+        sources_per_target=min(initial_sources_per_target, nb_nodes - 1),
+        generator=generator,
+    )
+    if len(initial_sources) > edge_budget:
+        keep = np.sort(rng.choice(len(initial_sources), edge_budget, replace=False))
+        initial_sources = np.array(initial_sources)[keep].tolist()
+        initial_targets = np.array(initial_targets)[keep].tolist()
+    sources = np.array(initial_sources, dtype=np.int64)
+    targets = np.array(initial_targets, dtype=np.int64)
+    comp_metrics = np.asarray(evaluate_edges(initial_sources, initial_targets))
+    evaluated_sources: List[Set[int]] = [set() for _ in range(nb_nodes)]
+    for source, target in zip(initial_sources, initial_targets):
+        evaluated_sources[target].add(source)
+
+    round_idx = 0
+    while len(sources) < edge_budget:
+        labels, weights = partial_graph_communities(
+            nb_nodes,
+            sources,
+            targets,
+            comp_metrics,
+            weight_func=weight_func,
+            resolution=resolution,
+            method=method,
+            seed=seed,
+        )
+        uncertainty, affinities = community_uncertainty(
+            nb_nodes, sources, targets, weights, labels
+        )
+
+        nb_new_edges = min(round_size, edge_budget - len(sources))
+        new_sources, new_targets = [], []
+        order = np.lexsort(
+            (rng.random(nb_nodes), -uncertainty)
+        )  # most uncertain first, ties in random order
+        for node in order:
+            if len(new_sources) >= nb_new_edges:
+                break
+            evaluated = evaluated_sources[node]
+            if len(evaluated) >= nb_nodes - 1:
+                continue
+            available = np.ones(nb_nodes, dtype=bool)
+            available[node] = False
+            available[list(evaluated)] = False
+            candidates = np.flatnonzero(available)
+            in_top = available & np.isin(labels, np.argsort(-affinities[node])[:2])
+            if in_top.any():
+                candidates = np.flatnonzero(in_top)
+            nb_sources = min(
+                sources_per_node, len(candidates), nb_new_edges - len(new_sources)
+            )
+            for source in rng.choice(candidates, nb_sources, replace=False).tolist():
+                evaluated.add(source)
+                new_sources.append(source)
+                new_targets.append(int(node))
+        if len(new_sources) == 0:
+            break
+
+        sources = np.concatenate([sources, new_sources])
+        targets = np.concatenate([targets, new_targets])
+        comp_metrics = np.concatenate(
+            [comp_metrics, np.asarray(evaluate_edges(new_sources, new_targets))]
+        )
+        round_idx += 1
+        if verbose:
+            print(
+                f"Round {round_idx}: {len(sources)} edges, {labels.max() + 1} communities, mean uncertainty {uncertainty.mean():.3f}"
+            )
+    return sources, targets, comp_metrics
+
+
+def evaluate_edges_until_convergence(
+    nb_nodes: int,
+    evaluate_edges: Callable[[List[int], List[int]], np.ndarray],
+    sources: List[int],
+    targets: List[int],
+    round_size: Optional[int] = None,
+    ari_threshold: float = 0.95,
+    patience: int = 3,
+    weight_func: Optional[Callable] = None,
+    resolution: float = 1.0,
+    method: Literal["louvain", "leiden"] = "louvain",
+    seed: Optional[int] = None,
+    verbose: bool = False,
+) -> Tuple[
+    Int[np.ndarray, "edge"],
+    Int[np.ndarray, "edge"],
+    Float[np.ndarray, "edge"],
+    List[Dict[str, Any]],
+    bool,
+]:
+    """Evaluate the (source, target) edges by rounds of round_size edges (default: nb_nodes) drawn in random order, and stop once the communities stop changing: after each round, the communities of the partial graph are computed (see partial_graph_communities) and compared to the ones of the previous round with the adjusted Rand index. The evaluation stops when the ARI stays above ari_threshold for patience consecutive rounds, or when all the edges are evaluated.
+    Return the sources, the targets and the comparison metrics of the evaluated edges (sorted by target then source), the convergence trace (one dict per round with the number of edges, of communities and the ARI with the previous round) and whether the communities converged."""
+    rng = np.random.default_rng(seed)
+    if round_size is None:
+        round_size = nb_nodes
+    order = rng.permutation(len(sources))
+    sources_array = np.asarray(sources, dtype=np.int64)[order]
+    targets_array = np.asarray(targets, dtype=np.int64)[order]
+
+    comp_metrics = np.zeros(0)
+    trace: List[Dict[str, Any]] = []
+    previous_labels = None
+    nb_stable_rounds = 0
+    converged = False
+    nb_evaluated = 0
+    while nb_evaluated < len(sources_array):
+        end = min(nb_evaluated + round_size, len(sources_array))
+        comp_metrics = np.concatenate(
+            [
+                comp_metrics,
+                np.asarray(
+                    evaluate_edges(
+                        sources_array[nb_evaluated:end].tolist(),
+                        targets_array[nb_evaluated:end].tolist(),
+                    )
+                ),
+            ]
+        )
+        nb_evaluated = end
+        labels, _ = partial_graph_communities(
+            nb_nodes,
+            sources_array[:nb_evaluated],
+            targets_array[:nb_evaluated],
+            comp_metrics,
+            weight_func=weight_func,
+            resolution=resolution,
+            method=method,
+            seed=seed,
+        )
+        ari = np.nan
+        if previous_labels is not None:
+            ari = adjusted_rand_score(previous_labels, labels)
+        nb_stable_rounds = nb_stable_rounds + 1 if ari >= ari_threshold else 0
+        previous_labels = labels
+        trace.append(
+            {
+                "nb_edges": nb_evaluated,
+                "nb_communities": int(labels.max()) + 1,
+                "ari": ari,
+            }
+        )
+        if verbose:
+            print(
+                f"Round {len(trace)}: {nb_evaluated}/{len(sources_array)} edges, {labels.max() + 1} communities, ARI with the previous round {ari:.3f}"
+            )
+        if nb_stable_rounds >= patience:
+            converged = True
+            break
+
+    evaluated_order = np.lexsort(
+        (sources_array[:nb_evaluated], targets_array[:nb_evaluated])
+    )
+    return (
+        sources_array[:nb_evaluated][evaluated_order],
+        targets_array[:nb_evaluated][evaluated_order],
+        comp_metrics[evaluated_order],
+        trace,
+        converged,
+    )
+
+
 from networkx.algorithms import community
 
 
@@ -487,27 +2067,26 @@ class SgraphDataset:
 
 
 def compute_clustering_metrics(sgraph: "SwapGraph"):
-    """Compute the clustering metrics of the patching network."""
+    """Compute the clustering metrics of the patching network: the modularity of the communities and the average weight of the edges inside and between communities. Computed from the edge arrays, in linear time in the number of edges."""
     assert (
         sgraph.commu_labels is not None
     ), "You need to run pnet.compute_communities() first."
-    commu = [sgraph.commu_labels[i] for i in range(len(sgraph.tok_dataset))]
-
-    intra_cluster = []
-    exra_cluster = []
+    labels = np.array(
+        [sgraph.commu_labels[i] for i in range(len(sgraph.tok_dataset))]
+    )
 
-    for u, v, w in sgraph.edges:
-        if sgraph.commu_labels[u] == sgraph.commu_labels[v]:
-            intra_cluster.append(w)
-        else:
-            exra_cluster.append(w)
+    intra_cluster = (
+        labels[sgraph.edge_sources] == labels[sgraph.edge_targets]
+    )  # whether each edge is inside a community
 
     return {
-        "modularity": community.modularity(
-            sgraph.G_show, sgraph.commu, weight="weight", resolution=1
+        "modularity": directed_modularity(
+            sgraph.weight_matrix(), labels, resolution=1
+        ),
+        "intra_cluster": np.mean(sgraph.edge_weights[intra_cluster], dtype=np.float64),
+        "extra_cluster": np.mean(
+            sgraph.edge_weights[~intra_cluster], dtype=np.float64
         ),
-        "intra_cluster": np.mean(intra_cluster),
-        "extra_cluster": np.mean(exra_cluster),
     }
 
 
@@ -523,13 +2102,52 @@ class SwapGraph:
         kw_only=True  # the comparison metric between the logits of the patched model and the original model
     )
     proba_edge: float = field(default=0.1, kw_only=True)
-    batch_size: int = field(default=256, kw_only=True)
-    raw_edges: List[Tuple[int, int, float]] = field(init=False, default=None)
-    edges: List[Tuple[int, int, float]] = field(init=False, default=None)
-    all_comp_metrics: List[float] = field(init=False, default=None)
-    all_weights: List[float] = field(init=False)
-    G: nx.DiGraph = field(init=False, default=None)
-    G_show: nx.DiGraph = field(init=False, default=None)
+    nb_edges: Optional[int] = field(
+        default=None, kw_only=True
+    )  # if set, exactly nb_edges distinct edges are sampled instead of keeping each edge with probability proba_edge
+    sources_per_target: Optional[int] = field(
+        default=None, kw_only=True
+    )  # if set, each node is the target of exactly sources_per_target edges (fixed degree mode)
+    batch_size: Optional[int] = field(
+        default=256, kw_only=True
+    )  # if None, the batch size is planned from the free memory of the device
+    eval_position: Optional[WildPosition] = field(
+        default=None, kw_only=True
+    )  # the positions read by comp_metric. If set, only the reference log-probs at these positions are stored
+    incremental_engine: Optional[IncrementalPatchingEngine] = field(
+        default=None, kw_only=True
+    )  # if set, only the patched position is recomputed in the patched forward passes (requires eval_position)
+    cache_resid_pre: bool = field(
+        default=False, kw_only=True
+    )  # if True, the patched forward passes start from the cached clean residual stream at the patched layer
+    pipeline: bool = field(
+        default=False, kw_only=True
+    )  # if True, the batch inputs and the comparison metric are computed in background threads during the forward passes
+    seed: Optional[int] = field(
+        default=None, kw_only=True
+    )  # if set, the edge sampling and the community detection are deterministic
+    community_backend: CommunityBackend = field(
+        default="louvain", kw_only=True
+    )  # "louvain" or "leiden" on the CSR weight matrix, "networkx" for the networkx implementation of Louvain (to validate the other backends)
+    skip_equal_activations: Optional[float] = field(
+        default=None, kw_only=True
+    )  # if set, the edges whose source and target activations are equal within this tolerance are resolved without a forward pass
+    keep_activation_store: bool = field(
+        default=True, kw_only=True
+    )  # if True, the clean activations are kept after the build, such that grow only computes the ones of the new datapoints. Set to False to free them once the graph is built
+    activation_store: Optional[ActivationStore] = field(init=False, default=None)
+    edge_sources: Int[np.ndarray, "edge"] = field(
+        init=False, default=None
+    )  # the edges are stored as parallel arrays: edge i goes from edge_sources[i] to edge_targets[i]
+    edge_targets: Int[np.ndarray, "edge"] = field(init=False, default=None)
+    edge_comp_metrics: Float[np.ndarray, "edge"] = field(
+        init=False, default=None
+    )  # the output of the comparison metric for each edge
+    edge_weights: Float[np.ndarray, "edge"] = field(
+        init=False, default=None
+    )  # the weight of each edge in the graph, computed by compute_weights
+    _G: nx.DiGraph = field(init=False, default=None)
+    _G_show: nx.DiGraph = field(init=False, default=None)
     node_positions: Dict[int, np.ndarray] = field(init=False, default=None)
 
     commu: List[Set[int]] = field(
@@ -538,90 +2156,446 @@ class SwapGraph:
     commu_labels: Dict[int, int] = field(
         init=False, default=None
     )  # the label of the community of each node
+    convergence_trace: List[Dict[str, Any]] = field(
+        init=False, default=None
+    )  # set by build_until_convergence: the number of edges, of communities and the ARI with the previous round for each round
+    converged: Optional[bool] = field(
+        init=False, default=None
+    )  # set by build_until_convergence: whether the communities converged before all the sampled edges were evaluated
+    nb_skipped_edges: int = field(
+        init=False, default=0
+    )  # the number of edges resolved without a forward pass (see skip_equal_activations)
+
+    def sample_edges(self) -> Tuple[List[int], List[int]]:
+        """The (source, target) pairs of the graph, sampled according to proba_edge, nb_edges or sources_per_target (deterministic if seed is set)."""
+        generator = None
+        if self.seed is not None:
+            generator = torch.Generator().manual_seed(self.seed)
+        return sample_edges(
+            len(self.tok_dataset),
+            proba_edge=self.proba_edge,
+            nb_edges=self.nb_edges,
+            sources_per_target=self.sources_per_target,
+            generator=generator,
+        )
 
     def build(
         self,
         additional_info_gathering: Optional[Callable] = None,
         verbose: bool = False,
         progress_bar: bool = True,
+        edge_log_path: Optional[str] = None,
+        checkpoint_every: int = 10,
     ):
-        edges = []
-        source_IDs = []
-        target_IDs = []
-        for i in range(len(self.tok_dataset)):
-            for j, y in enumerate(self.tok_dataset):
-                if torch.rand(1) > self.proba_edge:
-                    continue
-                if i == j:
-                    continue
-                source_IDs.append(j)
-                target_IDs.append(i)
+        """Sample the edges and compute their comparison metric. If edge_log_path is given, the graph is built with build_stream: the evaluated edges are saved to the edge log as they finish, and the edges already in the log are not recomputed."""
+        if edge_log_path is not None:
+            for _ in self.build_stream(
+                edge_log_path=edge_log_path,
+                checkpoint_every=checkpoint_every,
+                additional_info_gathering=additional_info_gathering,
+                verbose=verbose,
+                progress_bar=progress_bar,
+            ):
+                pass
+            return
+
+        self.nb_skipped_edges = 0
+        source_IDs, target_IDs = self.sample_edges()
         if verbose:
-            print(f"Number of edges: {len(edges)}")
+            print(f"Number of edges: {len(source_IDs)}")
 
-        weights = compute_batched_weights(
-            self.model,
-            self.tok_dataset,
+        comp_metrics = self.evaluate_edges(
             source_IDs,
             target_IDs,
-            self.batch_size,
-            self.patchedComponents,
-            self.comp_metric,
-            additional_info_gathering,
-            verbose,
+            additional_info_gathering=additional_info_gathering,
+            verbose=verbose,
             progress_bar=progress_bar,
-        ).tolist()
+        )
 
-        self.raw_edges = list(
-            zip(source_IDs, target_IDs, weights)
+        self.set_edges(
+            np.array(source_IDs), np.array(target_IDs), comp_metrics
         )  # the raw edges, the ones with the output from the comparison metric. Before plotting the edges need to go through a post-processing step to get the weight of the graph.
-        self.all_comp_metrics = [x[2] for x in self.raw_edges]
-
-        self.G = nx.DiGraph()
-        for i in range(len(self.tok_dataset)):
-            self.G.add_node(i, label=str(i))
 
-        for u, v, w in self.raw_edges:
-            self.G.add_edge(
-                u,
-                v,
-                weight=w,
+    def build_stream(
+        self,
+        edge_log_path: Optional[str] = None,
+        chunk_size: Optional[int] = None,
+        checkpoint_every: int = 10,
+        additional_info_gathering: Optional[Callable] = None,
+        verbose: bool = False,
+        progress_bar: bool = True,
+    ) -> Iterator[
+        Tuple[Int[np.ndarray, "edge"], Int[np.ndarray, "edge"], Float[np.ndarray, "edge"]]
+    ]:
+        """Build the graph by chunks of chunk_size edges (default: the batch size), yielding the sources, targets and comparison metrics of each chunk as soon as it is evaluated. The edges are stored in the graph once the generator is exhausted.
+        If edge_log_path is given, the evaluated edges are appended to this edge log every checkpoint_every chunks (and when the build ends or is interrupted), and the sampled edges already in the log are loaded instead of being recomputed. Resuming requires the same sampled edges, i.e. a seed or proba_edge = 1."""
+        self.nb_skipped_edges = 0
+        source_IDs, target_IDs = self.sample_edges()
+        nb_nodes = len(self.tok_dataset)
+        sources = np.array(source_IDs, dtype=np.int64)
+        targets = np.array(target_IDs, dtype=np.int64)
+        pair_ids = targets * nb_nodes + sources
+
+        done_sources = done_targets = np.zeros(0, dtype=np.int64)
+        done_comp_metrics = np.zeros(0, dtype=np.float32)
+        if edge_log_path is not None:
+            done_sources, done_targets, done_comp_metrics = load_edge_log(
+                edge_log_path
+            )
+        done_pair_ids, first_idx = np.unique(
+            done_targets * nb_nodes + done_sources, return_index=True
+        )
+        in_sample = np.isin(done_pair_ids, pair_ids)
+        done_pair_ids = done_pair_ids[in_sample]
+        all_sources = [done_sources[first_idx][in_sample]]
+        all_targets = [done_targets[first_idx][in_sample]]
+        all_comp_metrics = [done_comp_metrics[first_idx][in_sample]]
+        remaining = ~np.isin(pair_ids, done_pair_ids)
+        sources, targets = sources[remaining], targets[remaining]
+        if verbose:
+            print(
+                f"Number of edges: {len(source_IDs)}, {len(source_IDs) - len(sources)} loaded from the edge log"
             )
 
-    def compute_weights(self, func: Optional[Callable[[float], float]] = None):
-        """Compute the weights of the edges for network display with force-based visualization."""
-        assert (
-            self.raw_edges is not None
-        ), "You need to build the network before computing the weights. Call build() first."
+        activation_store = None
+        if len(sources) > 0:
+            activation_store = self.get_activation_store()
+            if chunk_size is None:
+                chunk_size = activation_store.batch_size
+        to_log: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+        def flush_log():
+            if edge_log_path is not None and len(to_log) > 0:
+                append_edge_log(
+                    edge_log_path, *[np.concatenate(x) for x in zip(*to_log)]
+                )
+                to_log.clear()
 
-        if func is None:
-            func = partial(
-                gaussian_kernel,
-                sigma=np.percentile(
-                    self.all_comp_metrics, 25
-                ),  # hard coded default to have a reasonable kernel to got from KL to graph weights
+        try:
+            for chunk_idx, start in enumerate(
+                tqdm.tqdm(
+                    range(0, len(sources), chunk_size or 1), disable=not progress_bar
+                )
+            ):
+                chunk = (
+                    sources[start : start + chunk_size],
+                    targets[start : start + chunk_size],
+                    self.evaluate_edges(
+                        sources[start : start + chunk_size].tolist(),
+                        targets[start : start + chunk_size].tolist(),
+                        additional_info_gathering=additional_info_gathering,
+                        verbose=verbose,
+                        progress_bar=False,
+                        activation_store=activation_store,
+                    ),
+                )
+                all_sources.append(chunk[0])
+                all_targets.append(chunk[1])
+                all_comp_metrics.append(chunk[2])
+                to_log.append(chunk)
+                if (chunk_idx + 1) % checkpoint_every == 0:
+                    flush_log()
+                yield chunk
+        finally:  # also keep the evaluated edges if the build is interrupted
+            flush_log()
+
+        sources = np.concatenate(all_sources)
+        targets = np.concatenate(all_targets)
+        order = np.lexsort((sources, targets))
+        self.set_edges(
+            sources[order], targets[order], np.concatenate(all_comp_metrics)[order]
+        )
+
+    def build_until_convergence(
+        self,
+        round_size: Optional[int] = None,
+        ari_threshold: float = 0.95,
+        patience: int = 3,
+        resolution: float = 1.0,
+        verbose: bool = False,
+        progress_bar: bool = False,
+    ):
+        """Build the graph by rounds of round_size of the sampled edges, and stop once the communities of the partial graph stay stable (ARI with the previous round above ari_threshold for patience rounds, see evaluate_edges_until_convergence). The graph only keeps the evaluated edges. The rounds are recorded in convergence_trace and converged."""
+        source_IDs, target_IDs = self.sample_edges()
+        activation_store = self.get_activation_store()
+        backend = self.community_backend
+        self.nb_skipped_edges = 0
+        (
+            sources,
+            targets,
+            comp_metrics,
+            self.convergence_trace,
+            self.converged,
+        ) = evaluate_edges_until_convergence(
+            len(self.tok_dataset),
+            partial(
+                self.evaluate_edges,
+                verbose=verbose,
+                progress_bar=progress_bar,
+                activation_store=activation_store,
+            ),
+            source_IDs,
+            target_IDs,
+            round_size=round_size,
+            ari_threshold=ari_threshold,
+            patience=patience,
+            resolution=resolution,
+            method="louvain" if backend == "networkx" else backend,
+            seed=self.seed,
+            verbose=verbose,
+        )
+        if verbose:
+            print(
+                f"Number of edges: {len(sources)}/{len(source_IDs)} in {len(self.convergence_trace)} rounds"
+            )
+        self.set_edges(sources, targets, comp_metrics)
+
+    def get_activation_store(self) -> ActivationStore:
+        """The activation store of the clean activations of the patched components, to share between several calls of evaluate_edges. If keep_activation_store, it is created once and kept in activation_store."""
+        if self.activation_store is not None:
+            if self.activation_store.listOfComponents != self.patchedComponents:
+                self.activation_store.change_component_list(self.patchedComponents)
+            return self.activation_store
+        batch_size = self.batch_size
+        if batch_size is None:
+            batch_size = plan_batch_size(
+                self.model,
+                self.tok_dataset.shape[1],
+                full_logits=self.eval_position is None,
+                components=self.patchedComponents,
+                nb_cached_rows=len(self.tok_dataset),
             )
+        activation_store = ActivationStore(
+            model=self.model,
+            dataset=self.tok_dataset,
+            listOfComponents=self.patchedComponents,
+            batch_size=batch_size,
+            eval_position=self.eval_position,
+            cache_resid_pre=self.cache_resid_pre,
+        )
+        if self.keep_activation_store:
+            self.activation_store = activation_store
+        return activation_store
 
-        self.edges = []
-        self.all_weights = []
-        for source, target, comp_metric in self.raw_edges:
-            self.edges.append((source, target, func(comp_metric)))
-            self.all_weights.append(func(comp_metric))
+    def evaluate_edges(
+        self,
+        source_IDs: List[int],
+        target_IDs: List[int],
+        additional_info_gathering: Optional[Callable] = None,
+        verbose: bool = False,
+        progress_bar: bool = True,
+        activation_store: Optional[ActivationStore] = None,
+    ) -> Float[np.ndarray, "edge"]:
+        """Run the patched forward passes of the (source, target) pairs and return their comparison metric. The edges skipped because of equal activations are counted in nb_skipped_edges."""
+        if activation_store is None:
+            activation_store = self.get_activation_store()
+        nb_skipped_forwards = activation_store.nb_skipped_forwards
+        comp_metrics = (
+            compute_batched_weights(
+                self.model,
+                self.tok_dataset,
+                source_IDs,
+                target_IDs,
+                self.batch_size,
+                self.patchedComponents,
+                self.comp_metric,
+                additional_info_gathering,
+                verbose,
+                activation_store=activation_store,
+                progress_bar=progress_bar,
+                eval_position=self.eval_position,
+                incremental_engine=self.incremental_engine,
+                cache_resid_pre=self.cache_resid_pre,
+                pipeline=self.pipeline,
+                skip_equal_activations=self.skip_equal_activations,
+            )
+            .detach()
+            .cpu()
+            .numpy()
+        )
+        self.nb_skipped_edges += (
+            activation_store.nb_skipped_forwards - nb_skipped_forwards
+        )
+        return comp_metrics
+
+    def build_active(
+        self,
+        edge_budget: int,
+        initial_sources_per_target: int = 5,
+        round_size: Optional[int] = None,
+        sources_per_node: int = 4,
+        resolution: float = 1.0,
+        verbose: bool = False,
+        progress_bar: bool = False,
+    ):
+        """Build the graph with at most edge_budget patched forward passes, spent on the edges that decide the community of the uncertain nodes (see active_edge_sampling). proba_edge, nb_edges and sources_per_target are ignored."""
+        activation_store = self.get_activation_store()
+        backend = self.community_backend
+        self.nb_skipped_edges = 0
+        sources, targets, comp_metrics = active_edge_sampling(
+            len(self.tok_dataset),
+            partial(
+                self.evaluate_edges,
+                verbose=verbose,
+                progress_bar=progress_bar,
+                activation_store=activation_store,
+            ),
+            edge_budget,
+            initial_sources_per_target=initial_sources_per_target,
+            round_size=round_size,
+            sources_per_node=sources_per_node,
+            resolution=resolution,
+            method="louvain" if backend == "networkx" else backend,
+            seed=self.seed,
+            verbose=verbose,
+        )
+        if verbose:
+            print(f"Number of edges: {len(sources)}")
+        self.set_edges(sources, targets, comp_metrics)
 
-        self.G_show = nx.DiGraph()
+    def set_edges(
+        self,
+        sources: Int[np.ndarray, "edge"],
+        targets: Int[np.ndarray, "edge"],
+        comp_metrics: Float[np.ndarray, "edge"],
+    ):
+        """Store the edges and their comparison metric. The weights and the networkx graphs are reset."""
+        self.edge_sources = np.asarray(sources, dtype=np.int32)
+        self.edge_targets = np.asarray(targets, dtype=np.int32)
+        self.edge_comp_metrics = np.asarray(comp_metrics, dtype=np.float32)
+        self.edge_weights = None
+        self._G = None
+        self._G_show = None
+
+    @property
+    def raw_edges(self) -> Optional[List[Tuple[int, int, float]]]:
+        """The (source, target, comp_metric) tuples of the edges."""
+        if self.edge_comp_metrics is None:
+            return None
+        return list(
+            zip(
+                self.edge_sources.tolist(),
+                self.edge_targets.tolist(),
+                self.edge_comp_metrics.tolist(),
+            )
+        )
 
-        for i in range(len(self.tok_dataset)):
-            self.G_show.add_node(i, label=str(i), color="red", node_color="r")
+    @property
+    def edges(self) -> Optional[List[Tuple[int, int, float]]]:
+        """The (source, target, weight) tuples of the edges."""
+        if self.edge_weights is None:
+            return None
+        return list(
+            zip(
+                self.edge_sources.tolist(),
+                self.edge_targets.tolist(),
+                self.edge_weights.tolist(),
+            )
+        )
 
-        for u, v, w in self.edges:
-            if w == 0:
-                continue
-            self.G_show.add_edge(
-                u,
-                v,
-                weight=w,
-                penwidth=w,
+    @property
+    def all_comp_metrics(self) -> Optional[List[float]]:
+        if self.edge_comp_metrics is None:
+            return None
+        return self.edge_comp_metrics.tolist()
+
+    @property
+    def all_weights(self) -> Optional[List[float]]:
+        if self.edge_weights is None:
+            return None
+        return self.edge_weights.tolist()
+
+    @property
+    def G(self) -> nx.DiGraph:
+        """The graph weighted by the comparison metric. Only built when it is first accessed."""
+        assert (
+            self.edge_comp_metrics is not None
+        ), "You need to build the network first. Call build() first."
+        if self._G is None:
+            self._G = nx.DiGraph()
+            self._G.add_nodes_from(
+                (i, {"label": str(i)}) for i in range(len(self.tok_dataset))
             )
+            self._G.add_weighted_edges_from(self.raw_edges)  # type: ignore
+        return self._G
+
+    @property
+    def G_show(self) -> nx.DiGraph:
+        """The graph weighted by the edge weights, without the edges of weight 0. Only built when it is first accessed."""
+        assert (
+            self.edge_weights is not None
+        ), "You need to compute the weights of the edges first. Call build() and compute_weights() first."
+        if self._G_show is None:
+            self._G_show = nx.DiGraph()
+            self._G_show.add_nodes_from(
+                (i, {"label": str(i), "color": "red", "node_color": "r"})
+                for i in range(len(self.tok_dataset))
+            )
+            nonzero = self.edge_weights != 0
+            self._G_show.add_edges_from(
+                (u, v, {"weight": w, "penwidth": w})
+                for u, v, w in zip(
+                    self.edge_sources[nonzero].tolist(),
+                    self.edge_targets[nonzero].tolist(),
+                    self.edge_weights[nonzero].tolist(),
+                )
+            )
+        return self._G_show
+
+    def weight_matrix(self) -> scipy.sparse.csr_matrix:
+        """The [nb_nodes, nb_nodes] CSR matrix of the edge weights (source, target), without the edges of weight 0."""
+        assert (
+            self.edge_weights is not None
+        ), "You need to compute the weights of the edges first. Call build() and compute_weights() first."
+        nb_nodes = len(self.tok_dataset)
+        nonzero = self.edge_weights != 0
+        return scipy.sparse.csr_matrix(
+            (
+                self.edge_weights[nonzero],
+                (self.edge_sources[nonzero], self.edge_targets[nonzero]),
+            ),
+            shape=(nb_nodes, nb_nodes),
+        )
+
+    def compute_weights(self, func: Optional[Callable[[float], float]] = None):
+        """Compute the weights of the edges for network display with force-based visualization. func is applied to the array of comparison metrics, or element by element if it doesn't support arrays."""
+        assert (
+            self.edge_comp_metrics is not None
+        ), "You need to build the network before computing the weights. Call build() first."
+
+        if func is None:
+            func = default_weight_func(self.edge_comp_metrics)
+
+        try:
+            weights = np.asarray(func(self.edge_comp_metrics))  # type: ignore
+        except TypeError:
+            weights = None
+        if weights is None or weights.shape != self.edge_comp_metrics.shape:
+            weights = np.array([func(x) for x in self.edge_comp_metrics.tolist()])
+        self.edge_weights = weights.astype(np.float32)
+        self._G_show = None
+
+    def compute_layout(
+        self,
+        iterations: int = 100,
+        initial_positions: Optional[
+            Union[Dict[int, np.ndarray], Float[np.ndarray, "node 2"]]
+        ] = None,
+        k: float = 0.5,
+        barnes_hut: Optional[bool] = None,
+        seed: Optional[int] = None,
+    ) -> Dict[int, np.ndarray]:
+        """Compute the positions of the nodes for display with the force-directed layout of swap_graphs.layout (Barnes-Hut approximation by default above 2000 nodes). initial_positions warm-starts the layout, e.g. with the node_positions of a swap graph of another component on the same dataset: the layout is then refined in a few iterations instead of computed from scratch, and the plots of the components are aligned."""
+        positions = force_directed_layout(
+            self.weight_matrix(),
+            initial_positions=initial_positions,
+            k=k,
+            iterations=iterations,
+            barnes_hut=barnes_hut,
+            seed=seed,
+        )
+        self.node_positions = dict(enumerate(positions))
+        return self.node_positions
 
     def show(  # OLD FUNCTION, DEPRECIATED. USE show_html() INSTEAD
         self,
@@ -631,11 +2605,12 @@ class SwapGraph:
         with_labels: bool = False,
         recompute_positions: bool = False,
         iterations: int = 50,
+        initial_positions: Optional[Dict[int, np.ndarray]] = None,
         labels: Optional[Union[List[str], Dict[int, str]]] = None,
         save_path: Optional[str] = None,
     ):
         assert (
-            self.edges is not None
+            self.edge_weights is not None
         ), "You need to compute the weights of the edges before displaying them. Call build() and compute_weights() first."
 
         if color_discrete:
@@ -644,8 +2619,8 @@ class SwapGraph:
             cmap = plt.cm.viridis  # type: ignore
 
         if self.node_positions is None or recompute_positions:
-            self.node_positions = nx.spring_layout(  # type: ignore
-                self.G_show, k=0.5, iterations=iterations
+            self.compute_layout(
+                iterations=iterations, initial_positions=initial_positions
             )
 
         nx.draw_networkx_nodes(  # type: ignore
@@ -685,16 +2660,17 @@ class SwapGraph:
         feature_name: Optional[str] = None,
         recompute_positions: bool = False,
         iterations: int = 100,
+        initial_positions: Optional[Dict[int, np.ndarray]] = None,
         color_discrete=True,
         **kwargs,
     ):
         assert (
-            self.edges is not None
+            self.edge_weights is not None
         ), "You need to compute the weights of the edges before displaying them. Call build() and compute_weights() first."
 
         if self.node_positions is None or recompute_positions:
-            self.node_positions = nx.spring_layout(  # type: ignore
-                self.G_show, k=0.5, iterations=iterations
+            self.compute_layout(
+                iterations=iterations, initial_positions=initial_positions
             )
 
         color_dict = (
@@ -851,41 +2827,167 @@ class SwapGraph:
         if not display:
             return fig
 
-    def compute_communities(self, resolution: float = 1.0):
-        """Compute the communities of the graph using the Louvain algorithm. Return a function to be used as a color map for the nodes."""
+    def compute_communities(
+        self, resolution: float = 1.0, backend: Optional[CommunityBackend] = None
+    ) -> Int[np.ndarray, "node"]:
+        """Compute the communities of the graph by modularity maximization, with the backend community_backend (if backend is None). Return the array of the community label of each node, to be used as a color map for the nodes."""
         assert (
-            self.edges is not None
+            self.edge_weights is not None
         ), "You need to compute the weights of the edges before displaying them. Call build() and compute_weights() first."
 
-        self.commu = community.louvain_communities(self.G_show, resolution=resolution)
-        self.commu_labels = {}
-        for i, c in enumerate(self.commu):
-            for n in c:
-                self.commu_labels[n] = i
+        if backend is None:
+            backend = self.community_backend
+        if backend == "networkx":
+            commu = community.louvain_communities(
+                self.G_show, resolution=resolution, seed=self.seed
+            )
+            labels = np.zeros(len(self.tok_dataset), dtype=np.int64)
+            for i, c in enumerate(commu):
+                labels[list(c)] = i
+        else:
+            labels = detect_communities(
+                self.weight_matrix(),
+                resolution=resolution,
+                method=backend,
+                seed=self.seed,
+            )
+
+        self.commu = [
+            set(np.flatnonzero(labels == i).tolist()) for i in range(labels.max() + 1)
+        ]
+        self.commu_labels = dict(enumerate(labels.tolist()))
+        return labels
+
+    def grow(
+        self,
+        new_tok_dataset: Float[torch.Tensor, "batch pos"],
+        new_display_dataset: Optional[List[str]] = None,
+        patchedComponents: Optional[List[ModelComponent]] = None,
+        eval_position: Optional[WildPosition] = None,
+        comp_metric: Optional[CompMetric] = None,
+        weight_func: Optional[Callable[[float], float]] = None,
+        resolution: float = 1.0,
+        verbose: bool = False,
+        progress_bar: bool = True,
+    ) -> Optional[Dict[str, float]]:
+        """Add the datapoints new_tok_dataset to a built graph, only running the patched forward passes of the new edges (new -> old, old -> new and new -> new), sampled as in build with the density of the existing graph. The clean activations are only computed for the new datapoints, unless the activation store was freed (keep_activation_store=False).
+        If the positions of the patched components, eval_position or comp_metric depend on the datapoint, pass new ones covering the whole grown dataset.
+        If the weights (resp. the communities) were computed, they are recomputed on the grown graph, with weight_func (resp. resolution). Return the clustering metrics of the grown graph if the communities were computed."""
+        assert (
+            self.edge_comp_metrics is not None
+        ), "You need to build the network before growing it. Call build() first."
+        assert new_tok_dataset.shape[1] == self.tok_dataset.shape[1]
+        nb_old_nodes = len(self.tok_dataset)
+        nb_old_pairs = nb_old_nodes * (nb_old_nodes - 1)
+        had_weights = self.edge_weights is not None
+        had_communities = self.commu_labels is not None
+
+        self.tok_dataset = torch.cat(
+            [self.tok_dataset, new_tok_dataset.to(self.tok_dataset.device)]
+        )
+        if new_display_dataset is not None:
+            self.display_dataset = self.display_dataset + new_display_dataset
+        if patchedComponents is not None:
+            self.patchedComponents = patchedComponents
+        if eval_position is not None:
+            self.eval_position = eval_position
+        if comp_metric is not None:
+            self.comp_metric = comp_metric
+
+        if self.activation_store is not None:
+            self.activation_store.listOfComponents = self.patchedComponents
+            self.activation_store.eval_position = self.eval_position
+            self.activation_store.extend(new_tok_dataset)
+        if self.incremental_engine is not None:
+            if eval_position is not None:
+                self.incremental_engine.position = eval_position
+            self.incremental_engine.extend(new_tok_dataset)
+
+        generator = None
+        if self.seed is not None:
+            generator = torch.Generator().manual_seed(self.seed + nb_old_nodes)
+        proba_edge = min(
+            1.0, len(self.edge_comp_metrics) / max(1, nb_old_pairs)
+        )  # the density of the graph sampled by build
+        source_IDs, target_IDs = sample_edges_to_new_nodes(
+            nb_old_nodes,
+            len(self.tok_dataset),
+            proba_edge=proba_edge,
+            sources_per_target=self.sources_per_target,
+            generator=generator,
+        )
+        if verbose:
+            print(
+                f"Number of new edges: {len(source_IDs)} ({len(source_IDs) / max(1, len(self.edge_comp_metrics)):.0%} of the existing edges)"
+            )
+        comp_metrics = self.evaluate_edges(
+            source_IDs,
+            target_IDs,
+            verbose=verbose,
+            progress_bar=progress_bar,
+            activation_store=self.get_activation_store(),
+        )
+
+        sources = np.concatenate([self.edge_sources, source_IDs]).astype(np.int64)
+        targets = np.concatenate([self.edge_targets, target_IDs]).astype(np.int64)
+        order = np.lexsort((sources, targets))
+        self.set_edges(
+            sources[order],
+            targets[order],
+            np.concatenate([self.edge_comp_metrics, comp_metrics])[order],
+        )
+        self.node_positions = None
+        self.commu = None
+        self.commu_labels = None
 
-        return [self.commu_labels[i] for i in range(len(self.tok_dataset))]
+        if had_weights:
+            self.compute_weights(weight_func)
+        if had_communities and had_weights:
+            self.compute_communities(resolution=resolution)
+            return compute_clustering_metrics(self)
+        return None
 
     def load_comp_metric_edges(self, comp_metric_values: List[Tuple[int, int, float]]):
-        for u, v, w in comp_metric_values:
-            assert u < len(self.tok_dataset), "Wrong samples idx"
-            assert v < len(self.tok_dataset), "Wrong samples idx"
-            assert isinstance(w, float), "Wrong weight type"
-        self.raw_edges = comp_metric_values
-        self.all_comp_metrics = [w for x, y, w in self.raw_edges]
+        edges = np.array(comp_metric_values, dtype=np.float64).reshape(-1, 3)
+        sources, targets = edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64)
+        assert (sources < len(self.tok_dataset)).all(), "Wrong samples idx"
+        assert (targets < len(self.tok_dataset)).all(), "Wrong samples idx"
+        self.set_edges(sources, targets, edges[:, 2])
 
 
 def find_important_components(
     model: HookedTransformer,
     dataset: Float[torch.Tensor, "batch pos"],
-    batch_size: int,
+    batch_size: Optional[int],
     components_to_search: List[ModelComponent],
     comp_metric: CompMetric,
     verbose: bool = False,
     output_shape: Optional[Tuple[int, int]] = None,
     nb_samples: int = 100,
     force_cache_all: bool = False,
+    slice_positions: bool = False,
+    cache_dir: Optional[str] = None,
+    cache_version: Optional[str] = None,
+    cache_budget_bytes: Optional[int] = None,
+    eval_position: Optional[WildPosition] = None,
+    incremental_engine: Optional[IncrementalPatchingEngine] = None,
+    cache_resid_pre: bool = False,
+    multiplex_components: bool = False,
+    pipeline: bool = False,
+    skip_equal_activations: Optional[float] = None,
 ):
-    """Got through the components_to_search one by one and find the components that leads to the most significant change in the output of the model. This can be seen as computing a random subset of size nb_samples of the weight of the swap graph for each element and choose the one with the highest average weights."""
+    """Got through the components_to_search one by one and find the components that leads to the most significant change in the output of the model. This can be seen as computing a random subset of size nb_samples of the weight of the swap graph for each element and choose the one with the highest average weights.
+    If multiplex_components, the pairs of batch_size // nb_samples components are packed in the same forward passes, each row being patched on its own component.
+    If batch_size is None, it is planned from the free memory of the device (see plan_batch_size).
+    skip_equal_activations is passed to compute_batched_weights, the number of skipped forward passes is printed if verbose."""
+    if batch_size is None:
+        batch_size = plan_batch_size(
+            model,
+            dataset.shape[1],
+            full_logits=eval_position is None,
+            components=components_to_search[:1],
+            nb_cached_rows=len(dataset),
+        )
 
     results = []
     activation_store = ActivationStore(
@@ -893,27 +2995,71 @@ def find_important_components(
         dataset=dataset,
         listOfComponents=[components_to_search[0]],
         force_cache_all=force_cache_all,
+        slice_positions=slice_positions,
+        batch_size=batch_size,
+        cache_dir=cache_dir,
+        cache_version=cache_version,
+        cache_budget_bytes=cache_budget_bytes,
+        eval_position=eval_position,
+        cache_resid_pre=cache_resid_pre,
     )
     target_IDs = [rd.randint(0, len(dataset) - 1) for i in range(nb_samples)]
     source_IDs = [rd.randint(0, len(dataset) - 1) for i in range(nb_samples)]
 
-    for i in tqdm.tqdm(range(len(components_to_search))):
-        component = components_to_search[i]
-        activation_store.change_component_list([component])
-        weights = compute_batched_weights(
-            model=model,
-            dataset=dataset,
-            source_IDs=source_IDs,
-            target_IDs=target_IDs,
-            batch_size=batch_size,
-            components_to_patch=[component],
-            comp_metric=comp_metric,
-            verbose=verbose,
-            activation_store=activation_store,
-            progress_bar=False,
-        )
+    if multiplex_components:
+        assert incremental_engine is None
+        nb_multiplexed = max(1, batch_size // nb_samples)
+        for i in tqdm.tqdm(range(0, len(components_to_search), nb_multiplexed)):
+            components = components_to_search[i : i + nb_multiplexed]
+            activation_store.change_component_list(
+                components, prefetch=components_to_search[i + nb_multiplexed :]
+            )
+            weights = compute_batched_weights(
+                model=model,
+                dataset=dataset,
+                source_IDs=source_IDs * len(components),
+                target_IDs=target_IDs * len(components),
+                batch_size=batch_size,
+                components_to_patch=components,
+                comp_metric=comp_metric,
+                verbose=verbose,
+                activation_store=activation_store,
+                progress_bar=False,
+                eval_position=eval_position,
+                row_components=[c for c in components for _ in range(nb_samples)],
+                pipeline=pipeline,
+                skip_equal_activations=skip_equal_activations,
+            )
+            results += list(torch.split(weights, nb_samples))
+    else:
+        for i in tqdm.tqdm(range(len(components_to_search))):
+            component = components_to_search[i]
+            activation_store.change_component_list(
+                [component], prefetch=components_to_search[i + 1 :]
+            )  # with a cache budget, the hooks of the next components are computed in the same forward pass
+            weights = compute_batched_weights(
+                model=model,
+                dataset=dataset,
+                source_IDs=source_IDs,
+                target_IDs=target_IDs,
+                batch_size=batch_size,
+                components_to_patch=[component],
+                comp_metric=comp_metric,
+                verbose=verbose,
+                activation_store=activation_store,
+                progress_bar=False,
+                eval_position=eval_position,
+                incremental_engine=incremental_engine,
+                pipeline=pipeline,
+                skip_equal_activations=skip_equal_activations,
+            )
+
+            results.append(weights)
 
-        results.append(weights)
+    if skip_equal_activations is not None and verbose:
+        print(
+            f"Skipped {activation_store.nb_skipped_forwards}/{len(components_to_search) * nb_samples} forward passes with equal source and target activations"
+        )
 
     if output_shape is None:
         output_shape = (len(components_to_search), nb_samples)
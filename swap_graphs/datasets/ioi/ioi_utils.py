@@ -3,7 +3,7 @@ from .ioi_dataset import IOIDataset, OBJECTS, PLACES, NAMES_GENDER
 import torch
 from jaxtyping import Float, Int
 from typing import Callable, List, Union, Optional, Tuple, Dict, Any, Sequence, Optional
-from swap_graphs.core import WildPosition, objects_to_strings
+from swap_graphs.core import WildPosition, objects_to_strings, logits_at_positions
 
 
 def handle_all_and_std(returning, all, std):
@@ -120,40 +120,38 @@ def logit_diff_comp(
     #     len(ioi_dataset.io_tokenIDs[target_idx]),
     # )
 
+    # logits at the END position. The logit differences are invariant to the log_softmax, so the reference can be log-probs
+    logits_target = logits_at_positions(logits_target, position_to_evaluate, target_idx)
+    logits_source = logits_at_positions(logits_source, position_to_evaluate, target_idx)
+
     IO_logits_target = logits_target[
         torch.arange(len(target_seqs)),
-        position_to_evaluate.positions_from_idx(target_idx),
         ioi_dataset.io_tokenIDs[target_idx],
     ]
 
     S_logits_target = logits_target[
         torch.arange(len(target_seqs)),
-        position_to_evaluate.positions_from_idx(target_idx),
         ioi_dataset.s_tokenIDs[target_idx],
     ]
 
     IO_logits_source = logits_source[
         torch.arange(len(target_seqs)),
-        position_to_evaluate.positions_from_idx(target_idx),
         ioi_dataset.io_tokenIDs[target_idx],
     ]
 
     S_logits_source = logits_source[
         torch.arange(len(target_seqs)),
-        position_to_evaluate.positions_from_idx(target_idx),
         ioi_dataset.s_tokenIDs[target_idx],
     ]
 
     if ioi_dataset.wild_template:
         IO2_logits_source = logits_source[
             torch.arange(len(target_seqs)),
-            position_to_evaluate.positions_from_idx(target_idx),
             ioi_dataset.io2_tokenIDs[target_idx],
         ]
 
         IO2_logits_target = logits_target[
             torch.arange(len(target_seqs)),
-            position_to_evaluate.positions_from_idx(target_idx),
             ioi_dataset.io2_tokenIDs[target_idx],
         ]
 
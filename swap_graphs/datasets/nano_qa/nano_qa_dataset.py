@@ -19,7 +19,13 @@ from swap_graphs.datasets.nano_qa.nano_qa_utils import (
 
 from swap_graphs.utils import wrap_str
 
-from swap_graphs.core import objects_to_unique_ids, objects_to_strings, WildPosition
+from swap_graphs.core import (
+    objects_to_unique_ids,
+    objects_to_strings,
+    WildPosition,
+    plan_batch_size,
+    run_batches_with_backoff,
+)
 
 import attrs
 from typing import Dict, List, Optional, Callable, Union
@@ -244,21 +250,27 @@ def evaluate_model(
     nano_qa_dataset: NanoQADataset,
     logits: Optional[torch.Tensor] = None,
     end_position: Optional[WildPosition] = None,
-    batch_size=10,
+    batch_size: Optional[int] = 10,
     all=False,
     print=False,
 ):
+    """Evaluate the model on the nanoQA questions. If batch_size is None, it is planned from the free memory of the device."""
     if logits is None:
         logits = torch.zeros(
             (nano_qa_dataset.nb_samples, model.cfg.n_ctx, model.cfg.d_vocab_out)
         )
+        if batch_size is None:
+            batch_size = plan_batch_size(model, nano_qa_dataset.prompts_tok.shape[1])
 
-        for i in tqdm(range(0, nano_qa_dataset.nb_samples, batch_size)):
-            batch = nano_qa_dataset.prompts_text[i : i + batch_size]
-            batch_logits = model(batch, prepend_bos=False)
-            logits[i : i + len(batch), : batch_logits.shape[1]] = model(
-                batch, prepend_bos=False
+        def run_batch(start: int, end: int):
+            batch_logits = model(
+                nano_qa_dataset.prompts_text[start:end], prepend_bos=False
             )
+            logits[start:end, : batch_logits.shape[1]] = batch_logits.cpu()
+
+        run_batches_with_backoff(
+            nano_qa_dataset.nb_samples, batch_size, run_batch, progress_bar=True
+        )
     if end_position is None:
         end_position = WildPosition(position=nano_qa_dataset.word_idx["END"], label="END")
 
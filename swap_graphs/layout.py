@@ -0,0 +1,228 @@
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+import scipy.sparse
+from jaxtyping import Float, Int
+
+NEIGHBOR_OFFSETS = np.array(
+    [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+)  # the 3x3 block of cells around a cell, itself included
+CHILDREN_OF_PARENT_NEIGHBORS = np.array(
+    [(dx, dy) for dx in range(-2, 4) for dy in range(-2, 4)]
+)  # the 6x6 block of cells of a level covered by the 3x3 neighbors of a parent cell, relative to its first child
+
+
+def displacement_exact(
+    pos: Float[np.ndarray, "node 2"],
+    k: float,
+    dense_weights: Optional[Float[np.ndarray, "node node"]] = None,
+    max_chunk_numel: int = 2**22,
+) -> Float[np.ndarray, "node 2"]:
+    """The repulsive displacement k^2 * delta / |delta|^2 summed over all the other nodes, plus the attractive displacement -w * |delta| * delta / k if the dense matrix of weights is given. Computed by chunks of rows, such that the [chunk, node] arrays fit in max_chunk_numel elements."""
+    nb_nodes = len(pos)
+    displacement = np.zeros_like(pos)
+    chunk_size = max(1, max_chunk_numel // nb_nodes)
+    for start in range(0, nb_nodes, chunk_size):
+        end = min(start + chunk_size, nb_nodes)
+        dx = pos[start:end, 0, None] - pos[None, :, 0]
+        dy = pos[start:end, 1, None] - pos[None, :, 1]
+        distance2 = np.maximum(dx * dx + dy * dy, 1e-4)  # minimum distance of 0.01
+        factor = k * k / distance2
+        if dense_weights is not None:
+            factor -= dense_weights[start:end] * np.sqrt(distance2) / k
+        displacement[start:end, 0] = (dx * factor).sum(axis=1)
+        displacement[start:end, 1] = (dy * factor).sum(axis=1)
+    return displacement
+
+
+def attraction_sparse(
+    pos: Float[np.ndarray, "node 2"], k: float, weights: scipy.sparse.csr_matrix
+) -> Float[np.ndarray, "node 2"]:
+    """The attractive displacement -w * |delta| * delta / k summed over the edges of the symmetric CSR matrix weights."""
+    rows = np.repeat(np.arange(weights.shape[0]), np.diff(weights.indptr))
+    delta = pos[rows] - pos[weights.indices]
+    distance = np.maximum(np.sqrt((delta**2).sum(axis=-1)), 0.01)
+    coefficients = scipy.sparse.csr_matrix(
+        (weights.data * distance / k, weights.indices, weights.indptr),
+        shape=weights.shape,
+    )
+    total = np.asarray(coefficients.sum(axis=1)).flatten()
+    return coefficients @ pos - total[:, None] * pos
+
+
+def grid_cells(
+    unit_pos: Float[np.ndarray, "node 2"], level: int
+) -> Int[np.ndarray, "node 2"]:
+    """The (x, y) cell of each node in the 2^level x 2^level grid over the unit square."""
+    nb_cells = 2**level
+    return np.minimum((unit_pos * nb_cells).astype(np.int64), nb_cells - 1)
+
+
+def repulsion_barnes_hut(
+    pos: Float[np.ndarray, "node 2"], k: float, leaf_size: int = 8
+) -> Float[np.ndarray, "node 2"]:
+    """The repulsive displacement of displacement_exact, where the distant nodes are grouped as in the Barnes-Hut approximation, in O(N log N).
+    The nodes are binned in grids of 2^l x 2^l cells over their bounding box, with l up to the finest level where a cell holds about leaf_size nodes. At each level, a node interacts with the centroids (weighted by their number of nodes) of the cells that are children of the neighbors of its parent cell but not its own neighbors. These cells are at least one cell away, and each other node falls in exactly one such cell at some level, or in the 3x3 neighboring cells at the finest level, where the interactions are exact."""
+    nb_nodes = len(pos)
+    low = pos.min(axis=0)
+    span = max(float((pos.max(axis=0) - low).max()), 1e-12)
+    unit_pos = (pos - low) / span
+    nb_levels = max(2, int(np.ceil(np.log(max(nb_nodes / leaf_size, 1)) / np.log(4))))
+    displacement = np.zeros_like(pos)
+
+    def add_interactions(nodes, others_pos, others_mass):
+        delta = pos[nodes] - others_pos
+        distance2 = np.maximum((delta**2).sum(axis=-1), 1e-4)
+        force = k * k * delta * (others_mass / distance2)[:, None]
+        for d in range(2):
+            displacement[:, d] += np.bincount(
+                nodes, weights=force[:, d], minlength=nb_nodes
+            )
+
+    for level in range(2, nb_levels + 1):  # far field
+        nb_cells = 2**level
+        cells = grid_cells(unit_pos, level)
+        cell_ids = cells[:, 0] * nb_cells + cells[:, 1]
+        mass = np.bincount(cell_ids, minlength=nb_cells**2)
+        centroids = np.stack(
+            [
+                np.bincount(cell_ids, weights=pos[:, d], minlength=nb_cells**2)
+                for d in range(2)
+            ],
+            axis=1,
+        ) / np.maximum(mass, 1)[:, None]
+
+        candidates = (
+            2 * (cells[:, None, :] // 2) + CHILDREN_OF_PARENT_NEIGHBORS[None, :, :]
+        )  # [node, 36, 2]
+        in_grid = ((candidates >= 0) & (candidates < nb_cells)).all(axis=-1)
+        far = (np.abs(candidates - cells[:, None, :]) > 1).any(axis=-1)
+        nodes, candidate_idx = np.nonzero(in_grid & far)
+        candidate_cells = candidates[nodes, candidate_idx]
+        candidate_ids = candidate_cells[:, 0] * nb_cells + candidate_cells[:, 1]
+        nonempty = mass[candidate_ids] > 0
+        nodes, candidate_ids = nodes[nonempty], candidate_ids[nonempty]
+        add_interactions(nodes, centroids[candidate_ids], mass[candidate_ids])
+
+    # near field: exact interactions with the nodes of the 3x3 neighboring cells at the finest level
+    nb_cells = 2**nb_levels
+    cells = grid_cells(unit_pos, nb_levels)
+    cell_ids = cells[:, 0] * nb_cells + cells[:, 1]
+    order = np.argsort(cell_ids, kind="stable")
+    counts = np.bincount(cell_ids, minlength=nb_cells**2)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    neighbors = cells[:, None, :] + NEIGHBOR_OFFSETS[None, :, :]  # [node, 9, 2]
+    in_grid = ((neighbors >= 0) & (neighbors < nb_cells)).all(axis=-1)
+    nodes, neighbor_idx = np.nonzero(in_grid)
+    neighbor_cells = neighbors[nodes, neighbor_idx]
+    neighbor_ids = neighbor_cells[:, 0] * nb_cells + neighbor_cells[:, 1]
+    block_sizes = counts[neighbor_ids]
+    pair_nodes = np.repeat(nodes, block_sizes)
+    block_offsets = np.arange(block_sizes.sum()) - np.repeat(
+        np.cumsum(block_sizes) - block_sizes, block_sizes
+    )
+    pair_others = order[np.repeat(starts[neighbor_ids], block_sizes) + block_offsets]
+    distinct = pair_nodes != pair_others
+    add_interactions(
+        pair_nodes[distinct], pos[pair_others[distinct]], np.ones(distinct.sum())
+    )
+    return displacement
+
+
+def initial_layout(
+    weights: scipy.sparse.csr_matrix,
+    initial_positions: Optional[
+        Union[Float[np.ndarray, "node 2"], Dict[int, np.ndarray]]
+    ],
+    rng: np.random.Generator,
+) -> Tuple[Float[np.ndarray, "node 2"], bool]:
+    """The starting positions of the layout: random in the unit square, or the warm start initial_positions. The nodes missing from the warm start (NaN rows or keys absent from the dict) are placed at the weighted mean of their placed neighbors, or at random if they have none. Return the positions and whether it is a warm start."""
+    nb_nodes = weights.shape[0]
+    if initial_positions is None:
+        return rng.random((nb_nodes, 2)), False
+    if isinstance(initial_positions, dict):
+        pos = np.full((nb_nodes, 2), np.nan)
+        for node, xy in initial_positions.items():
+            if node < nb_nodes:
+                pos[node] = xy
+    else:
+        pos = np.array(initial_positions, dtype=np.float64)[:nb_nodes]
+        if len(pos) < nb_nodes:
+            pos = np.concatenate([pos, np.full((nb_nodes - len(pos), 2), np.nan)])
+
+    missing = np.isnan(pos).any(axis=1)
+    if missing.all():
+        return rng.random((nb_nodes, 2)), False
+    if missing.any():
+        symmetric = abs(weights) + abs(weights.T)
+        to_placed = symmetric[missing][:, ~missing]
+        total = np.asarray(to_placed.sum(axis=1)).flatten()
+        neighbor_mean = (to_placed @ pos[~missing]) / np.maximum(total, 1e-12)[:, None]
+        low, high = pos[~missing].min(axis=0), pos[~missing].max(axis=0)
+        random_pos = low + rng.random((missing.sum(), 2)) * (high - low)
+        placed = np.where((total > 0)[:, None], neighbor_mean, random_pos)
+        jitter = 0.01 * (high - low).max() * rng.standard_normal(placed.shape)
+        pos[missing] = placed + jitter
+    return pos, True
+
+
+def force_directed_layout(
+    weights: scipy.sparse.spmatrix,
+    initial_positions: Optional[
+        Union[Float[np.ndarray, "node 2"], Dict[int, np.ndarray]]
+    ] = None,
+    k: Optional[float] = None,
+    iterations: int = 50,
+    barnes_hut: Optional[bool] = None,
+    leaf_size: int = 8,
+    initial_temperature: Optional[float] = None,
+    threshold: float = 1e-4,
+    rescale: bool = True,
+    seed: Optional[int] = None,
+) -> Float[np.ndarray, "node 2"]:
+    """Position the nodes of the graph of adjacency matrix weights with the Fruchterman-Reingold force-directed algorithm, as nx.spring_layout: all the nodes repel each other with a force k^2 / d, and the nodes linked by an edge attract each other with a force w * d^2 / k (the matrix is symmetrized). At each iteration, the nodes move along their displacement by at most the temperature, which decreases linearly.
+    The attractive forces are computed from the sparse edges (attraction_sparse), the repulsive forces for all the pairs of nodes at once (displacement_exact, which also computes the attractive forces of dense graphs), or with the Barnes-Hut approximation (repulsion_barnes_hut) if barnes_hut (by default when there are more than 2000 nodes).
+    initial_positions warm-starts the layout (e.g. with the layout of a graph on the same dataset). The first temperature is then 1% of the size of the layout instead of 10%, such that the layout is refined instead of reshuffled and a few iterations suffice.
+    The iterations stop when the mean displacement is below threshold. If rescale, the positions are centered and scaled to [-1, 1]. Return the [node, 2] array of positions."""
+    rng = np.random.default_rng(seed)
+    weights = scipy.sparse.csr_matrix(weights, dtype=np.float64)
+    nb_nodes = weights.shape[0]
+    if nb_nodes == 0:
+        return np.zeros((0, 2))
+    pos, warm_start = initial_layout(weights, initial_positions, rng)
+    if nb_nodes == 1:
+        return np.zeros((1, 2)) if rescale else pos
+
+    if k is None:
+        k = np.sqrt(1.0 / nb_nodes)
+    if barnes_hut is None:
+        barnes_hut = nb_nodes > 2000
+    symmetric = ((weights + weights.T) / 2).tocsr()
+    dense_weights = None
+    if not barnes_hut and symmetric.nnz > nb_nodes**2 / 4:
+        dense_weights = symmetric.toarray()  # the forces of dense graphs are computed in a single pass
+
+    if initial_temperature is None:
+        initial_temperature = 0.01 if warm_start else 0.1
+    temperature = initial_temperature * float((pos.max(axis=0) - pos.min(axis=0)).max())
+    dt = temperature / (iterations + 1)
+    for _ in range(iterations):
+        if barnes_hut:
+            displacement = repulsion_barnes_hut(pos, k, leaf_size=leaf_size)
+        else:
+            displacement = displacement_exact(pos, k, dense_weights)
+        if dense_weights is None:
+            displacement += attraction_sparse(pos, k, symmetric)
+
+        length = np.maximum(np.sqrt((displacement**2).sum(axis=-1)), 0.01)
+        delta_pos = displacement * (temperature / length)[:, None]
+        pos = pos + delta_pos
+        temperature -= dt
+        if np.linalg.norm(delta_pos) / nb_nodes < threshold:
+            break
+
+    if rescale:
+        pos = pos - pos.mean(axis=0)
+        pos = pos / max(float(np.abs(pos).max()), 1e-12)
+    return pos
@@ -16,7 +16,12 @@ import numpy as np
 from jaxtyping import Float, Int
 from typing import Callable, List, Union, Optional, Tuple, Dict, Any, Sequence
 
-from swap_graphs.core import WildPosition, ModelComponent, NOT_A_HEAD
+from swap_graphs.core import (
+    WildPosition,
+    ModelComponent,
+    NOT_A_HEAD,
+    logits_at_positions,
+)
 import os
 import pickle
 
@@ -291,20 +296,12 @@ def KL_div_sim(
 
     # kl_div = torch.nn.KLDivLoss(reduction="batchmean", log_target=True)
     log_probs_target = torch.nn.functional.log_softmax(
-        logits_target[
-            range(len(target_seqs)),
-            position_to_evaluate.positions_from_idx(target_idx),
-            :,
-        ],
-        dim=-1,  # log_softmax
+        logits_at_positions(logits_target, position_to_evaluate, target_idx),
+        dim=-1,  # log_softmax. The reference can already be log-probs at the evaluated positions (log_softmax is idempotent)
     )
 
     log_probs_source = torch.nn.functional.log_softmax(  # log_softmax
-        logits_source[
-            range(len(target_seqs)),
-            position_to_evaluate.positions_from_idx(target_idx),
-            :,
-        ],
+        logits_at_positions(logits_source, position_to_evaluate, target_idx),
         dim=-1,
     )
     return (torch.exp(log_probs_source) * (log_probs_source - log_probs_target)).sum(
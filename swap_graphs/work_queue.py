@@ -0,0 +1,165 @@
+import contextlib
+import os
+import pickle
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from attrs import define, field
+
+
+@define
+class FileWorkQueue:
+    """A work queue stored in a shared directory, such that independent processes (possibly on different nodes) can split a list of tasks. A task is claimed by creating its lease file, the lease expires if it is not renewed for lease_seconds (e.g. the worker crashed) and can then be claimed by another worker. The result of a task is written atomically in the results folder."""
+
+    queue_dir: str = field(kw_only=True)
+    lease_seconds: float = field(
+        kw_only=True, default=600.0
+    )  # a lease that has not been renewed for this duration can be reclaimed
+    worker_id: str = field(
+        kw_only=True, factory=lambda: f"{socket.gethostname()}-{os.getpid()}"
+    )
+
+    def __attrs_post_init__(self):
+        os.makedirs(os.path.join(self.queue_dir, "leases"), exist_ok=True)
+        os.makedirs(os.path.join(self.queue_dir, "results"), exist_ok=True)
+
+    def task_file_name(self, task: str) -> str:
+        return task.replace("/", "_")
+
+    def lease_path(self, task: str) -> str:
+        return os.path.join(self.queue_dir, "leases", self.task_file_name(task))
+
+    def result_path(self, task: str) -> str:
+        return os.path.join(
+            self.queue_dir, "results", self.task_file_name(task) + ".pkl"
+        )
+
+    def is_done(self, task: str) -> bool:
+        return os.path.exists(self.result_path(task))
+
+    def lease_expired(self, task: str) -> bool:
+        """Whether the lease of the task has not been renewed for lease_seconds. A missing lease is not expired."""
+        try:
+            return time.time() - os.path.getmtime(self.lease_path(task)) > self.lease_seconds
+        except FileNotFoundError:
+            return False
+
+    def lease_owner(self, task: str) -> Optional[str]:
+        """The worker id written in the lease of the task, None if the task is not leased."""
+        try:
+            with open(self.lease_path(task)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def restore_lease(self, task: str, moved_path: str):
+        """Put back a lease moved away by mistake, unless a new lease has been created in the meantime."""
+        with contextlib.suppress(FileExistsError):
+            os.link(moved_path, self.lease_path(task))  # unlike rename, never overwrites
+        os.remove(moved_path)
+
+    def try_claim(self, task: str) -> bool:
+        """Try to take the lease of the task. Return False if the task is done or leased by another worker."""
+        if self.is_done(task):
+            return False
+        if self.lease_expired(task):
+            stale_path = f"{self.lease_path(task)}.stale-{self.worker_id}"
+            try:  # only one worker can move the expired lease away
+                os.rename(self.lease_path(task), stale_path)
+            except FileNotFoundError:
+                return False
+            if time.time() - os.path.getmtime(stale_path) <= self.lease_seconds:
+                # another worker reclaimed or renewed the lease between the expiration check and the rename
+                self.restore_lease(task, stale_path)
+                return False
+            os.remove(stale_path)
+        try:
+            fd = os.open(self.lease_path(task), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.worker_id)
+        if self.is_done(task):  # completed between the first check and the lease creation
+            self.release(task)
+            return False
+        return True
+
+    def renew(self, task: str):
+        """Renew the lease of the task, such that it doesn't expire while the task is running. A lease taken over by another worker is not renewed."""
+        if self.lease_owner(task) == self.worker_id:
+            os.utime(self.lease_path(task))
+
+    def release(self, task: str):
+        """Remove the lease of the task if this worker owns it. A lease taken over by another worker (after the lease of this worker expired) is left untouched."""
+        if self.lease_owner(task) != self.worker_id:
+            return
+        released_path = f"{self.lease_path(task)}.released-{self.worker_id}"
+        try:
+            os.rename(self.lease_path(task), released_path)
+        except FileNotFoundError:
+            return
+        with open(released_path) as f:
+            owner = f.read()
+        if owner != self.worker_id:  # taken over between the owner check and the rename
+            self.restore_lease(task, released_path)
+        else:
+            os.remove(released_path)
+
+    @contextlib.contextmanager
+    def heartbeat(self, task: str) -> Iterator[None]:
+        """Renew the lease of the task in a background thread until the end of the context. The lease is released if the task raises an error."""
+        stop = threading.Event()
+
+        def renew_until_stopped():
+            while not stop.wait(self.lease_seconds / 3):
+                with contextlib.suppress(FileNotFoundError):
+                    self.renew(task)
+
+        thread = threading.Thread(target=renew_until_stopped, daemon=True)
+        thread.start()
+        try:
+            yield
+        except BaseException:
+            self.release(task)
+            raise
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, task: str, result: Any):
+        """Write the result of the task and release its lease. The result is written under a temporary name and renamed, such that readers never see a partial file."""
+        tmp_path = f"{self.result_path(task)}.tmp-{self.worker_id}"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(result, f)
+        os.replace(tmp_path, self.result_path(task))
+        self.release(task)
+
+    def load_result(self, task: str) -> Any:
+        with open(self.result_path(task), "rb") as f:
+            return pickle.load(f)
+
+    def results(self, tasks: List[str]) -> Dict[str, Any]:
+        """The results of the tasks that are done."""
+        return {t: self.load_result(t) for t in tasks if self.is_done(t)}
+
+    def run_once(
+        self, task: str, compute: Callable[[], Any], poll_seconds: float = 10.0
+    ) -> Any:
+        """Return the result of compute(), computed by a single worker of the queue: the worker that claims the task runs compute() and writes its result, the other workers wait for this result and load it. If the computing worker crashes, its lease expires and a waiting worker takes over."""
+        while not self.is_done(task):
+            if self.try_claim(task):
+                with self.heartbeat(task):
+                    result = compute()
+                self.complete(task, result)
+                return result
+            time.sleep(poll_seconds)
+        return self.load_result(task)
+
+    def claim_next(self, tasks: List[str]) -> Optional[str]:
+        """Claim the first task of the list that is neither done nor leased. Return None if there is none."""
+        for task in tasks:
+            if self.try_claim(task):
+                return task
+        return None
@@ -11,6 +11,7 @@ from copy import deepcopy
 from functools import partial
 from pathlib import Path
 from pprint import pprint
+from types import SimpleNamespace
 from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import datasets
@@ -19,6 +20,7 @@ import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 import plotly.express as px
+import scipy.sparse
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -38,15 +40,35 @@ from swap_graphs.datasets.ioi.ioi_utils import (
 from IPython import get_ipython  # type: ignore
 from jaxtyping import Float, Int
 from names_generator import generate_name
+import swap_graphs.core
+from swap_graphs.community_detection import detect_communities
 from swap_graphs.core import (
     ActivationStore,
+    IncrementalPatchingEngine,
     CompMetric,
     ModelComponent,
     SwapGraph,
     WildPosition,
     find_important_components,
+    plan_batch_size,
+    available_memory_bytes,
     SgraphDataset,
+    compute_batched_weights,
     compute_clustering_metrics,
+    component_patching_hook,
+    active_edge_sampling,
+    default_weight_func,
+    evaluate_edges_until_convergence,
+    append_edge_log,
+    load_edge_log,
+    logits_at_positions,
+    run_batches_with_backoff,
+    run_blocks_with_hooks,
+    run_pipelined_batches,
+    run_with_hooks_at_positions,
+    sample_edges,
+    sample_edges_to_new_nodes,
+    unembed_resid,
 )
 from torch.utils.data import DataLoader
 from transformer_lens import (
@@ -82,6 +104,7 @@ from swap_graphs.core import SgraphDataset, SwapGraph
 from tqdm import tqdm
 
 import networkx as nx
+from networkx.algorithms import community
 from sklearn.metrics.cluster import adjusted_rand_score
 
 torch.set_grad_enabled(False)
@@ -108,4 +131,1021 @@ def test_model_component():
     assert str(a) == "blocks.8.attn.hook_z.h6@test"
     
     
-    
\ No newline at end of file
+    
+
+def test_component_patching_hook():
+    torch.manual_seed(0)
+    batch, seq, n_heads, d_head = 8, 10, 4, 5
+    dataset_positions = [rd.randint(0, seq - 1) for _ in range(20)]
+    position = WildPosition(position=dataset_positions, label="test")
+    source_idx = [rd.randint(0, 19) for _ in range(batch)]
+    target_idx = [rd.randint(0, 19) for _ in range(batch)]
+
+    head_compo = ModelComponent(position=position, layer=3, name="z", head=2)
+    layer_compo = ModelComponent(position=position, layer=3, name="mlp")
+
+    for compo, shape in [
+        (head_compo, (batch, seq, n_heads, d_head)),
+        (layer_compo, (batch, seq, n_heads * d_head)),
+    ]:
+        z = torch.randn(shape)
+        cache = torch.randn(shape)
+        expected = z.clone()
+        for i in range(batch):
+            t_pos = position.positions_from_idx(target_idx)[i]
+            s_pos = position.positions_from_idx(source_idx)[i]
+            if compo.is_head():
+                expected[i, t_pos, compo.head] = cache[i, s_pos, compo.head]
+            else:
+                expected[i, t_pos] = cache[i, s_pos]
+
+        patched = component_patching_hook(
+            z.clone(),
+            hook=None,  # type: ignore
+            cache=cache,
+            component=compo,
+            source_idx=source_idx,
+            target_idx=target_idx,
+        )
+        assert torch.equal(patched, expected)
+
+
+def test_run_batches_with_backoff():
+    max_rows = 3
+    calls = []
+
+    def run_batch(start, end):
+        calls.append((start, end))
+        if end - start > max_rows:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return torch.arange(start, end)
+
+    results = run_batches_with_backoff(10, 8, run_batch)
+    assert torch.equal(torch.cat(results), torch.arange(10))
+    assert calls[:3] == [(0, 8), (0, 4), (0, 2)]
+
+    def failing_batch(start, end):
+        raise RuntimeError("another error")
+
+    try:
+        run_batches_with_backoff(10, 8, failing_batch)
+        assert False, "the error should be raised"
+    except RuntimeError as e:
+        assert str(e) == "another error"
+
+
+def test_plan_batch_size():
+    model = tiny_model()
+    assert model.cfg.device == "cpu"
+    batch_size = plan_batch_size(model, seq_len=8)
+    assert batch_size > 0
+    assert plan_batch_size(model, seq_len=8, max_batch_size=4) == min(4, batch_size)
+    assert plan_batch_size(model, seq_len=8, full_logits=False) >= batch_size
+    tokens, end = tiny_dataset()
+    components = [ModelComponent(position=end, layer=1, name="z", head=0)]
+    with_patch_values = plan_batch_size(model, seq_len=8, components=components)
+    assert 0 < with_patch_values <= batch_size
+    with_cache = plan_batch_size(
+        model, seq_len=8, components=components, nb_cached_rows=10**6
+    )
+    assert 0 < with_cache < with_patch_values
+
+
+def test_available_memory_bytes(monkeypatch):
+    assert available_memory_bytes("cpu") > 0
+
+    def sysconf(name):
+        raise ValueError(f"unrecognized configuration name {name}")
+
+    monkeypatch.setattr(swap_graphs.core, "NO_PSUTIL", True)
+    monkeypatch.setattr(os, "sysconf", sysconf)  # as on macOS
+    assert available_memory_bytes("cpu") == swap_graphs.core.FALLBACK_MEMORY_BYTES
+
+
+def test_run_pipelined_batches():
+    x = torch.randn(50, 7)
+    results = run_pipelined_batches(
+        50,
+        8,
+        prepare_batch=lambda start, end: x[start:end],
+        forward_batch=lambda inputs: inputs.exp(),
+        finish_batch=lambda inputs, outputs: (outputs * inputs).sum(dim=-1),
+    )
+    assert torch.equal(torch.cat(results), (x.exp() * x).sum(dim=-1))
+
+
+def test_pipelined_batched_weights():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    source_IDs, target_IDs = sample_edges(
+        len(tokens), nb_edges=60, generator=torch.Generator().manual_seed(0)
+    )
+    components = [
+        ModelComponent(position=end, layer=1, name="z", head=0),
+        ModelComponent(position=end, layer=2, name="mlp"),
+    ]
+    comp_metric = partial(KL_div_sim, position_to_evaluate=end)
+    for kwargs in [
+        {},
+        {"eval_position": end},
+        {"row_components": [components[i % 2] for i in range(len(target_IDs))]},
+    ]:
+        serial, pipelined = [
+            compute_batched_weights(
+                model,
+                tokens,
+                source_IDs,
+                target_IDs,
+                16,  # the last batch is incomplete
+                components,
+                comp_metric,
+                progress_bar=False,
+                pipeline=pipeline,
+                **kwargs,
+            )
+            for pipeline in [False, True]
+        ]
+        assert torch.equal(serial, pipelined)
+
+
+def test_sample_edges():
+    nb_nodes = 30
+    generator = torch.Generator().manual_seed(0)
+    for kwargs in [
+        dict(proba_edge=0.3),
+        dict(nb_edges=200),
+        dict(sources_per_target=4, max_chunk_numel=100),
+    ]:
+        sources, targets = sample_edges(nb_nodes, generator=generator, **kwargs)
+        pairs = list(zip(targets, sources))
+        assert all(s != t for s, t in zip(sources, targets))
+        assert len(set(pairs)) == len(pairs)
+        assert pairs == sorted(pairs)
+        if "nb_edges" in kwargs:
+            assert len(pairs) == 200
+        if "sources_per_target" in kwargs:
+            assert targets == [t for t in range(nb_nodes) for _ in range(4)]
+
+    sources, targets = sample_edges(nb_nodes, proba_edge=1.0)
+    assert len(sources) == nb_nodes * (nb_nodes - 1)
+
+
+def test_active_edge_sampling():
+    nb_nodes = 40
+    rng = np.random.default_rng(0)
+    labels = np.arange(nb_nodes) % 4
+    comp_metrics = np.where(
+        labels[:, None] == labels[None, :],
+        rng.uniform(0.0, 0.5, (nb_nodes, nb_nodes)),
+        rng.uniform(1.5, 2.5, (nb_nodes, nb_nodes)),
+    )
+    evaluated = []
+
+    def evaluate_edges(sources, targets):
+        evaluated.extend(zip(targets, sources))
+        return comp_metrics[sources, targets]
+
+    sources, targets, metrics = active_edge_sampling(
+        nb_nodes, evaluate_edges, edge_budget=400, initial_sources_per_target=3, seed=0
+    )
+    assert len(sources) == len(evaluated) == 400
+    assert len(set(evaluated)) == len(evaluated)  # each pair is evaluated once
+    assert (sources != targets).all()
+    assert np.allclose(metrics, comp_metrics[sources, targets])
+    weights = default_weight_func(metrics)(metrics)
+    found = detect_communities(
+        scipy.sparse.csr_matrix((weights, (sources, targets)), shape=(nb_nodes, nb_nodes)),
+        seed=0,
+    )
+    assert adjusted_rand_score(labels, found) == 1.0
+
+
+def test_evaluate_edges_until_convergence():
+    nb_nodes = 100
+    rng = np.random.default_rng(0)
+    labels = np.arange(nb_nodes) % 4
+    comp_metrics = np.where(
+        labels[:, None] == labels[None, :],
+        rng.uniform(0.0, 0.5, (nb_nodes, nb_nodes)),
+        rng.uniform(1.5, 2.5, (nb_nodes, nb_nodes)),
+    )
+    all_sources, all_targets = sample_edges(nb_nodes, proba_edge=1.0)
+
+    sources, targets, metrics, trace, converged = evaluate_edges_until_convergence(
+        nb_nodes,
+        lambda s, t: comp_metrics[s, t],
+        all_sources,
+        all_targets,
+        round_size=200,
+        patience=2,
+        seed=0,
+    )
+    assert converged
+    assert len(sources) < len(all_sources) // 2
+    assert [r["nb_edges"] for r in trace] == [200 * (i + 1) for i in range(len(trace))]
+    assert all(r["ari"] >= 0.95 for r in trace[-2:])
+    assert np.allclose(metrics, comp_metrics[sources, targets])
+    pairs = list(zip(targets.tolist(), sources.tolist()))
+    assert pairs == sorted(set(pairs))
+
+    _, _, _, trace, converged = evaluate_edges_until_convergence(
+        nb_nodes,
+        lambda s, t: comp_metrics[s, t],
+        all_sources,
+        all_targets,
+        round_size=2000,
+        ari_threshold=1.1,
+    )
+    assert not converged
+    assert trace[-1]["nb_edges"] == len(all_sources)
+
+
+def test_edge_log(tmp_path):
+    path = str(tmp_path / "edges.log")
+    assert all(len(x) == 0 for x in load_edge_log(path))
+    append_edge_log(path, np.array([0, 1]), np.array([1, 0]), np.array([0.5, 1.5]))
+    append_edge_log(path, np.array([2]), np.array([0]), np.array([2.5]))
+    with open(path, "ab") as f:
+        f.write(b"\x01\x02")  # record truncated by an interrupted write
+    sources, targets, comp_metrics = load_edge_log(path)
+    assert sources.tolist() == [0, 1, 2]
+    assert targets.tolist() == [1, 0, 0]
+    assert comp_metrics.tolist() == [0.5, 1.5, 2.5]
+
+
+def test_sample_edges_to_new_nodes():
+    sources, targets = sample_edges_to_new_nodes(3, 5)
+    pairs = list(zip(targets, sources))
+    assert pairs == sorted(pairs)
+    old_pairs = [(t, s) for s, t in itertools.permutations(range(3), 2)]
+    all_pairs = [(t, s) for s, t in itertools.permutations(range(5), 2)]
+    assert sorted(pairs + old_pairs) == sorted(all_pairs)
+
+    generator = torch.Generator().manual_seed(0)
+    sources, targets = sample_edges_to_new_nodes(
+        3, 5, sources_per_target=2, generator=generator
+    )
+    assert targets == [3, 3, 4, 4]
+    assert all(s != t for s, t in zip(sources, targets))
+
+
+def tiny_model(positional_embedding_type: str = "standard") -> HookedTransformer:
+    """A small random model, to check on CPU that the patching variants compute the same logits as the plain patched forward pass."""
+    cfg = HookedTransformerConfig(
+        n_layers=3,
+        d_model=32,
+        d_head=8,
+        n_heads=4,
+        d_mlp=64,
+        d_vocab=50,
+        n_ctx=12,
+        act_fn="gelu",
+        normalization_type="LN",
+        positional_embedding_type=positional_embedding_type,
+        seed=0,
+        device="cpu",
+    )
+    return HookedTransformer(cfg)
+
+
+def tiny_dataset(nb_samples: int = 20, seq_len: int = 8):
+    """Random sequences and a random END position (at least 3) for each of them."""
+    generator = torch.Generator().manual_seed(0)
+    tokens = torch.randint(0, 50, (nb_samples, seq_len), generator=generator)
+    end = WildPosition(
+        torch.randint(3, seq_len, (nb_samples,), generator=generator), label="END"
+    )
+    return tokens, end
+
+
+def test_fused_patching_hooks():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    components = [
+        ModelComponent(position=end, layer=1, name="z", head=0),
+        ModelComponent(position=end, layer=1, name="z", head=2),  # same hook point
+        ModelComponent(position=3, position_label="third", layer=1, name="z", head=3),
+        ModelComponent(position=end, layer=0, name="mlp"),
+    ]
+    store = ActivationStore(model=model, dataset=tokens, listOfComponents=components)
+    target_idx = list(range(10))
+    source_idx = [
+        [(i + k + 1) % len(tokens) for i in target_idx] for k in range(len(components))
+    ]
+
+    per_component_hooks = []
+    for component, component_source_idx in zip(components, source_idx):
+        per_component_hooks += store.getPatchingHooksByIdx(
+            source_idx=component_source_idx,
+            target_idx=target_idx,
+            list_of_components=[component],
+        )
+    fused_hooks = store.getFusedPatchingHooksByIdx(
+        source_idx=source_idx, target_idx=target_idx, list_of_components=components
+    )
+    assert len(fused_hooks) == 2  # one hook per hook point
+    expected = model.run_with_hooks(tokens[target_idx], fwd_hooks=per_component_hooks)
+    fused = model.run_with_hooks(tokens[target_idx], fwd_hooks=fused_hooks)
+    assert torch.allclose(fused, expected, atol=1e-5)
+
+
+def test_sliced_activation_store():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    components = [
+        ModelComponent(position=end, layer=1, name="z", head=1),
+        ModelComponent(position=3, position_label="third", layer=1, name="z", head=1),
+        ModelComponent(position=end, layer=2, name="mlp"),
+    ]
+    comp_metric = partial(KL_div_sim, position_to_evaluate=end)
+    source_IDs, target_IDs = sample_edges(
+        len(tokens), nb_edges=60, generator=torch.Generator().manual_seed(0)
+    )
+    full_store = ActivationStore(model=model, dataset=tokens, listOfComponents=components)
+    sliced_store = ActivationStore(
+        model=model, dataset=tokens, listOfComponents=components, slice_positions=True
+    )
+    for c in components:
+        assert torch.equal(
+            sliced_store.gather_patch_values(c, source_IDs),
+            full_store.gather_patch_values(c, source_IDs),
+        )
+
+    weights = {}
+    for name, store in [("full", full_store), ("sliced", sliced_store)]:
+        weights[name] = compute_batched_weights(
+            model,
+            tokens,
+            source_IDs,
+            target_IDs,
+            16,
+            components,
+            comp_metric,
+            activation_store=store,
+            progress_bar=False,
+        )
+    assert torch.allclose(weights["sliced"], weights["full"], atol=1e-5)
+
+
+def test_chunked_activation_store():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    components = [
+        ModelComponent(position=end, layer=0, name="z", head=2),
+        ModelComponent(position=end, layer=1, name="resid_pre"),
+    ]
+    for kwargs in [dict(), dict(slice_positions=True), dict(cache_resid_pre=True)]:
+        full_store = ActivationStore(
+            model=model, dataset=tokens, listOfComponents=components, **kwargs
+        )
+        chunked_store = ActivationStore(
+            model=model,
+            dataset=tokens,
+            listOfComponents=components,
+            batch_size=6,  # the last chunk is smaller
+            **kwargs,
+        )
+        assert torch.allclose(
+            chunked_store.dataset_logits, full_store.dataset_logits, atol=1e-5
+        )
+        assert chunked_store.transformerLensCache.keys() == full_store.transformerLensCache.keys()
+        for key, activations in full_store.transformerLensCache.items():
+            assert torch.allclose(
+                chunked_store.transformerLensCache[key], activations, atol=1e-5
+            )
+
+
+def test_disk_activation_store(tmp_path, monkeypatch):
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    components = [
+        ModelComponent(position=end, layer=1, name="z", head=0),
+        ModelComponent(position=end, layer=2, name="mlp"),
+    ]
+    kwargs = dict(
+        dataset=tokens,
+        listOfComponents=components,
+        slice_positions=True,
+        eval_position=end,
+        cache_resid_pre=True,
+    )
+    memory_store = ActivationStore(model=model, **kwargs)
+    disk_store = ActivationStore(model=model, cache_dir=str(tmp_path), **kwargs)
+
+    def no_forward(*args, **kwargs):
+        raise AssertionError("The cache should be loaded from disk")
+
+    with monkeypatch.context() as m:
+        m.setattr(ActivationStore, "compute_buffers", no_forward)
+        reloaded_store = ActivationStore(model=model, cache_dir=str(tmp_path), **kwargs)
+    for store in [disk_store, reloaded_store]:
+        assert torch.allclose(store.dataset_logits, memory_store.dataset_logits)
+        assert store.transformerLensCache.keys() == memory_store.transformerLensCache.keys()
+        for key, activations in memory_store.transformerLensCache.items():
+            assert torch.allclose(store.transformerLensCache[key], activations)
+
+    # the cache is not reused for other weights, or other position values with the same label
+    other_model = tiny_model()
+    other_model.blocks[0].mlp.W_in.data *= 2.0
+    other_store = ActivationStore(model=other_model, cache_dir=str(tmp_path), **kwargs)
+    assert other_store.disk_cache_path() != disk_store.disk_cache_path()
+    assert not torch.allclose(other_store.dataset_logits, disk_store.dataset_logits)
+    tagged_paths = [
+        ActivationStore(
+            model=model, cache_dir=str(tmp_path), cache_version=version, **kwargs
+        ).disk_cache_path()
+        for version in ["v1", "v2"]
+    ]
+    assert tagged_paths[0] != tagged_paths[1]
+
+    other_end = WildPosition([p - 1 for p in end.position], label="END")
+    other_components = [
+        ModelComponent(position=other_end, layer=1, name="z", head=0)
+    ]
+    store = ActivationStore(
+        model=model,
+        dataset=tokens,
+        listOfComponents=other_components,
+        slice_positions=True,
+        cache_dir=str(tmp_path),
+    )
+    assert store.cache_key(other_components[0]) != store.cache_key(components[0])
+    full_store = ActivationStore(
+        model=model, dataset=tokens, listOfComponents=other_components
+    )
+    all_idx = list(range(len(tokens)))
+    assert torch.allclose(
+        store.gather_patch_values(other_components[0], all_idx),
+        full_store.gather_patch_values(other_components[0], all_idx),
+    )
+
+
+def test_activation_store_eviction():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    components = []
+    for l in range(3):
+        components.append(ModelComponent(position=end, layer=l, name="z", head=1))
+        components.append(ModelComponent(position=end, layer=l, name="mlp"))
+    comp_metric = partial(KL_div_sim, position_to_evaluate=end)
+    source_IDs, target_IDs = sample_edges(
+        len(tokens), nb_edges=40, generator=torch.Generator().manual_seed(0)
+    )
+    hook_nbytes = ActivationStore(
+        model=model, dataset=tokens, listOfComponents=components[:1]
+    ).cache_nbytes()
+
+    for budget in [None, int(2.5 * hook_nbytes)]:
+        store = ActivationStore(
+            model=model,
+            dataset=tokens,
+            listOfComponents=components[:1],
+            cache_budget_bytes=budget,
+        )
+        for i, component in enumerate(components):
+            store.change_component_list([component], prefetch=components[i + 1 :])
+            assert store.cache_key(component) in store.transformerLensCache
+            if budget is None:
+                assert list(store.transformerLensCache) == [store.cache_key(component)]
+            else:
+                assert store.cache_nbytes() <= budget
+            weights = compute_batched_weights(
+                model,
+                tokens,
+                source_IDs,
+                target_IDs,
+                16,
+                [component],
+                comp_metric,
+                activation_store=store,
+                progress_bar=False,
+            )
+            expected = compute_batched_weights(
+                model,
+                tokens,
+                source_IDs,
+                target_IDs,
+                16,
+                [component],
+                comp_metric,
+                progress_bar=False,
+            )
+            assert torch.allclose(weights, expected, atol=1e-5)
+        assert store.cache_key(components[0]) not in store.transformerLensCache
+
+
+def test_eval_position_activation_store():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    components = [ModelComponent(position=end, layer=1, name="z", head=3)]
+    full_store = ActivationStore(model=model, dataset=tokens, listOfComponents=components)
+    eval_store = ActivationStore(
+        model=model, dataset=tokens, listOfComponents=components, eval_position=end
+    )
+    assert eval_store.dataset_logits.shape == (len(tokens), model.cfg.d_vocab)
+    assert torch.allclose(
+        eval_store.dataset_logits,
+        torch.log_softmax(logits_at_positions(full_store.dataset_logits, end), dim=-1),
+        atol=1e-5,
+    )
+
+    comp_metric = partial(KL_div_sim, position_to_evaluate=end)
+    source_IDs, target_IDs = sample_edges(
+        len(tokens), nb_edges=60, generator=torch.Generator().manual_seed(0)
+    )
+    weights = {}
+    for name, store in [("full", full_store), ("eval", eval_store)]:
+        weights[name] = compute_batched_weights(
+            model,
+            tokens,
+            source_IDs,
+            target_IDs,
+            16,
+            components,
+            comp_metric,
+            activation_store=store,
+            progress_bar=False,
+        )
+    assert torch.allclose(weights["eval"], weights["full"], atol=1e-5)
+
+
+def test_position_restricted_unembedding():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    components = [ModelComponent(position=end, layer=1, name="mlp")]
+    store = ActivationStore(model=model, dataset=tokens, listOfComponents=components)
+    target_idx = list(range(10))
+    hooks = store.getPatchingHooksByIdx(
+        source_idx=list(range(10, 20)), target_idx=target_idx
+    )
+    expected = logits_at_positions(
+        model.run_with_hooks(tokens[target_idx], fwd_hooks=hooks), end, target_idx
+    )
+    logits = run_with_hooks_at_positions(
+        model, tokens[target_idx], hooks, end, target_idx
+    )
+    assert torch.allclose(logits, expected, atol=1e-5)
+
+    generator = torch.Generator().manual_seed(0)
+    ioi_dataset = SimpleNamespace(  # the attributes read by logit_diff_comp
+        word_idx={"END": end.position},
+        io_tokenIDs=torch.randint(0, 50, (len(tokens),), generator=generator),
+        s_tokenIDs=torch.randint(0, 50, (len(tokens),), generator=generator),
+        wild_template=False,
+    )
+    source_IDs, target_IDs = sample_edges(len(tokens), nb_edges=60, generator=generator)
+    for comp_metric in [
+        partial(KL_div_sim, position_to_evaluate=end),
+        partial(logit_diff_comp, ioi_dataset=ioi_dataset),
+        partial(logit_diff_comp, ioi_dataset=ioi_dataset, keep_sign=True),
+    ]:
+        expected = compute_batched_weights(
+            model,
+            tokens,
+            source_IDs,
+            target_IDs,
+            16,
+            components,
+            comp_metric,
+            progress_bar=False,
+        )
+        weights = compute_batched_weights(
+            model,
+            tokens,
+            source_IDs,
+            target_IDs,
+            16,
+            components,
+            comp_metric,
+            progress_bar=False,
+            eval_position=end,
+        )
+        assert torch.allclose(weights, expected, atol=1e-5)
+
+
+def test_incremental_patching_engine():
+    tokens, end = tiny_dataset()
+    comp_metric = partial(KL_div_sim, position_to_evaluate=end)
+    source_IDs, target_IDs = sample_edges(
+        len(tokens), nb_edges=60, generator=torch.Generator().manual_seed(0)
+    )
+    for positional_embedding_type in ["standard", "rotary"]:
+        model = tiny_model(positional_embedding_type)
+        engine = IncrementalPatchingEngine(
+            model=model, dataset=tokens, position=end, batch_size=8
+        )
+        components = [
+            ModelComponent(position=end, layer=1, name="z", head=2),
+            ModelComponent(position=end, layer=0, name="mlp"),
+            ModelComponent(position=end, layer=2, name="resid_pre"),
+            ModelComponent(position=end, layer=1, name="k", head=0),
+            ModelComponent(position=end, layer=2, name="v", head=3),
+        ]
+        for components_to_patch in [[c] for c in components] + [components]:
+            expected = compute_batched_weights(
+                model,
+                tokens,
+                source_IDs,
+                target_IDs,
+                16,
+                components_to_patch,
+                comp_metric,
+                progress_bar=False,
+            )
+            weights = compute_batched_weights(
+                model,
+                tokens,
+                source_IDs,
+                target_IDs,
+                16,
+                components_to_patch,
+                comp_metric,
+                progress_bar=False,
+                eval_position=end,
+                incremental_engine=engine,
+            )
+            assert torch.allclose(weights, expected, atol=1e-5)
+
+
+def test_resume_from_resid_pre():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    comp_metric = partial(KL_div_sim, position_to_evaluate=end)
+    source_IDs, target_IDs = sample_edges(
+        len(tokens), nb_edges=60, generator=torch.Generator().manual_seed(0)
+    )
+    components = [
+        ModelComponent(position=end, layer=0, name="z", head=1),
+        ModelComponent(position=end, layer=0, name="resid_pre"),
+        ModelComponent(position=3, position_label="third", layer=1, name="mlp"),
+        ModelComponent(position=end, layer=2, name="z", head=0),
+    ]
+    resid_pre = ActivationStore(
+        model=model, dataset=tokens, listOfComponents=[], cache_resid_pre=True
+    ).transformerLensCache
+    _, cache = model.run_with_cache(tokens)
+    for l in range(model.cfg.n_layers):
+        key = utils.get_act_name("resid_pre", l)
+        assert torch.allclose(resid_pre[key], cache[key], atol=1e-5)
+        final_resid = run_blocks_with_hooks(model, resid_pre[key], l, [])
+        assert torch.allclose(
+            unembed_resid(model, final_resid), model(tokens), atol=1e-4
+        )
+
+    for components_to_patch in [[c] for c in components] + [components[1:3]]:
+        expected = compute_batched_weights(
+            model,
+            tokens,
+            source_IDs,
+            target_IDs,
+            16,
+            components_to_patch,
+            comp_metric,
+            progress_bar=False,
+        )
+        for eval_position in [None, end]:  # resid_eval: resume and unembed the evaluation positions
+            weights = compute_batched_weights(
+                model,
+                tokens,
+                source_IDs,
+                target_IDs,
+                16,
+                components_to_patch,
+                comp_metric,
+                progress_bar=False,
+                eval_position=eval_position,
+                cache_resid_pre=True,
+            )
+            assert torch.allclose(weights, expected, atol=1e-5)
+
+
+def test_multiplexed_component_scan():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    components_to_search = [
+        ModelComponent(position=end, layer=1, name="z", head=0),
+        ModelComponent(position=end, layer=1, name="z", head=3),  # same hook point
+        ModelComponent(position=end, layer=1, name="mlp"),
+        ModelComponent(position=end, layer=0, name="z", head=2),
+        ModelComponent(position=end, layer=2, name="resid_pre"),
+    ]
+    results = {}
+    for multiplex_components in [False, True]:
+        rd.seed(0)  # the same (source, target) pairs
+        results[multiplex_components] = find_important_components(
+            model=model,
+            dataset=tokens,
+            batch_size=30,  # 3 components per forward pass
+            components_to_search=components_to_search,
+            comp_metric=partial(KL_div_sim, position_to_evaluate=end),
+            nb_samples=10,
+            multiplex_components=multiplex_components,
+        )
+    assert len(results[True]) == len(components_to_search)
+    for multiplexed, expected in zip(results[True], results[False]):
+        assert torch.allclose(multiplexed, expected, atol=1e-5)
+
+
+def test_swap_graph_edge_arrays():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    sgraph = SwapGraph(
+        model=model,
+        tok_dataset=tokens,
+        comp_metric=partial(KL_div_sim, position_to_evaluate=end),
+        patchedComponents=[ModelComponent(position=end, layer=1, name="z", head=2)],
+        proba_edge=0.3,
+        batch_size=16,
+        seed=0,
+    )
+    sgraph.build(progress_bar=False)
+    nb_edges = len(sgraph.edge_sources)
+    assert nb_edges > 0
+    assert sgraph.edge_sources.dtype == np.int32
+    assert sgraph.edge_comp_metrics.shape == (nb_edges,)
+    assert sgraph.edges is None  # no weights before compute_weights
+
+    raw_edges = sgraph.raw_edges
+    assert raw_edges == list(
+        zip(sgraph.edge_sources, sgraph.edge_targets, sgraph.edge_comp_metrics)
+    )
+    assert sgraph.G.number_of_nodes() == len(tokens)
+    assert sorted(sgraph.G.edges(data="weight")) == sorted(raw_edges)
+
+    reloaded = SwapGraph(
+        model=model,
+        tok_dataset=tokens,
+        comp_metric=sgraph.comp_metric,
+        patchedComponents=sgraph.patchedComponents,
+    )
+    reloaded.load_comp_metric_edges(raw_edges)
+    assert (reloaded.edge_sources == sgraph.edge_sources).all()
+    assert (reloaded.edge_targets == sgraph.edge_targets).all()
+    assert np.allclose(reloaded.edge_comp_metrics, sgraph.edge_comp_metrics)
+    assert reloaded.raw_edges == raw_edges
+
+    sgraph.G  # the networkx graphs are rebuilt from the new edges
+    sgraph.set_edges(
+        sgraph.edge_sources[::2], sgraph.edge_targets[::2], sgraph.edge_comp_metrics[::2]
+    )
+    assert sgraph.G.number_of_edges() == len(sgraph.edge_sources)
+    sgraph.compute_weights(lambda x: np.where(x < np.median(x), 1.0 - x, 0.0))
+    assert len(sgraph.edges) == len(sgraph.edge_sources)
+    nonzero = [(u, v, w) for u, v, w in sgraph.edges if w != 0]
+    assert 0 < len(nonzero) < len(sgraph.edges)
+    assert sorted(sgraph.G_show.edges(data="weight")) == sorted(nonzero)
+    matrix = sgraph.weight_matrix()
+    assert matrix.nnz == len(nonzero)
+    for u, v, w in nonzero:
+        assert matrix[u, v] == w
+
+
+def test_clustering_metrics():
+    rng = np.random.default_rng(0)
+    nb_nodes = 60
+    sources, targets = np.nonzero(~np.eye(nb_nodes, dtype=bool))
+    keep = rng.random(len(sources)) < 0.3
+    sources, targets = sources[keep], targets[keep]
+    same_group = sources % 3 == targets % 3
+    comp_metrics = np.where(same_group, 0.2, 1.0) + 0.3 * rng.random(len(sources))
+    sgraph = SwapGraph(
+        model=None,
+        tok_dataset=torch.zeros((nb_nodes, 4), dtype=torch.long),
+        comp_metric=None,
+        seed=0,
+    )
+    sgraph.set_edges(sources, targets, comp_metrics)
+    sgraph.compute_weights(lambda x: np.maximum(1.0 - x, 0.0))  # some edges of weight 0
+    assert (sgraph.edge_weights == 0).any()
+
+    for backend in ["networkx", "louvain", "leiden"]:
+        sgraph.compute_communities(backend=backend)
+        metrics = compute_clustering_metrics(sgraph)
+
+        # the networkx-based computation
+        intra_cluster, extra_cluster = [], []
+        for u, v, w in sgraph.edges:
+            if sgraph.commu_labels[u] == sgraph.commu_labels[v]:
+                intra_cluster.append(w)
+            else:
+                extra_cluster.append(w)
+        modularity = community.modularity(
+            sgraph.G_show, sgraph.commu, weight="weight", resolution=1
+        )
+        assert np.isclose(metrics["modularity"], modularity, atol=1e-6)
+        assert np.isclose(metrics["intra_cluster"], np.mean(intra_cluster), atol=1e-6)
+        assert np.isclose(metrics["extra_cluster"], np.mean(extra_cluster), atol=1e-6)
+
+
+def test_skip_equal_activations(capsys):
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    tokens[10:] = tokens[:10]  # pairs of equal sequences
+    end = WildPosition(end.position[:10] * 2, label="END")
+    components = [ModelComponent(position=end, layer=1, name="z", head=0)]
+    comp_metric = partial(KL_div_sim, position_to_evaluate=end)
+
+    assert compute_batched_weights(
+        model, tokens, [], [], 16, components, comp_metric, progress_bar=False
+    ).shape == (0,)
+
+    source_IDs = list(range(20))
+    target_IDs = [(i + 10) % 20 for i in range(10)] + list(range(1, 11))
+    weights = compute_batched_weights(
+        model,
+        tokens,
+        source_IDs,
+        target_IDs,
+        16,
+        components,
+        comp_metric,
+        progress_bar=False,
+    )
+    skipped_weights = compute_batched_weights(
+        model,
+        tokens,
+        source_IDs,
+        target_IDs,
+        16,
+        components,
+        comp_metric,
+        progress_bar=False,
+        skip_equal_activations=0.0,
+    )
+    assert torch.allclose(weights, skipped_weights, atol=1e-5)
+
+    for verbose in [False, True]:
+        find_important_components(
+            model=model,
+            dataset=tokens,
+            batch_size=16,
+            components_to_search=components,
+            comp_metric=comp_metric,
+            nb_samples=5,
+            skip_equal_activations=0.0,
+            verbose=verbose,
+        )
+        assert ("Skipped" in capsys.readouterr().out) == verbose
+
+
+def test_grow_swap_graph():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    nb_old_nodes = 14
+    sgraphs = {}
+    for name, nb_nodes in [("grown", nb_old_nodes), ("fresh", len(tokens))]:
+        sgraphs[name] = SwapGraph(
+            model=model,
+            tok_dataset=tokens[:nb_nodes],
+            comp_metric=partial(KL_div_sim, position_to_evaluate=end),
+            patchedComponents=[ModelComponent(position=end, layer=1, name="z", head=1)],
+            proba_edge=1.0,
+            batch_size=16,
+            seed=0,
+            eval_position=end,  # covers the grown dataset
+            incremental_engine=IncrementalPatchingEngine(
+                model=model, dataset=tokens[:nb_nodes], position=end, batch_size=16
+            ),
+            keep_activation_store=True,
+        )
+        sgraphs[name].build(progress_bar=False)
+        sgraphs[name].compute_weights()
+    grown, fresh = sgraphs["grown"], sgraphs["fresh"]
+    grown.grow(tokens[nb_old_nodes:], progress_bar=False)
+
+    assert len(grown.edge_sources) == len(tokens) * (len(tokens) - 1)
+    grown_order = np.lexsort((grown.edge_sources, grown.edge_targets))
+    fresh_order = np.lexsort((fresh.edge_sources, fresh.edge_targets))
+    assert (grown.edge_sources[grown_order] == fresh.edge_sources[fresh_order]).all()
+    assert (grown.edge_targets[grown_order] == fresh.edge_targets[fresh_order]).all()
+    assert np.allclose(
+        grown.edge_comp_metrics[grown_order],
+        fresh.edge_comp_metrics[fresh_order],
+        atol=1e-5,
+    )
+    assert np.allclose(
+        grown.edge_weights[grown_order], fresh.edge_weights[fresh_order], rtol=1e-4
+    )  # the weight function amplifies the float errors of the comparison metric
+
+    grown_store, fresh_store = grown.activation_store, fresh.activation_store
+    assert (grown_store.dataset == fresh_store.dataset).all()
+    assert torch.allclose(
+        grown_store.dataset_logits, fresh_store.dataset_logits, atol=1e-5
+    )
+    assert len(fresh_store.transformerLensCache) > 0
+    assert (
+        grown_store.transformerLensCache.keys()
+        == fresh_store.transformerLensCache.keys()
+    )
+    for key, activations in fresh_store.transformerLensCache.items():
+        assert torch.allclose(
+            grown_store.transformerLensCache[key], activations, atol=1e-5
+        )
+
+    for name in ["past_keys", "past_values", "resid_pre"]:
+        for grown_buffer, fresh_buffer in zip(
+            getattr(grown.incremental_engine, name),
+            getattr(fresh.incremental_engine, name),
+        ):
+            assert grown_buffer.shape[0] == len(tokens)
+            assert torch.allclose(grown_buffer, fresh_buffer, atol=1e-5)
+
+
+def test_resume_build_from_edge_log(tmp_path, monkeypatch):
+    model = tiny_model()
+    tokens, end = tiny_dataset(nb_samples=12)
+    edge_log_path = str(tmp_path / "edges.log")
+
+    def new_sgraph():
+        return SwapGraph(
+            model=model,
+            tok_dataset=tokens,
+            comp_metric=partial(KL_div_sim, position_to_evaluate=end),
+            patchedComponents=[ModelComponent(position=end, layer=1, name="z", head=2)],
+            proba_edge=0.5,
+            batch_size=16,
+            seed=0,
+        )
+
+    evaluated = []
+    evaluate_edges = SwapGraph.evaluate_edges
+
+    def counting_evaluate_edges(self, source_IDs, target_IDs, **kwargs):
+        evaluated.extend(zip(source_IDs, target_IDs))
+        return evaluate_edges(self, source_IDs, target_IDs, **kwargs)
+
+    monkeypatch.setattr(SwapGraph, "evaluate_edges", counting_evaluate_edges)
+
+    full = new_sgraph()
+    full.build(progress_bar=False)
+    nb_edges = len(full.edge_sources)
+    assert nb_edges > 30
+
+    evaluated.clear()
+    interrupted = new_sgraph()
+    stream = interrupted.build_stream(
+        edge_log_path=edge_log_path,
+        chunk_size=10,
+        checkpoint_every=2,
+        progress_bar=False,
+    )
+    for _ in range(3):
+        next(stream)
+    stream.close()  # interrupted: the third chunk is flushed to the log
+    logged = set(evaluated)
+    assert len(logged) == 30
+    assert interrupted.edge_comp_metrics is None
+
+    evaluated.clear()
+    resumed = new_sgraph()
+    resumed.build(edge_log_path=edge_log_path, progress_bar=False)
+    assert len(evaluated) == nb_edges - 30  # only the missing edges
+    assert logged.isdisjoint(evaluated)
+
+    assert (resumed.edge_sources == full.edge_sources).all()
+    assert (resumed.edge_targets == full.edge_targets).all()
+    assert np.allclose(resumed.edge_comp_metrics, full.edge_comp_metrics, atol=1e-5)
+    resumed.compute_weights()
+    full.compute_weights()
+    assert np.allclose(resumed.edge_weights, full.edge_weights, rtol=1e-4)
+
+
+def test_grow_forward_passes():
+    model = tiny_model()
+    tokens, end = tiny_dataset()
+    nb_old_nodes, nb_nodes = 14, len(tokens)
+    nb_rows = [0]
+
+    def count_rows(tensor, hook):
+        nb_rows[0] += tensor.shape[0]
+
+    def new_sgraph(nb_nodes):
+        return SwapGraph(
+            model=model,
+            tok_dataset=tokens[:nb_nodes],
+            comp_metric=partial(KL_div_sim, position_to_evaluate=end),
+            patchedComponents=[ModelComponent(position=end, layer=1, name="z", head=1)],
+            proba_edge=1.0,
+            batch_size=16,
+            seed=0,
+        )  # the activation store is kept by default
+
+    model.add_perma_hook("hook_embed", count_rows)
+    try:
+        grown = new_sgraph(nb_old_nodes)
+        grown.build(progress_bar=False)
+        nb_rows[0] = 0
+        grown.grow(tokens[nb_old_nodes:], progress_bar=False)
+        grow_rows = nb_rows[0]
+
+        nb_rows[0] = 0
+        new_sgraph(nb_nodes).build(progress_bar=False)
+        rebuild_rows = nb_rows[0]
+    finally:
+        model.reset_hooks(including_permanent=True)
+
+    nb_new_edges = nb_nodes * (nb_nodes - 1) - nb_old_nodes * (nb_old_nodes - 1)
+    assert rebuild_rows == nb_nodes + nb_nodes * (nb_nodes - 1)  # clean + patched
+    # the clean forward passes of the new rows and the patched ones of the new edges
+    assert grow_rows == (nb_nodes - nb_old_nodes) + nb_new_edges
+    assert grow_rows < 0.55 * rebuild_rows
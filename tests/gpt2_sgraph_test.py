@@ -152,3 +152,37 @@ def test_gpt2_small_ioi_sgraph():
     assert (
         metrics["rand"]["IO token"] > 0.95
     ), f"IO token clustering is not good, rand = {metrics['rand']['IO token']}"
+
+
+def test_gpt2_small_skip_equal_activations():
+    ioi_dataset = IOIDataset(N=20, seed=42, nb_names=5)
+    rows = torch.randint(0, 20, (40,), generator=torch.Generator().manual_seed(0))
+    tok_dataset = ioi_dataset.prompts_tok[rows]  # sampled with replacement
+    end_position = WildPosition(
+        [int(ioi_dataset.word_idx["END"][i]) for i in rows.tolist()], label="END"
+    )
+
+    comp_metric: CompMetric = partial(KL_div_sim, position_to_evaluate=end_position)  # type: ignore
+    model = HookedTransformer.from_pretrained("gpt2-small", device="cuda")
+
+    sgraphs = []
+    for skip_equal_activations in [None, 0.0]:
+        sgraph = SwapGraph(
+            model=model,
+            tok_dataset=tok_dataset,
+            comp_metric=comp_metric,
+            batch_size=300,
+            proba_edge=1.0,
+            patchedComponents=[
+                ModelComponent(position=end_position, layer=9, head=9, name="z")
+            ],
+            skip_equal_activations=skip_equal_activations,
+        )
+        sgraph.build(progress_bar=False)
+        sgraphs.append(sgraph)
+
+    assert sgraphs[0].nb_skipped_edges == 0
+    assert sgraphs[1].nb_skipped_edges > 0, "the duplicated rows should be skipped"
+    assert np.allclose(
+        sgraphs[0].edge_comp_metrics, sgraphs[1].edge_comp_metrics, atol=1e-4
+    )
@@ -0,0 +1,77 @@
+import numpy as np
+import networkx as nx
+import scipy.sparse
+import scipy.sparse.csgraph
+from networkx.algorithms import community
+from sklearn.metrics.cluster import adjusted_rand_score
+
+from swap_graphs.community_detection import (
+    detect_communities,
+    directed_modularity,
+    refine_partition,
+)
+
+
+def planted_partition(nb_nodes: int, nb_communities: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, nb_communities, nb_nodes)
+    same = labels[:, None] == labels[None, :]
+    weights = np.where(
+        same,
+        rng.random((nb_nodes, nb_nodes)),
+        0.2 * rng.random((nb_nodes, nb_nodes)),
+    )
+    np.fill_diagonal(weights, 0)
+    return scipy.sparse.csr_matrix(weights), labels
+
+
+def test_directed_modularity():
+    weights, labels = planted_partition(40, 3)
+    G = nx.DiGraph()
+    G.add_nodes_from(range(40))
+    coo = weights.tocoo()
+    G.add_weighted_edges_from(
+        zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist())
+    )
+    partition = [set(np.flatnonzero(labels == i).tolist()) for i in range(3)]
+    assert np.isclose(directed_modularity(weights, labels), community.modularity(G, partition))
+
+
+def test_detect_communities():
+    weights, labels = planted_partition(100, 4)
+    for method in ["louvain", "leiden"]:
+        found = detect_communities(weights, method=method, seed=0)
+        assert found.shape == (100,)
+        assert adjusted_rand_score(labels, found) == 1.0
+        assert np.array_equal(found, detect_communities(weights, method=method, seed=0))
+
+
+def is_connected(weights: scipy.sparse.csr_matrix, nodes: np.ndarray) -> bool:
+    sub = weights[nodes][:, nodes]
+    nb_components, _ = scipy.sparse.csgraph.connected_components(
+        sub + sub.T, directed=False
+    )
+    return nb_components == 1
+
+
+def test_leiden_refinement():
+    rng = np.random.default_rng(0)
+    for seed in range(5):
+        weights = scipy.sparse.random(
+            80, 80, density=0.05, random_state=seed, format="csr"
+        )
+        weights.setdiag(0)
+        weights.eliminate_zeros()
+        labels = rng.integers(0, 3, 80)  # communities that may be disconnected
+        refined = refine_partition(
+            weights, labels, 1.0, np.random.default_rng(seed)
+        )
+        for sub in np.unique(refined):
+            nodes = np.flatnonzero(refined == sub)
+            assert len(np.unique(labels[nodes])) == 1  # inside a single community
+            assert is_connected(weights, nodes)
+        assert len(np.unique(refined)) < 80  # some nodes are merged
+
+        found = detect_communities(weights, method="leiden", seed=seed)
+        for c in np.unique(found):
+            assert is_connected(weights, np.flatnonzero(found == c))
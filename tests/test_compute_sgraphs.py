@@ -0,0 +1,125 @@
+import os
+import sys
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from swap_graphs.core import ModelComponent, SgraphDataset, WildPosition
+from swap_graphs.utils import KL_div_sim
+from swap_graphs.work_queue import FileWorkQueue
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "scripts"))
+from compute_sgraphs import (  # noqa: E402
+    remove_edge_logs,
+    run_component,
+    run_components_in_pool,
+)
+
+
+def load_tiny_model(model_name: str, device: str) -> HookedTransformer:
+    """The same small random model in every process (model_name is ignored)."""
+    cfg = HookedTransformerConfig(
+        n_layers=2,
+        d_model=32,
+        d_head=8,
+        n_heads=4,
+        d_mlp=64,
+        d_vocab=50,
+        n_ctx=12,
+        act_fn="gelu",
+        normalization_type="LN",
+        seed=0,
+        device=device,
+    )
+    return HookedTransformer(cfg)
+
+
+def tiny_sgraph_kwargs(fig_path: str):
+    """The components and the arguments of build_component_sgraph on random sequences."""
+    generator = torch.Generator().manual_seed(0)
+    tokens = torch.randint(0, 50, (12, 8), generator=generator)
+    end = WildPosition(torch.randint(3, 8, (12,), generator=generator), label="END")
+    components = [
+        ModelComponent(position=end, layer=0, name="z", head=1),
+        ModelComponent(position=end, layer=1, name="z", head=2),
+        ModelComponent(position=end, layer=1, name="mlp"),
+    ]
+    sgraph_kwargs = dict(
+        queue=None,
+        dataset=SimpleNamespace(prompts_tok=tokens),
+        sgraph_dataset=SgraphDataset(
+            tok_dataset=tokens,
+            str_dataset=[str(i) for i in range(len(tokens))],
+            feature_dict={"parity": [i % 2 for i in range(len(tokens))]},
+        ),
+        comp_metric=partial(KL_div_sim, position_to_evaluate=end),
+        batch_size_sgraph=32,
+        eval_position=end,
+        sorted_components=components,
+        fig_path=fig_path,
+    )
+    return components, sgraph_kwargs
+
+
+def test_process_pool(tmp_path):
+    components, sgraph_kwargs = tiny_sgraph_kwargs(str(tmp_path))
+    pooled = dict(
+        run_components_in_pool(
+            components,
+            nb_workers=2,
+            model_name="tiny",
+            device="cpu",
+            threads_per_worker=1,
+            incremental_patching=False,
+            batch_size=32,
+            sgraph_kwargs=sgraph_kwargs,
+            model_loader=load_tiny_model,
+        )
+    )
+    assert set(pooled) == {str(c) for c in components}
+
+    model = load_tiny_model("tiny", "cpu")
+    nb_threads = torch.get_num_threads()
+    torch.set_num_threads(1)  # as in the workers
+    try:
+        for c in components:
+            serial = run_component(
+                c, model=model, incremental_engine=None, **sgraph_kwargs
+            )
+            pooled_edges = np.array(pooled[str(c)]["sgraph_edges"])
+            serial_edges = np.array(serial["sgraph_edges"])
+            assert (pooled_edges[:, :2] == serial_edges[:, :2]).all()
+            assert np.allclose(pooled_edges[:, 2], serial_edges[:, 2], atol=1e-6)
+            assert pooled[str(c)]["commu"] == serial["commu"]  # seeded by component_seed
+            for name, value in serial["clustering_metrics"].items():
+                assert np.isclose(
+                    pooled[str(c)]["clustering_metrics"][name], value, atol=1e-6
+                )
+    finally:
+        torch.set_num_threads(nb_threads)
+
+
+def test_remove_edge_log(tmp_path):
+    components, sgraph_kwargs = tiny_sgraph_kwargs(str(tmp_path))
+    edge_log_dir = tmp_path / "edge_logs"
+    edge_log_dir.mkdir()
+    sgraph_kwargs.update(
+        queue=FileWorkQueue(queue_dir=str(tmp_path / "queue")),
+        edge_log_dir=str(edge_log_dir),
+    )
+    (edge_log_dir / f"{components[1]}.edges").write_bytes(b"")  # another component
+    component_data = run_component(
+        components[0],
+        model=load_tiny_model("tiny", "cpu"),
+        incremental_engine=None,
+        **sgraph_kwargs,
+    )
+    assert sgraph_kwargs["queue"].load_result(str(components[0])) is not None
+    assert len(component_data["sgraph_edges"]) == 12 * 11
+    assert os.listdir(edge_log_dir) == [f"{components[1]}.edges"]
+    remove_edge_logs(str(edge_log_dir), [str(c) for c in components])
+    assert os.listdir(edge_log_dir) == []
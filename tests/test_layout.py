@@ -0,0 +1,84 @@
+import numpy as np
+import scipy.sparse
+
+from swap_graphs.layout import (
+    attraction_sparse,
+    displacement_exact,
+    force_directed_layout,
+    repulsion_barnes_hut,
+)
+
+
+def planted_partition(nb_nodes: int, nb_communities: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, nb_communities, nb_nodes)
+    same = labels[:, None] == labels[None, :]
+    weights = np.where(
+        same,
+        rng.random((nb_nodes, nb_nodes)),
+        0.02 * rng.random((nb_nodes, nb_nodes)),
+    )
+    np.fill_diagonal(weights, 0)
+    return weights, labels
+
+
+def separation(pos, labels):
+    """The mean distance between nodes of different communities over the mean distance between nodes of the same community."""
+    distances = np.linalg.norm(pos[:, None] - pos[None], axis=-1)
+    same = labels[:, None] == labels[None, :]
+    return distances[~same].mean() / distances[same & ~np.eye(len(labels), dtype=bool)].mean()
+
+
+def test_forces():
+    rng = np.random.default_rng(0)
+    pos = rng.random((1000, 2))
+    pos[:500] = 0.3 + 0.05 * rng.standard_normal((500, 2))  # a dense cluster
+    k = np.sqrt(1 / 1000)
+    exact = displacement_exact(pos, k)
+    approx = repulsion_barnes_hut(pos, k)
+    error = np.linalg.norm(approx - exact, axis=1) / np.linalg.norm(exact, axis=1)
+    assert np.median(error) < 0.01
+    assert np.percentile(error, 95) < 0.05
+
+    weights = scipy.sparse.random(200, 200, density=0.1, random_state=0, format="csr")
+    weights = (weights + weights.T) / 2
+    pos = pos[:200]
+    dense = displacement_exact(pos, k, weights.toarray())
+    sparse = displacement_exact(pos, k) + attraction_sparse(pos, k, weights.tocsr())
+    assert np.allclose(dense, sparse)
+
+
+def test_force_directed_layout():
+    weights, labels = planted_partition(300, 4)
+    for barnes_hut in [False, True]:
+        pos = force_directed_layout(
+            scipy.sparse.csr_matrix(weights),
+            k=0.5,
+            iterations=100,
+            barnes_hut=barnes_hut,
+            seed=0,
+        )
+        assert pos.shape == (300, 2)
+        assert np.abs(pos).max() <= 1.0
+        assert separation(pos, labels) > 3
+
+
+def test_force_directed_layout_warm_start():
+    weights, labels = planted_partition(320, 4)
+    pos = force_directed_layout(
+        scipy.sparse.csr_matrix(weights[:300, :300]), k=0.5, iterations=100, seed=0
+    )
+    initial_positions = dict(enumerate(pos))  # the 20 new nodes are missing
+    warm = force_directed_layout(
+        scipy.sparse.csr_matrix(weights),
+        initial_positions=initial_positions,
+        k=0.5,
+        iterations=15,
+        seed=0,
+    )
+    assert np.abs(warm[:300] - pos).mean() < 0.1  # the layout is refined, not reshuffled
+    assert separation(warm, labels) > 3
+    cold = force_directed_layout(
+        scipy.sparse.csr_matrix(weights), k=0.5, iterations=15, seed=0
+    )
+    assert separation(warm, labels) > separation(cold, labels)
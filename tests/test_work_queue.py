@@ -0,0 +1,70 @@
+import os
+import time
+
+from swap_graphs.work_queue import FileWorkQueue
+
+
+def test_work_queue_claim_and_complete(tmp_path):
+    queue_a = FileWorkQueue(queue_dir=str(tmp_path), worker_id="a")
+    queue_b = FileWorkQueue(queue_dir=str(tmp_path), worker_id="b")
+    tasks = ["blocks.0.attn.hook_z.h0@END", "blocks.0.hook_mlp_out@END"]
+
+    assert queue_a.claim_next(tasks) == tasks[0]
+    assert queue_b.claim_next(tasks) == tasks[1]  # the first task is leased by a
+    assert queue_b.claim_next(tasks) is None
+
+    queue_a.complete(tasks[0], {"commu": {0: 1}})
+    assert queue_a.is_done(tasks[0])
+    assert not queue_b.try_claim(tasks[0])  # done tasks are never claimed again
+    assert queue_b.results(tasks) == {tasks[0]: {"commu": {0: 1}}}
+
+
+def test_work_queue_expired_lease(tmp_path):
+    queue_a = FileWorkQueue(queue_dir=str(tmp_path), worker_id="a", lease_seconds=10)
+    queue_b = FileWorkQueue(queue_dir=str(tmp_path), worker_id="b", lease_seconds=10)
+    task = "blocks.3.attn.hook_z.h2@END"
+
+    assert queue_a.try_claim(task)
+    assert not queue_b.try_claim(task)
+
+    old_time = time.time() - 20  # a crashed without renewing its lease
+    os.utime(queue_a.lease_path(task), (old_time, old_time))
+    assert queue_b.try_claim(task)
+    assert not queue_a.try_claim(task)
+
+
+def test_work_queue_reclaimed_lease(tmp_path, monkeypatch):
+    queue_a = FileWorkQueue(queue_dir=str(tmp_path), worker_id="a", lease_seconds=10)
+    queue_b = FileWorkQueue(queue_dir=str(tmp_path), worker_id="b", lease_seconds=10)
+    queue_c = FileWorkQueue(queue_dir=str(tmp_path), worker_id="c", lease_seconds=10)
+    task = "blocks.3.attn.hook_z.h2@END"
+
+    assert queue_a.try_claim(task)
+    old_time = time.time() - 20
+    os.utime(queue_a.lease_path(task), (old_time, old_time))
+    assert queue_b.try_claim(task)
+    with monkeypatch.context() as m:  # c saw the expired lease of a before b reclaimed it
+        m.setattr(FileWorkQueue, "lease_expired", lambda self, task: True)
+        assert not queue_c.try_claim(task)
+    assert queue_b.lease_owner(task) == "b"
+
+    queue_a.release(task)  # a was too slow: its lease now belongs to b
+    queue_a.complete(task, "result of a")
+    assert queue_b.lease_owner(task) == "b"
+    queue_b.complete(task, "result of b")
+    assert queue_b.lease_owner(task) is None
+    assert os.listdir(os.path.join(str(tmp_path), "leases")) == []
+
+
+def test_work_queue_run_once(tmp_path):
+    queue_a = FileWorkQueue(queue_dir=str(tmp_path), worker_id="a")
+    queue_b = FileWorkQueue(queue_dir=str(tmp_path), worker_id="b")
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"comp_metric": [1.0, 2.0]}
+
+    assert queue_a.run_once("comp_metric", compute) == {"comp_metric": [1.0, 2.0]}
+    assert queue_b.run_once("comp_metric", compute) == {"comp_metric": [1.0, 2.0]}
+    assert len(calls) == 1